@@ -0,0 +1,22 @@
+-- census_mesh_2020 の前方一致集計（GET /census-mesh/summary/:keyCodePrefix 用の事前集計）
+-- work1/party-admin/seed/06_seed_census_mesh_2020/census_rollup.py で生成・投入する
+
+CREATE TABLE census_mesh_2020_rollup (
+    key_prefix TEXT PRIMARY KEY,        -- key_code の前綴（1桁～8桁）
+    prefix_len INTEGER NOT NULL,        -- 前綴の桁数
+    mesh_level TEXT,                    -- 1st（4桁）/ 2nd（6桁）/ 3rd（8桁）、それ以外は NULL
+
+    total_population  INTEGER NOT NULL, -- SUM(t001101001) 人口（総数）
+    total_households  INTEGER NOT NULL, -- SUM(t001101034) 世帯総数
+    total_male        INTEGER NOT NULL, -- SUM(t001101002) 人口（総数）男
+    total_female      INTEGER NOT NULL, -- SUM(t001101003) 人口（総数）女
+    total_age0to14    INTEGER NOT NULL, -- SUM(t001101004) 0～14歳人口 総数
+    total_age15to64   INTEGER NOT NULL, -- SUM(t001101010) 15～64歳人口 総数
+    total_age65plus   INTEGER NOT NULL, -- SUM(t001101019) 65歳以上人口 総数
+    total_age75plus   INTEGER NOT NULL, -- SUM(t001101022) 75歳以上人口 総数
+    total_foreigners  INTEGER NOT NULL, -- SUM(t001101031) 外国人人口 総数
+
+    mesh_count INTEGER NOT NULL         -- 前綴に一致する census_mesh_2020 の行数
+);
+
+CREATE INDEX IF NOT EXISTS idx_census_mesh_2020_rollup_prefix_len ON census_mesh_2020_rollup (prefix_len);
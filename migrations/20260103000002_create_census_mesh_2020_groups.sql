@@ -0,0 +1,33 @@
+-- census_mesh_2020 の秘匿処理（htk_syori / htk_saki / gassan）を解決したメッシュグループ
+-- work1/party-admin/seed/06_seed_census_mesh_2020/census_secrecy.py で生成・投入する
+-- 秘匿元（htk_syori=2）を含むグループのみ格納する。ここに無いメッシュは自分だけのグループとして扱う。
+
+-- メッシュ → グループ
+CREATE TABLE census_mesh_2020_group_member (
+    key_code  TEXT PRIMARY KEY,         -- 標準地域メッシュコード
+    group_key TEXT NOT NULL,            -- グループ代表メッシュ（秘匿先をたどった先の htk_syori<>2 のメッシュ）
+    role      TEXT NOT NULL,            -- root（代表）/ merged（秘匿元）
+    depth     INTEGER NOT NULL          -- 代表までの htk_saki のたどり回数（root は 0）
+);
+
+CREATE INDEX IF NOT EXISTS idx_census_mesh_2020_group_member_group_key ON census_mesh_2020_group_member (group_key);
+
+-- グループ単位の実効値
+-- t001101001～003, 034, 035（秘匿されない項目）は構成メッシュの合計、
+-- それ以外は代表メッシュの値（秘匿元の数値が合算済み）
+CREATE TABLE census_mesh_2020_group (
+    group_key    TEXT PRIMARY KEY,      -- グループ代表メッシュ
+    member_count INTEGER NOT NULL,      -- 構成メッシュ数（代表を含む）
+    members      TEXT NOT NULL,         -- 構成メッシュ（;区切り、代表が先頭）
+
+    t001101001 INTEGER, t001101002 INTEGER, t001101003 INTEGER, t001101004 INTEGER, t001101005 INTEGER,
+    t001101006 INTEGER, t001101007 INTEGER, t001101008 INTEGER, t001101009 INTEGER, t001101010 INTEGER,
+    t001101011 INTEGER, t001101012 INTEGER, t001101013 INTEGER, t001101014 INTEGER, t001101015 INTEGER,
+    t001101016 INTEGER, t001101017 INTEGER, t001101018 INTEGER, t001101019 INTEGER, t001101020 INTEGER,
+    t001101021 INTEGER, t001101022 INTEGER, t001101023 INTEGER, t001101024 INTEGER, t001101025 INTEGER,
+    t001101026 INTEGER, t001101027 INTEGER, t001101028 INTEGER, t001101029 INTEGER, t001101030 INTEGER,
+    t001101031 INTEGER, t001101032 INTEGER, t001101033 INTEGER, t001101034 INTEGER, t001101035 INTEGER,
+    t001101036 INTEGER, t001101037 INTEGER, t001101038 INTEGER, t001101039 INTEGER, t001101040 INTEGER,
+    t001101041 INTEGER, t001101042 INTEGER, t001101043 INTEGER, t001101044 INTEGER, t001101045 INTEGER,
+    t001101046 INTEGER, t001101047 INTEGER, t001101048 INTEGER, t001101049 INTEGER, t001101050 INTEGER
+);
@@ -1,12 +1,12 @@
 BEGIN TRANSACTION;
-INSERT INTO m_parties (id, name, color_code, notes, created_at, updated_at, alive) VALUES ('ldp', '自由民主党', '#124391', 'LDP', '2025-12-29 05:04:44', '2025-12-29 05:04:44', 0);
-INSERT INTO m_parties (id, name, color_code, notes, created_at, updated_at, alive) VALUES ('cdp', '立憲民主党', '#005299', 'CDP', '2025-12-29 05:04:44', '2025-12-29 05:04:44', 0);
-INSERT INTO m_parties (id, name, color_code, notes, created_at, updated_at, alive) VALUES ('jip', '日本維新の会', '#A8C300', 'JIP', '2025-12-29 05:04:44', '2025-12-29 05:04:44', 0);
-INSERT INTO m_parties (id, name, color_code, notes, created_at, updated_at, alive) VALUES ('komei', '公明党', '#F39800', 'Komeito', '2025-12-29 05:04:44', '2025-12-29 05:04:44', 0);
-INSERT INTO m_parties (id, name, color_code, notes, created_at, updated_at, alive) VALUES ('dpfp', '国民民主党', '#FFD700', 'DPFP', '2025-12-29 05:04:44', '2025-12-29 05:04:44', 0);
-INSERT INTO m_parties (id, name, color_code, notes, created_at, updated_at, alive) VALUES ('jcp', '日本共産党', '#DB001C', 'JCP', '2025-12-29 05:04:44', '2025-12-29 05:04:44', 0);
-INSERT INTO m_parties (id, name, color_code, notes, created_at, updated_at, alive) VALUES ('reiwa', 'れいわ新選組', '#E6007E', 'Reiwa', '2025-12-29 05:04:44', '2025-12-29 05:04:44', 0);
-INSERT INTO m_parties (id, name, color_code, notes, created_at, updated_at, alive) VALUES ('sdp', '社会民主党', '#00A1E9', 'SDP', '2025-12-29 05:04:44', '2025-12-29 05:04:44', 0);
-INSERT INTO m_parties (id, name, color_code, notes, created_at, updated_at, alive) VALUES ('sansei', '参政党', '#FF8C00', 'Sanseito', '2025-12-29 05:04:44', '2025-12-29 05:04:44', 0);
-INSERT INTO m_parties (id, name, color_code, notes, created_at, updated_at, alive) VALUES ('cpj', '日本保守党', '#000000', 'CPJ', '2025-12-29 05:04:44', '2025-12-29 05:04:44', 1);
+INSERT INTO m_parties (party_id, name, short_name, color_code, note, logo_url, is_active) VALUES ('ldp', '自由民主党', NULL, '#124391', 'LDP', NULL, 0);
+INSERT INTO m_parties (party_id, name, short_name, color_code, note, logo_url, is_active) VALUES ('cdp', '立憲民主党', NULL, '#005299', 'CDP', NULL, 0);
+INSERT INTO m_parties (party_id, name, short_name, color_code, note, logo_url, is_active) VALUES ('jip', '日本維新の会', NULL, '#A8C300', 'JIP', NULL, 0);
+INSERT INTO m_parties (party_id, name, short_name, color_code, note, logo_url, is_active) VALUES ('komei', '公明党', NULL, '#F39800', 'Komeito', NULL, 0);
+INSERT INTO m_parties (party_id, name, short_name, color_code, note, logo_url, is_active) VALUES ('dpfp', '国民民主党', NULL, '#FFD700', 'DPFP', NULL, 0);
+INSERT INTO m_parties (party_id, name, short_name, color_code, note, logo_url, is_active) VALUES ('jcp', '日本共産党', NULL, '#DB001C', 'JCP', NULL, 0);
+INSERT INTO m_parties (party_id, name, short_name, color_code, note, logo_url, is_active) VALUES ('reiwa', 'れいわ新選組', NULL, '#E6007E', 'Reiwa', NULL, 0);
+INSERT INTO m_parties (party_id, name, short_name, color_code, note, logo_url, is_active) VALUES ('sdp', '社会民主党', NULL, '#00A1E9', 'SDP', NULL, 0);
+INSERT INTO m_parties (party_id, name, short_name, color_code, note, logo_url, is_active) VALUES ('sansei', '参政党', NULL, '#FF8C00', 'Sanseito', NULL, 0);
+INSERT INTO m_parties (party_id, name, short_name, color_code, note, logo_url, is_active) VALUES ('cpj', '日本保守党', NULL, '#04a3ffff', 'CPJ', NULL, 1);
 COMMIT;
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: per-row census conversion before/after CompiledSchema.
+
+Rows are parsed into memory first so only the projection is timed:
+  sql   the old genarate_census_mesh_2020.py loop (dict lookups per cell,
+        TARGET_COLS.index() for unmapped columns, value_to_sql) vs
+        CompiledSchema.sql_literals
+  json  the old upload_kv.py process_row_to_json (regex header
+        normalisation per cell on csv.DictReader rows) vs
+        CompiledSchema.json_object
+Both outputs are compared row by row before timings are reported.
+
+Usage: python bench_census_schema.py [--file tblT001101H13.txt] [--repeat 3]
+"""
+
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+from typing import Optional
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from seed_io import open_csv_stream  # noqa: E402
+from census_schema import TARGET_COLS, CompiledSchema, build_index_map, quote_sql  # noqa: E402
+
+
+# --- reference implementations (as they were before CompiledSchema) ---
+
+def legacy_value_to_sql(col: str, raw: str) -> str:
+    if raw is None:
+        return 'NULL'
+    v = raw.strip()
+    if v == '' or v == '*' or v == '　':
+        return 'NULL'
+    if col in ('key_code','htk_saki','gassan'):
+        return quote_sql(v)
+    v2 = v.replace(',', '').strip()
+    try:
+        ival = int(v2)
+        return str(ival)
+    except Exception:
+        return 'NULL'
+
+
+def legacy_sql_literals(column_index_map, csv_row):
+    values_list = []
+    for column in TARGET_COLS:
+        idx = column_index_map.get(column)
+        raw = None
+        if idx is not None and idx < len(csv_row):
+            raw = csv_row[idx]
+        else:
+            pos = TARGET_COLS.index(column)
+            if pos < len(csv_row):
+                raw = csv_row[pos]
+        values_list.append(legacy_value_to_sql(column, raw))
+    return values_list
+
+
+def legacy_norm_header(h: str) -> str:
+    h = h.strip()
+    return re.sub(r'[^0-9a-z]+', '_', h.lower())
+
+
+def legacy_clean_raw_value(raw: Optional[str]) -> Optional[str]:
+    if raw is None:
+        return None
+    s = raw.strip().strip('　')
+    if s == '' or s == '*' or s == '　':
+        return None
+    return s
+
+
+def legacy_try_int_conversion(s: Optional[str]) -> Optional[int]:
+    if s is None:
+        return None
+    s2 = s.replace(',', '')
+    if re.fullmatch(r'-?\d+', s2):
+        try:
+            return int(s2)
+        except Exception:
+            return None
+    return None
+
+
+def legacy_process_row_to_json(fieldnames, row, to_array_htksaki=False):
+    out = {}
+    for orig_h in fieldnames:
+        norm_h = legacy_norm_header(orig_h)
+        raw = row.get(orig_h)
+        cleaned = legacy_clean_raw_value(raw)
+        if orig_h.strip().upper() == 'HTKSAKI' or norm_h == 'htk_saki':
+            if cleaned is None:
+                val = None
+            else:
+                if to_array_htksaki:
+                    val = [p for p in re.split(r'[;，、]', cleaned) if p != '']
+                else:
+                    val = cleaned
+        else:
+            num = legacy_try_int_conversion(cleaned)
+            if num is not None:
+                val = num
+            else:
+                val = cleaned
+        out[norm_h] = val
+    return out
+
+
+def timed(label, func, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for row in rows:
+            func(row)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    rate = len(rows) / best if best else float('inf')
+    print(f'  {label:<10} {best:8.3f}s  {rate:12,.0f} rows/s')
+    return rate
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file', help='census CSV to benchmark (default: largest file in census_mesh_2020_data)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per variant; the best is reported')
+    args = parser.parse_args()
+
+    path = args.file
+    if not path:
+        candidates = glob.glob(os.path.join(script_dir, 'census_mesh_2020_data', '*.txt'))
+        if not candidates:
+            print('No input files found; pass --file', file=sys.stderr)
+            sys.exit(1)
+        path = max(candidates, key=os.path.getsize)
+
+    with open_csv_stream(path) as reader:
+        header = reader.header
+        rows = [row for row in reader if row]
+    dict_rows = [dict(zip(header, row)) for row in rows]
+    print(f'{os.path.basename(path)}: {len(rows)} rows, {len(header)} columns')
+
+    schema = CompiledSchema(header)
+    index_map = build_index_map(header)
+
+    # correctness first: the compiled schema must match the old code exactly
+    for row, drow in zip(rows, dict_rows):
+        if schema.sql_literals(row) != legacy_sql_literals(index_map, row):
+            sys.exit(f'SQL mismatch for row {row[:3]}')
+        if schema.json_object(row) != legacy_process_row_to_json(header, drow):
+            sys.exit(f'JSON mismatch for row {row[:3]}')
+
+    print('sql')
+    before = timed('before', lambda r: legacy_sql_literals(index_map, r), rows, args.repeat)
+    after = timed('compiled', schema.sql_literals, rows, args.repeat)
+    print(f'  speedup    {after / before:.2f}x')
+    print('json')
+    before = timed('before', lambda r: legacy_process_row_to_json(header, r), dict_rows, args.repeat)
+    after = timed('compiled', schema.json_object, rows, args.repeat)
+    print(f'  speedup    {after / before:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
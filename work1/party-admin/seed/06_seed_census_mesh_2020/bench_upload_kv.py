@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark: upload_kv.py in each upload mode against a local KV.
+
+A synthetic census dataset (same header, description row, CP932 and key
+layout as census_mesh_2020_data) is generated into a temporary directory,
+or --indir points at real files. kv_stub_server.serve() runs in this
+process, and every mode runs upload_kv.py as a child process into a
+namespace of its own:
+
+  sequential   one PUT per row on the main thread
+  parallel     --parallel 16
+  async        --async-requests 64
+  adaptive     --async-requests 16 --adaptive
+  bulk         --bulk
+  bulk-binary  --bulk --value-encoding binary
+  encode       --bulk --encode-workers 2
+  shard        --layout shard --async-requests 64
+  wrangler     --use-wrangler through kv_fake_wrangler.py (no HTTP)
+  only-json    --only-json (no network; the read / encode / write floor)
+
+Each run writes --metrics-file (kv_metrics.py); the table reports wall
+time, rows/s, request attempts, retries, throttled (429) and failed (5xx /
+no response / non-zero exit) attempts as the uploader saw them, requests
+the server saw, the peak RSS of the uploader and its encode workers, and
+the keys stored afterwards.
+
+Usage: python bench_upload_kv.py [--rows 5000] [--files 4] [--latency 0.01]
+                                 [--error-rate 0.01] [--rate-limit 500]
+                                 [--modes async,bulk] [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from kv_stub_server import KVServer, serve
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+UPLOADER = os.path.join(SCRIPT_DIR, 'upload_kv.py')
+FAKE_WRANGLER = os.path.join(SCRIPT_DIR, 'kv_fake_wrangler.py')
+
+MODES = {
+    'sequential': [],
+    'parallel': ['--parallel', '16'],
+    'async': ['--async-requests', '64'],
+    'adaptive': ['--async-requests', '16', '--adaptive'],
+    'bulk': ['--bulk'],
+    'bulk-binary': ['--bulk', '--value-encoding', 'binary'],
+    'encode': ['--bulk', '--encode-workers', '2'],
+    'shard': ['--layout', 'shard', '--async-requests', '64'],
+    'wrangler': ['--use-wrangler'],
+    'only-json': ['--only-json'],
+}
+# the uploader's pacing and progress output would only measure themselves
+COMMON_ARGS = ['--sleep', '0', '--progress-every', '0', '--upload-batch-size', '0', '--stats-interval', '0']
+
+HEADER = ['KEY_CODE', 'HTKSYORI', 'HTKSAKI', 'GASSAN'] + [f'T001101{i:03d}' for i in range(1, 51)]
+MESHES_PER_PRIMARY = 64 * 100 * 4  # 2nd level x 3rd level x half meshes under one 1st level mesh
+
+
+# --- synthetic dataset ---
+
+def _key_code(n: int) -> str:
+    """n-th 9-digit half mesh code: 1st level mesh, 2nd level (2 digits 0-7), 3rd level (2 digits), half (1-4)."""
+    primary, rest = divmod(n, MESHES_PER_PRIMARY)
+    second, rest = divmod(rest, 400)
+    third, half = divmod(rest, 4)
+    return f'{5339 + primary:04d}{second // 8}{second % 8}{third:02d}{half + 1}'
+
+
+def _row(rng: random.Random, key_code: str) -> List[str]:
+    population = rng.choice((rng.randint(0, 20), rng.randint(0, 400), rng.randint(0, 3000)))
+    if population < 3 and rng.random() < 0.5:
+        # secrecy: a small mesh is merged into a neighbour and its cells are hidden
+        return [key_code, '2', _key_code(rng.randint(0, 10 * MESHES_PER_PRIMARY)), ''] + ['*'] * 50
+    cells = []
+    for _ in range(50):
+        cells.append(str(rng.randint(0, population)) if rng.random() < 0.9 else '')
+    return [key_code, '0', '', ''] + cells
+
+
+def generate_dataset(outdir: str, rows: int, files: int, seed: int = 0) -> int:
+    """Write `rows` mesh rows over `files` census files; the number of keyed rows written."""
+    rng = random.Random(seed)
+    os.makedirs(outdir, exist_ok=True)
+    description = ['', '', '', ''] + [f'　項目{i:02d}' for i in range(1, 51)]
+    per_file = -(-rows // files)
+    written = 0
+    for f in range(files):
+        count = min(per_file, rows - written)
+        if count <= 0:
+            break
+        path = os.path.join(outdir, f'tblT001101H{f + 1:02d}.txt')
+        with open(path, 'w', encoding='cp932', newline='') as out:
+            out.write(','.join(HEADER) + '\r\n')
+            out.write(','.join(description) + '\r\n')
+            for n in range(written, written + count):
+                out.write(','.join(_row(rng, _key_code(n))) + '\r\n')
+        written += count
+    return written
+
+
+# --- one run ---
+
+def _wait_rusage(proc: subprocess.Popen) -> int:
+    """Wait for proc; its peak RSS in bytes (the largest of it and its reaped children)."""
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def _fake_wrangler_keys(db_path: str, namespace: str) -> Optional[int]:
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM kv WHERE namespace = ?', (namespace,)).fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+
+
+def run_mode(mode: str, indir: str, workdir: str, server: KVServer, extra: List[str],
+             wrangler_startup: float) -> Dict:
+    namespace = f'bench-{mode}'
+    rundir = os.path.join(workdir, mode)
+    shutil.rmtree(rundir, ignore_errors=True)
+    os.makedirs(rundir)
+    metrics_path = os.path.join(rundir, 'metrics.json')
+    command = [sys.executable, UPLOADER, '--indir', indir, '--api-base', server.base_url,
+               '--checkpoint-file', os.path.join(rundir, 'checkpoint'), '--metrics-file', metrics_path,
+               *COMMON_ARGS, *MODES[mode], *extra]
+    env = {**os.environ, 'CF_ACCOUNT_ID': 'bench', 'CF_NAMESPACE_ID': namespace, 'CF_API_TOKEN': 'bench'}
+    if mode == 'wrangler':
+        bindir = os.path.join(workdir, 'bin')
+        os.makedirs(bindir, exist_ok=True)
+        link = os.path.join(bindir, 'wrangler')
+        if not os.path.lexists(link):
+            os.symlink(FAKE_WRANGLER, link)
+        env['PATH'] = bindir + os.pathsep + env.get('PATH', '')
+        env['FAKE_WRANGLER_DB'] = os.path.join(rundir, 'wrangler.db')
+        env['FAKE_WRANGLER_STARTUP'] = str(wrangler_startup)
+        command += ['--wrangler-namespace', namespace]
+    if mode == 'only-json':
+        command += ['--outdir', os.path.join(rundir, 'out_json')]
+
+    with server.store.lock:
+        requests_before = sum(server.store.requests.values())
+    with open(os.path.join(rundir, 'upload.log'), 'w', encoding='utf-8') as log:
+        started = time.monotonic()
+        proc = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT, cwd=rundir)
+        peak_rss = _wait_rusage(proc)
+        elapsed = time.monotonic() - started
+    with server.store.lock:
+        server_requests = sum(server.store.requests.values()) - requests_before
+        stored = len(server.store.namespaces.get(namespace, {}))
+    if mode == 'wrangler':
+        stored = _fake_wrangler_keys(env['FAKE_WRANGLER_DB'], namespace)
+    elif mode == 'only-json':
+        stored = None
+
+    result = {'mode': mode, 'args': MODES[mode] + extra, 'exit': proc.returncode, 'wall_s': round(elapsed, 3),
+              'peak_rss_bytes': peak_rss, 'server_requests': server_requests, 'stored_keys': stored}
+    try:
+        with open(metrics_path, 'r', encoding='utf-8') as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        report = None
+    if report is not None:
+        rows = report['rows']
+        attempts = retries = throttled = errors = 0
+        for stats in report['requests'].values():
+            attempts += stats['attempts']
+            retries += stats['retries']
+            for status, n in stats['status'].items():
+                if status == '429':
+                    throttled += n
+                elif status == 'error' or status.startswith('5') or (status.startswith('exit') and status != 'exit 0') \
+                        or status in ('timeout', 'not found'):
+                    errors += n
+        result.update({'rows': rows['success'] + rows['skipped'] + rows['failed'], 'success': rows['success'],
+                       'failed': rows['failed'], 'rows_per_s': round((rows['success'] + rows['skipped']) / elapsed, 1),
+                       'attempts': attempts, 'retries': retries, 'throttled': throttled, 'errors': errors,
+                       'stages': report['stages'], 'requests': report['requests']})
+    return result
+
+
+def _cell(value, fmt: str = '{:,}') -> str:
+    return '-' if value is None else fmt.format(value)
+
+
+def print_table(results: List[Dict]):
+    columns = ('mode', 'wall s', 'rows/s', 'ok rows', 'failed', 'attempts', 'retries', '429', 'errors',
+               'server reqs', 'peak RSS MB', 'stored')
+    lines = [columns]
+    for r in results:
+        lines.append((r['mode'] + ('' if r['exit'] == 0 else f' (exit {r["exit"]})'),
+                      f'{r["wall_s"]:.2f}', _cell(r.get('rows_per_s'), '{:,.0f}'), _cell(r.get('success')),
+                      _cell(r.get('failed')), _cell(r.get('attempts')), _cell(r.get('retries')),
+                      _cell(r.get('throttled')), _cell(r.get('errors')), _cell(r['server_requests']),
+                      f'{r["peak_rss_bytes"] / 2 ** 20:.0f}', _cell(r['stored_keys'])))
+    widths = [max(len(line[i]) for line in lines) for i in range(len(columns))]
+    for line in lines:
+        print('  '.join(cell.ljust(w) if i == 0 else cell.rjust(w) for i, (cell, w) in enumerate(zip(line, widths))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--indir', help='census files to upload (default: a synthetic dataset)')
+    parser.add_argument('--rows', type=int, default=5000, help='rows of the synthetic dataset')
+    parser.add_argument('--files', type=int, default=4, help='files of the synthetic dataset')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic dataset and of --error-rate')
+    parser.add_argument('--modes', default=','.join(MODES), help=f'comma separated, from: {", ".join(MODES)}')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds the server adds to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests the server answers 500 / 503')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='server: 429 above this many requests per second')
+    parser.add_argument('--concurrency-limit', type=int, default=0, help='server: 429 above this many requests in progress')
+    parser.add_argument('--wrangler-startup', type=float, default=0.3, help='seconds each fake wrangler call takes to start')
+    parser.add_argument('--upload-args', default='', help='extra upload_kv.py arguments for every mode (one shell-quoted string)')
+    parser.add_argument('--workdir', help='keep datasets, logs and metrics here (default: a temporary directory)')
+    parser.add_argument('--json', help='write the results as JSON')
+    args = parser.parse_args()
+
+    modes = [m.strip() for m in args.modes.split(',') if m.strip()]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        parser.error(f'unknown modes: {", ".join(unknown)}')
+    if not 0 <= args.error_rate <= 1:
+        parser.error('--error-rate must be between 0 and 1')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_upload_kv_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        indir = args.indir
+        if not indir:
+            indir = os.path.join(workdir, 'data')
+            shutil.rmtree(indir, ignore_errors=True)
+            written = generate_dataset(indir, args.rows, args.files, args.seed)
+            print(f'Synthetic dataset: {written} rows in {args.files} files, '
+                  f'{sum(os.path.getsize(os.path.join(indir, n)) for n in os.listdir(indir)):,} bytes')
+        server = serve(latency=args.latency, rate_limit=args.rate_limit, concurrency_limit=args.concurrency_limit,
+                       error_rate=args.error_rate, seed=args.seed)
+        print(f'KV stand-in at {server.base_url} (latency {args.latency}s, error rate {args.error_rate}, '
+              f'rate limit {args.rate_limit or "-"}, concurrency limit {args.concurrency_limit or "-"})')
+        extra = shlex.split(args.upload_args)
+        results = []
+        try:
+            for mode in modes:
+                print(f'... {mode}', flush=True)
+                result = run_mode(mode, indir, workdir, server, extra, args.wrangler_startup)
+                if result['exit'] != 0:
+                    print(f'    upload_kv.py exited with {result["exit"]}; see {os.path.join(workdir, mode, "upload.log")}')
+                results.append(result)
+        finally:
+            server.shutdown()
+            server.server_close()
+        print_table(results)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump({'indir': indir, 'latency': args.latency, 'error_rate': args.error_rate,
+                           'rate_limit': args.rate_limit, 'concurrency_limit': args.concurrency_limit,
+                           'results': results}, f, ensure_ascii=False, indent=1)
+                f.write('\n')
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Columnar binary store for `census_mesh_2020`, queried through mmap.
+
+  python census_columnar.py build --indir census_mesh_2020_data --out census_mesh_2020.col
+  python census_columnar.py get 533946011 --store census_mesh_2020.col
+  python census_columnar.py search --prefix 5339 --min-population 100 --limit 10
+  python census_columnar.py summary 5339
+
+Store layout (one directory, all integers little-endian):
+  meta.json        format version, row count, key width, column names
+  keys.bin         key_code, sorted, fixed width ASCII padded with NUL
+  ints.bin         int32 column arrays, one after another (htk_syori,
+                   t001101001 .. t001101050), NULL stored as 0
+  nulls.bin        one bitmap per int column (bit set = NULL, which in this
+                   data is the '*' secrecy marker or a blank cell)
+  <col>.off/.dat   htk_saki / gassan as uint32 offsets into a UTF-8 blob;
+                   NULL is an empty string (the CSVs never hold '' there)
+
+Queries answer the same questions as src/routes/census_mesh.ts without
+parsing any text: get by key (bisect over keys.bin), prefix search with
+population/household ranges, and prefix summary. A prefix is a contiguous
+range of the sorted keys, so sums are taken straight from column slices.
+
+Rows come from the same conversion as the SQL generator; a key_code seen
+in more than one file keeps its first row, like the DO NOTHING output.
+Search results are in key order (the API query has no ORDER BY).
+"""
+
+import argparse
+import json
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Optional
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from census_schema import TARGET_COLS, TEXT_COLS  # noqa: E402
+from genarate_census_mesh_2020 import convert_files, input_files  # noqa: E402
+
+FORMAT_VERSION = 1
+INT_COLS = [col for col in TARGET_COLS if col not in TEXT_COLS]
+STR_COLS = [col for col in TEXT_COLS if col != 'key_code']
+INT32_MIN = -2 ** 31
+INT32_MAX = 2 ** 31 - 1
+
+# API field name -> column, as in src/db/schema.ts (censusMesh2020)
+API_FIELDS = {'keyCode': 'key_code', 'htkSyori': 'htk_syori', 'htkSaki': 'htk_saki', 'gassan': 'gassan'}
+API_FIELDS.update({col: col for col in TARGET_COLS if col.startswith('t')})
+
+POPULATION_COL = 't001101001'
+HOUSEHOLDS_COL = 't001101034'
+# summary field -> column, as in GET /census-mesh/summary/:keyCodePrefix
+SUMMARY_COLS = {
+    'totalPopulation': 't001101001',
+    'totalHouseholds': 't001101034',
+    'totalMale': 't001101002',
+    'totalFemale': 't001101003',
+    'totalAge0to14': 't001101004',
+    'totalAge15to64': 't001101010',
+    'totalAge65Plus': 't001101019',
+    'totalAge75Plus': 't001101022',
+    'totalForeigners': 't001101031',
+}
+
+SEARCH_DEFAULT_LIMIT = 100
+SEARCH_MAX_LIMIT = 1000
+
+
+# --- build ---
+
+def collect_rows(source_files: List[str], workers: int = 1) -> Dict[str, tuple]:
+    """key_code -> typed row (TARGET_COLS order); the first row for a key wins."""
+    rows = {}
+    for converted in convert_files(source_files, workers, typed=True):
+        for chunk in converted:
+            for row in chunk:
+                rows.setdefault(row[0], row)
+        if converted.error:
+            print(f'Error processing {converted.path}: {converted.error}', file=sys.stderr)
+    return rows
+
+
+def write_store(rows: Dict[str, tuple], out_dir: str) -> int:
+    os.makedirs(out_dir, exist_ok=True)
+    keys = sorted(rows)
+    count = len(keys)
+    key_width = max((len(k.encode('ascii')) for k in keys), default=0)
+    bitmap_bytes = (count + 7) // 8
+
+    with open(os.path.join(out_dir, 'keys.bin'), 'wb') as f:
+        f.write(b''.join(k.encode('ascii').ljust(key_width, b'\0') for k in keys))
+
+    # transpose once: one tuple per column, in key order
+    columns = dict(zip(TARGET_COLS, zip(*(rows[k] for k in keys)))) if count else {}
+    with open(os.path.join(out_dir, 'ints.bin'), 'wb') as f_ints, \
+            open(os.path.join(out_dir, 'nulls.bin'), 'wb') as f_nulls:
+        for col in INT_COLS:
+            column = columns.get(col, ())
+            nulls = bytearray(bitmap_bytes)
+            for i, value in enumerate(column):
+                if value is None:
+                    nulls[i >> 3] |= 1 << (i & 7)
+            present = [v for v in column if v is not None]
+            if present and (min(present) < INT32_MIN or max(present) > INT32_MAX):
+                raise ValueError(f'{col} has values outside int32: {min(present)}..{max(present)}')
+            values = array('i', [0 if v is None else v for v in column])
+            if sys.byteorder != 'little':
+                values.byteswap()
+            values.tofile(f_ints)
+            f_nulls.write(nulls)
+
+    for col in STR_COLS:
+        offsets = array('I', [0])
+        blob = bytearray()
+        for value in columns.get(col, ()):
+            if value is not None:
+                blob += value.encode('utf-8')
+            offsets.append(len(blob))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        with open(os.path.join(out_dir, f'{col}.off'), 'wb') as f:
+            offsets.tofile(f)
+        with open(os.path.join(out_dir, f'{col}.dat'), 'wb') as f:
+            f.write(blob)
+
+    meta = {
+        'format': 'census_mesh_2020-columnar',
+        'version': FORMAT_VERSION,
+        'rows': count,
+        'key_width': key_width,
+        'int_columns': INT_COLS,
+        'text_columns': STR_COLS,
+    }
+    with open(os.path.join(out_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+        f.write('\n')
+    return count
+
+
+# --- query ---
+
+class _SortedKeys:
+    """Sequence view of keys.bin for bisect."""
+
+    def __init__(self, buf, width: int, count: int):
+        self.buf = buf
+        self.width = width
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = i * self.width
+        return self.buf[start:start + self.width]
+
+
+class ColumnarStore:
+    """Read-only, memory-mapped view of a store written by `build`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != FORMAT_VERSION:
+            raise ValueError(f'{path}: unsupported store version {meta.get("version")}')
+        if meta['int_columns'] != INT_COLS or meta['text_columns'] != STR_COLS:
+            raise ValueError(f'{path}: column layout does not match census_schema.TARGET_COLS')
+        if sys.byteorder != 'little':
+            raise RuntimeError('columnar store is little-endian; big-endian hosts are not supported')
+        self.count = meta['rows']
+        self.key_width = meta['key_width']
+        self._files = []
+        self._maps = []
+
+        self._keys_buf = self._map('keys.bin')
+        self.keys = _SortedKeys(self._keys_buf, self.key_width, self.count)
+        ints = self._map('ints.bin')
+        ints_view = memoryview(ints).cast('i') if self.count else memoryview(array('i'))
+        self._ints = {col: ints_view[n * self.count:(n + 1) * self.count] for n, col in enumerate(INT_COLS)}
+        nulls = memoryview(self._map('nulls.bin'))
+        bitmap_bytes = (self.count + 7) // 8
+        self._nulls = {col: nulls[n * bitmap_bytes:(n + 1) * bitmap_bytes] for n, col in enumerate(INT_COLS)}
+        self._text = {}
+        for col in STR_COLS:
+            off = self._map(f'{col}.off')
+            self._text[col] = (memoryview(off).cast('I'), self._map(f'{col}.dat'))
+
+    def _map(self, name: str):
+        f = open(os.path.join(self.path, name), 'rb')
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            # mmap cannot map an empty file (empty store / all-NULL text column)
+            return b''
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(m)
+        return m
+
+    def close(self):
+        # drop the memoryviews before closing the maps they point into
+        self._ints = self._nulls = self._text = self.keys = None
+        for m in self._maps:
+            try:
+                m.close()
+            except BufferError:
+                pass
+        for f in self._files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # -- cell access --
+
+    def _encode_key(self, key: str) -> bytes:
+        return key.encode('ascii', 'replace')
+
+    def find(self, key_code: str) -> Optional[int]:
+        """Row index of key_code, or None."""
+        raw = self._encode_key(key_code)
+        if len(raw) > self.key_width:
+            return None
+        padded = raw.ljust(self.key_width, b'\0')
+        i = bisect_left(self.keys, padded)
+        if i < self.count and self.keys[i] == padded:
+            return i
+        return None
+
+    def prefix_range(self, prefix: str):
+        """[lo, hi) row range of keys starting with prefix."""
+        raw = self._encode_key(prefix)
+        if not raw:
+            return 0, self.count
+        if len(raw) > self.key_width:
+            return 0, 0
+        lo = bisect_left(self.keys, raw.ljust(self.key_width, b'\0'))
+        hi = bisect_left(self.keys, raw.ljust(self.key_width, b'\xff'), lo)
+        return lo, hi
+
+    def key_at(self, i: int) -> str:
+        return bytes(self.keys[i]).rstrip(b'\0').decode('ascii')
+
+    def is_null(self, col: str, i: int) -> bool:
+        return bool(self._nulls[col][i >> 3] & (1 << (i & 7)))
+
+    def int_value(self, col: str, i: int) -> Optional[int]:
+        if self.is_null(col, i):
+            return None
+        return self._ints[col][i]
+
+    def text_value(self, col: str, i: int) -> Optional[str]:
+        offsets, blob = self._text[col]
+        start, end = offsets[i], offsets[i + 1]
+        if start == end:
+            return None
+        return blob[start:end].decode('utf-8')
+
+    def row(self, i: int) -> dict:
+        """Row i keyed by API field names (same shape as GET /census-mesh/:keyCode)."""
+        out = {}
+        for field, col in API_FIELDS.items():
+            if col == 'key_code':
+                out[field] = self.key_at(i)
+            elif col in self._text:
+                out[field] = self.text_value(col, i)
+            else:
+                out[field] = self.int_value(col, i)
+        return out
+
+    # -- the API's questions --
+
+    def get(self, key_code: str) -> Optional[dict]:
+        i = self.find(key_code)
+        return None if i is None else self.row(i)
+
+    def search(self, key_code_prefix: Optional[str] = None,
+               min_population: Optional[int] = None, max_population: Optional[int] = None,
+               min_households: Optional[int] = None, max_households: Optional[int] = None,
+               limit: int = SEARCH_DEFAULT_LIMIT, offset: int = 0) -> dict:
+        """GET /census-mesh: prefix + range filters, limit/offset paging.
+
+        As in SQL, a range filter never matches a NULL cell.
+        """
+        limit = min(limit, SEARCH_MAX_LIMIT)
+        lo, hi = self.prefix_range(key_code_prefix) if key_code_prefix else (0, self.count)
+        filters = []
+        for col, low, high in ((POPULATION_COL, min_population, max_population),
+                               (HOUSEHOLDS_COL, min_households, max_households)):
+            if low is not None or high is not None:
+                filters.append((self._ints[col], self._nulls[col], low, high))
+
+        data = []
+        skipped = 0
+        if limit > 0:
+            for i in range(lo, hi):
+                matched = True
+                for values, nulls, low, high in filters:
+                    if nulls[i >> 3] & (1 << (i & 7)):
+                        matched = False
+                        break
+                    v = values[i]
+                    if (low is not None and v < low) or (high is not None and v > high):
+                        matched = False
+                        break
+                if not matched:
+                    continue
+                if skipped < offset:
+                    skipped += 1
+                    continue
+                data.append(self.row(i))
+                if len(data) >= limit:
+                    break
+        return {'data': data, 'meta': {'limit': limit, 'offset': offset, 'count': len(data)}}
+
+    def summary(self, key_code_prefix: str) -> Optional[dict]:
+        """GET /census-mesh/summary/:keyCodePrefix, or None when no mesh matches (404).
+
+        NULL cells are stored as 0, so a slice sum is SUM(COALESCE(col, 0)).
+        """
+        lo, hi = self.prefix_range(key_code_prefix)
+        if hi <= lo:
+            return None
+        result = {field: sum(self._ints[col][lo:hi]) for field, col in SUMMARY_COLS.items()}
+        result['meshCount'] = hi - lo
+        return {'keyCodePrefix': key_code_prefix, 'summary': result}
+
+
+def open_store(path: str) -> ColumnarStore:
+    return ColumnarStore(path)
+
+
+# --- CLI ---
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    default_store = os.path.join(script_dir, 'census_mesh_2020.col')
+    parser = argparse.ArgumentParser(description='Columnar census_mesh_2020 store: build and query')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_build = sub.add_parser('build', help='Convert the census CSV files into a columnar store')
+    p_build.add_argument('--indir', default=os.path.join(script_dir, 'census_mesh_2020_data'), help='Input directory containing CSV files')
+    p_build.add_argument('--out', default=default_store, help='Output store directory')
+    p_build.add_argument('--workers', type=int, default=1, help='Convert input files in N worker processes')
+
+    p_get = sub.add_parser('get', help='Row for one key_code (GET /census-mesh/:keyCode)')
+    p_get.add_argument('key_code')
+
+    p_search = sub.add_parser('search', help='Filtered rows (GET /census-mesh)')
+    p_search.add_argument('--prefix', help='key_code prefix')
+    p_search.add_argument('--min-population', type=int)
+    p_search.add_argument('--max-population', type=int)
+    p_search.add_argument('--min-households', type=int)
+    p_search.add_argument('--max-households', type=int)
+    p_search.add_argument('--limit', type=int, default=SEARCH_DEFAULT_LIMIT)
+    p_search.add_argument('--offset', type=int, default=0)
+
+    p_summary = sub.add_parser('summary', help='Totals for a key_code prefix (GET /census-mesh/summary/:keyCodePrefix)')
+    p_summary.add_argument('key_code_prefix')
+
+    for p in (p_get, p_search, p_summary):
+        p.add_argument('--store', default=default_store, help='Store directory written by build')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        source_files = input_files(args.indir)
+        if not source_files:
+            print(f'No input files found in {args.indir}', file=sys.stderr)
+            sys.exit(1)
+        rows = collect_rows(source_files, args.workers)
+        count = write_store(rows, args.out)
+        print(f'Wrote {count} rows ({len(INT_COLS)} int columns) to {args.out}')
+        return
+
+    with open_store(args.store) as store:
+        if args.command == 'get':
+            result = store.get(args.key_code)
+        elif args.command == 'search':
+            result = store.search(args.prefix, args.min_population, args.max_population,
+                                  args.min_households, args.max_households, args.limit, args.offset)
+        else:
+            result = store.summary(args.key_code_prefix)
+        if result is None:
+            print('Not found', file=sys.stderr)
+            sys.exit(1)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
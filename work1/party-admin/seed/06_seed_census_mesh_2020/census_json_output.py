@@ -0,0 +1,224 @@
+"""
+Output of upload_kv.py --only-json: mesh JSON objects packed into a few large files.
+
+One `{key_code}.json` per mesh is hundreds of thousands of tiny files, and
+the run is all file system metadata. --json-layout packs them instead, per
+input file into parts of at most --json-part-bytes:
+
+  ndjson  census_mesh_2020_{stem}_0001.ndjson   one mesh object per line (default)
+  tar     census_mesh_2020_{stem}_0001.tar      members {key_code}.json, then index.json
+  zip     census_mesh_2020_{stem}_0001.zip      members {key_code}.json, deflated
+  files   {key_code}.json                       one file per mesh, as before
+
+Parts are written through a WRITE_BUFFER_BYTES buffer, and a part is
+rotated before a mesh would take it over the budget (a mesh larger than the
+budget gets a part of its own). Members carry a fixed timestamp, so the
+same input gives byte-identical parts that diff and copy cleanly.
+
+index.json in the output directory lists every part with its input file,
+mesh count, size and first / last key_code. A tar part ends with an
+index.json member mapping key_code -> [byte offset, size] of the member
+data, and the part's entry in the output index gives that member's
+offset, so one mesh is a seek and a read; zip has its central directory.
+
+Parts are named after their input, so rewriting one input replaces only
+its own parts: the parts the index lists for it are removed first, as are
+the parts of inputs that are gone (prune()).
+"""
+
+import io
+import json
+import os
+import re
+import tarfile
+import zipfile
+from typing import Dict, Iterable, List, Optional
+
+JSON_LAYOUTS = ('ndjson', 'tar', 'zip', 'files')
+DEFAULT_PART_BYTES = 64 * 1024 * 1024
+WRITE_BUFFER_BYTES = 1024 * 1024
+INDEX_NAME = 'index.json'
+INDEX_VERSION = 1
+PART_PREFIX = 'census_mesh_2020_'
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+def member_name(key_code: str) -> str:
+    return re.sub(r'[^0-9A-Za-z._-]', '_', str(key_code)) + '.json'
+
+
+def _blocks(size: int) -> int:
+    """size rounded up to whole tar blocks."""
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+class _Part:
+    """One open part file of any packed layout."""
+
+    def __init__(self, path: str, layout: str):
+        self.path = path
+        self.layout = layout
+        self.rows = 0
+        self.first_key: Optional[str] = None
+        self.last_key: Optional[str] = None
+        self.members: Dict[str, List[int]] = {}  # tar: key_code -> [data offset, size]
+        self._index_bytes = 2  # tar: upper bound of the index member, '{}' plus one '"key":[offset,size],' per mesh
+        self._central_bytes = 0  # zip: central directory written on close
+        self.fh = open(path, 'wb', buffering=WRITE_BUFFER_BYTES)
+        self.tar = tarfile.open(fileobj=self.fh, mode='w', format=tarfile.USTAR_FORMAT) if layout == 'tar' else None
+        self.zip = zipfile.ZipFile(self.fh, 'w', zipfile.ZIP_DEFLATED) if layout == 'zip' else None
+
+    def projected(self, key_code: str, data: bytes) -> int:
+        """Size of the part closed right after adding this mesh (an upper bound for zip, which compresses)."""
+        if self.layout == 'ndjson':
+            return self.fh.tell() + len(data) + 1
+        if self.layout == 'zip':
+            return self.fh.tell() + len(data) + 30 + 46 + 2 * len(member_name(key_code)) + self._central_bytes + 22
+        # the data and index members, two zero blocks, padded to a whole record
+        index_bytes = self._index_bytes + len(key_code) + 32
+        end = self.tar.offset + 2 * tarfile.BLOCKSIZE + _blocks(len(data)) + _blocks(index_bytes) + 2 * tarfile.BLOCKSIZE
+        return -(-end // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+    def _add_tar(self, name: str, data: bytes) -> int:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = 0o644
+        self.tar.addfile(info, io.BytesIO(data))
+        return self.tar.offset - _blocks(len(data))
+
+    def add(self, key_code: str, data: bytes):
+        if self.layout == 'ndjson':
+            self.fh.write(data + b'\n')
+        elif self.layout == 'tar':
+            self.members[key_code] = [self._add_tar(member_name(key_code), data), len(data)]
+            self._index_bytes += len(key_code) + 32
+        else:
+            self.zip.writestr(zipfile.ZipInfo(member_name(key_code), date_time=ZIP_EPOCH), data,
+                              compress_type=zipfile.ZIP_DEFLATED)
+            self._central_bytes += 46 + len(member_name(key_code))
+        self.rows += 1
+        self.first_key = self.first_key or key_code
+        self.last_key = key_code
+
+    def close(self, source: str) -> dict:
+        entry = {'source': source, 'layout': self.layout, 'rows': self.rows,
+                 'first_key': self.first_key, 'last_key': self.last_key}
+        if self.tar is not None:
+            index = json.dumps(self.members, separators=(',', ':')).encode('utf-8')
+            entry['index_offset'] = self._add_tar(INDEX_NAME, index)
+            entry['index_bytes'] = len(index)
+            self.tar.close()
+        if self.zip is not None:
+            self.zip.close()
+        self.fh.close()
+        entry['bytes'] = os.path.getsize(self.path)
+        return entry
+
+
+class JsonOutput:
+    """Mesh objects of a run into --outdir in one layout.
+
+    begin(input_path) / write(key_code, obj) ... / end() per input file;
+    end() returns the paths written for that input (for the manifest).
+    """
+
+    def __init__(self, outdir: str, layout: str = 'ndjson', max_part_bytes: int = DEFAULT_PART_BYTES):
+        if layout not in JSON_LAYOUTS:
+            raise ValueError(f'unknown JSON layout {layout!r}')
+        self.outdir = outdir
+        self.layout = layout
+        self.max_part_bytes = max_part_bytes or None
+        self.index_path = os.path.join(outdir, INDEX_NAME)
+        self.outputs: Dict[str, dict] = {}
+        self.parts_written = 0
+        self.bytes_written = 0
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                self.outputs = data.get('outputs') or {}
+        except (OSError, ValueError):
+            pass
+        self._source: Optional[str] = None
+        self._stem = ''
+        self._part: Optional[_Part] = None
+        self._paths: List[str] = []
+
+    def _remove(self, names: Iterable[str]):
+        for name in list(names):
+            try:
+                os.remove(os.path.join(self.outdir, name))
+            except FileNotFoundError:
+                pass
+            self.outputs.pop(name, None)
+
+    def begin(self, input_path: str):
+        """Start the output of one input file; parts it left in an earlier run are removed."""
+        self._source = os.path.basename(input_path)
+        self._stem = os.path.splitext(self._source)[0]
+        self._paths = []
+        self._remove(name for name, entry in self.outputs.items() if entry.get('source') == self._source)
+
+    def _close_part(self):
+        if self._part is None:
+            return
+        entry = self._part.close(self._source)
+        self.outputs[os.path.basename(self._part.path)] = entry
+        self.parts_written += 1
+        self.bytes_written += entry['bytes']
+        self._part = None
+
+    def write(self, key_code: str, obj: dict):
+        data = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        if self.layout == 'files':
+            with open(os.path.join(self.outdir, member_name(key_code)), 'wb') as f:
+                f.write(data)
+            return
+        if self._part is not None and self._part.rows and self.max_part_bytes is not None and \
+                self._part.projected(key_code, data) > self.max_part_bytes:
+            self._close_part()
+        if self._part is None:
+            path = os.path.join(self.outdir, f'{PART_PREFIX}{self._stem}_{len(self._paths) + 1:04d}.{self.layout}')
+            self._part = _Part(path, self.layout)
+            self._paths.append(path)
+        self._part.add(str(key_code), data)
+
+    def end(self) -> List[str]:
+        """Finish the current input file; the paths of its parts."""
+        self._close_part()
+        if self.layout != 'files':
+            self._save_index()
+        return list(self._paths)
+
+    def prune(self, input_paths: Iterable[str]) -> int:
+        """Remove the parts of inputs no longer among input_paths; the number removed."""
+        current = {os.path.basename(p) for p in input_paths}
+        gone = [name for name, entry in self.outputs.items() if entry.get('source') not in current]
+        self._remove(gone)
+        if gone:
+            self._save_index()
+        return len(gone)
+
+    def _save_index(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'outputs': self.outputs}, f, ensure_ascii=False, indent=1, sort_keys=True)
+            f.write('\n')
+        os.replace(tmp, self.index_path)
+
+    def summary(self) -> str:
+        if self.layout == 'files':
+            return 'JSON output: one file per mesh'
+        return f'JSON output: {self.parts_written} {self.layout} parts, {self.bytes_written:,} bytes'
+
+
+def read_tar_mesh(path: str, entry: dict, key_code: str) -> Optional[dict]:
+    """One mesh from a tar part through its index member (entry: the part's record in index.json)."""
+    with open(path, 'rb') as f:
+        f.seek(entry['index_offset'])
+        members = json.loads(f.read(entry['index_bytes']))
+        if key_code not in members:
+            return None
+        offset, size = members[key_code]
+        f.seek(offset)
+        return json.loads(f.read(size))
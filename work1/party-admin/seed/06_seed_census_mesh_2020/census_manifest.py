@@ -0,0 +1,129 @@
+"""
+Per-input manifest for incremental census rebuilds.
+
+The manifest is a JSON file mapping each input file name to its size,
+mtime, SHA-256 and the outputs produced from it, together with the options
+that shape those outputs. On the next run an input is unchanged when its
+stat matches (no read at all) or, if only the stat differs, when its hash
+still matches; its outputs are then left alone.
+
+Used by genarate_census_mesh_2020.py (--manifest) and upload_kv.py
+(--manifest).
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List
+
+MANIFEST_VERSION = 1
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """Inputs already turned into outputs, keyed by file name.
+
+    `options` describes everything besides the input content that affects
+    the outputs (output mode, target, ...). Entries recorded with different
+    options never count as unchanged.
+    """
+
+    def __init__(self, path: str, options: dict):
+        self.path = path
+        self.options = json.loads(json.dumps(options))  # normalise (tuples -> lists) for comparison
+        self.entries: Dict[str, dict] = {}
+        self._hashes: Dict[str, tuple] = {}
+        self._dirty = False
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        if data.get('version') == MANIFEST_VERSION:
+            self.entries = data.get('inputs', {})
+
+    @staticmethod
+    def name(input_path: str) -> str:
+        return os.path.basename(input_path)
+
+    def _hash(self, input_path: str, st: os.stat_result) -> str:
+        # remember the hash together with the stat it was taken for, so record() can reuse it
+        cached = self._hashes.get(input_path)
+        if cached and cached[0] == (st.st_size, st.st_mtime_ns):
+            return cached[1]
+        digest = file_sha256(input_path)
+        self._hashes[input_path] = ((st.st_size, st.st_mtime_ns), digest)
+        return digest
+
+    def unchanged(self, input_path: str, check_outputs: bool = True) -> bool:
+        """True if input_path was recorded with the same content and options
+        (and, with check_outputs, all of its recorded outputs still exist)."""
+        entry = self.entries.get(self.name(input_path))
+        if not entry or entry.get('options') != self.options:
+            return False
+        if check_outputs and not all(os.path.exists(p) for p in entry.get('outputs', ())):
+            return False
+        st = os.stat(input_path)
+        if entry.get('size') == st.st_size and entry.get('mtime_ns') == st.st_mtime_ns:
+            return True
+        if entry.get('size') != st.st_size or self._hash(input_path, st) != entry.get('sha256'):
+            return False
+        # touched but identical: refresh the stat so the next run skips the hash
+        entry['mtime_ns'] = st.st_mtime_ns
+        self._dirty = True
+        return True
+
+    def outputs(self, input_path: str) -> List[str]:
+        entry = self.entries.get(self.name(input_path))
+        return list(entry.get('outputs', ())) if entry else []
+
+    def record(self, input_path: str, outputs: Iterable[str] = (), **extra):
+        st = os.stat(input_path)
+        entry = {
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'sha256': self._hash(input_path, st),
+            'options': self.options,
+            'outputs': list(outputs),
+        }
+        entry.update(extra)
+        self.entries[self.name(input_path)] = entry
+        self._dirty = True
+
+    def forget(self, input_path: str):
+        if self.entries.pop(self.name(input_path), None) is not None:
+            self._dirty = True
+
+    def missing_inputs(self, input_paths: Iterable[str]) -> List[str]:
+        """Recorded names that are no longer among input_paths."""
+        current = {self.name(p) for p in input_paths}
+        return sorted(name for name in self.entries if name not in current)
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'inputs': self.entries}, f, ensure_ascii=False, indent=1, sort_keys=True)
+            f.write('\n')
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+
+def remove_outputs(paths: Iterable[str]) -> int:
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
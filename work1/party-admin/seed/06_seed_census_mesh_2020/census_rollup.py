@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Precomputed key_code prefix rollups for `census_mesh_2020`.
+
+GET /census-mesh/summary/:keyCodePrefix sums nine columns over
+`key_code LIKE 'prefix%'`. This script computes the same totals once for
+every prefix of length 1..8 (4 = 1st level mesh, 6 = 2nd, 8 = 3rd; a full
+9 digit key_code is a single row of census_mesh_2020), so a summary is one
+primary key lookup.
+
+  python census_rollup.py --outdir SQL_rollup           SQL parts for D1
+  python census_rollup.py --sqlite out.db               local SQLite table
+  python census_rollup.py --kv-json rollup_kv.json      `wrangler kv bulk put` file
+
+Totals follow the API exactly: SUM(COALESCE(col, 0)) and COUNT(*) over the
+rows the D1 table holds (first row per key_code, like the generator's DO
+NOTHING output). Secrecy does not double count: an htk_syori=2 row has
+'*' (NULL) in the columns that were folded into its htk_saki mesh, so each
+person is counted once, in the mesh that publishes the number.
+
+The table is created by migrations/20260103000001_create_census_mesh_2020_rollup.sql.
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import Dict, Iterable, List, Sequence
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sqlite_seed  # noqa: E402
+from census_schema import TARGET_COLS, sql_literal  # noqa: E402
+from census_columnar import SUMMARY_COLS, collect_rows  # noqa: E402
+from genarate_census_mesh_2020 import input_files  # noqa: E402
+from sql_parts import D1_MAX_STATEMENT_BYTES, SqlPartWriter, size_report  # noqa: E402
+
+TABLE_NAME = 'census_mesh_2020_rollup'
+KV_KEY_PREFIX = 'census_mesh_2020_summary:'
+DEFAULT_LENGTHS = tuple(range(1, 9))
+MESH_LEVELS = {4: '1st', 6: '2nd', 8: '3rd'}
+
+# rollup column -> API summary field (the value order of every rollup vector)
+TOTAL_COLUMNS = {
+    'total_population': 'totalPopulation',
+    'total_households': 'totalHouseholds',
+    'total_male': 'totalMale',
+    'total_female': 'totalFemale',
+    'total_age0to14': 'totalAge0to14',
+    'total_age15to64': 'totalAge15to64',
+    'total_age65plus': 'totalAge65Plus',
+    'total_age75plus': 'totalAge75Plus',
+    'total_foreigners': 'totalForeigners',
+}
+COLUMNS = ['key_prefix', 'prefix_len', 'mesh_level'] + list(TOTAL_COLUMNS) + ['mesh_count']
+
+
+def rollup(rows: Dict[str, tuple], lengths: Iterable[int] = DEFAULT_LENGTHS) -> Dict[str, List[int]]:
+    """prefix -> [totals in TOTAL_COLUMNS order..., mesh_count] for every requested prefix length.
+
+    Each level is folded from the next longer one, so every row is added once.
+    """
+    lengths = sorted(set(lengths))
+    positions = [TARGET_COLS.index(SUMMARY_COLS[field]) for field in TOTAL_COLUMNS.values()]
+    width = len(positions) + 1
+
+    by_length: Dict[int, Dict[str, List[int]]] = {}
+    for key, row in rows.items():
+        level = by_length.setdefault(len(key), {})
+        level[key] = [row[p] or 0 for p in positions] + [1]
+
+    result = {}
+    longest = max(by_length, default=0)
+    carry: Dict[str, List[int]] = {}
+    for length in range(longest, 0, -1):
+        current = by_length.get(length, {})
+        for prefix, vec in carry.items():
+            acc = current.get(prefix)
+            if acc is None:
+                current[prefix] = list(vec)
+            else:
+                for i in range(width):
+                    acc[i] += vec[i]
+        if length in lengths:
+            result.update(current)
+        # fold into the next shorter prefix
+        carry = {}
+        for prefix, vec in current.items():
+            acc = carry.get(prefix[:-1])
+            if acc is None:
+                carry[prefix[:-1]] = list(vec)
+            else:
+                for i in range(width):
+                    acc[i] += vec[i]
+    return result
+
+
+def rollup_records(totals: Dict[str, List[int]]) -> List[tuple]:
+    """Rows in COLUMNS order, sorted by prefix."""
+    return [(prefix, len(prefix), MESH_LEVELS.get(len(prefix)), *totals[prefix]) for prefix in sorted(totals)]
+
+
+def summary_body(record: Sequence) -> dict:
+    """Record -> the JSON body GET /census-mesh/summary/:keyCodePrefix returns."""
+    summary = {field: value for field, value in zip(TOTAL_COLUMNS.values(), record[3:-1])}
+    summary['meshCount'] = record[-1]
+    return {'keyCodePrefix': record[0], 'summary': summary}
+
+
+def write_sql_parts(records: List[tuple], output_dir: str, max_part_bytes=None, chunk_size=None) -> list:
+    os.makedirs(output_dir, exist_ok=True)
+    assignments = ','.join(f'{col}=excluded.{col}' for col in COLUMNS if col != 'key_prefix')
+    writer = SqlPartWriter(
+        lambda n: os.path.join(output_dir, f'seed_census_mesh_2020_rollup_part_{str(n).zfill(4)}.sql'),
+        header_for=lambda n: '-- Generated by census_rollup.py\n\n',
+        max_part_rows=chunk_size, max_part_bytes=max_part_bytes,
+        max_statement_bytes=D1_MAX_STATEMENT_BYTES)
+    writer.set_statement(f'INSERT INTO {TABLE_NAME} ({",".join(COLUMNS)}) VALUES\n',
+                         f'\nON CONFLICT(key_prefix) DO UPDATE SET {assignments};\n')
+    with writer:
+        for record in records:
+            writer.add_row('(' + ','.join(sql_literal(v) for v in record) + ')')
+    return writer.parts
+
+
+def write_kv_json(records: List[tuple], path: str) -> int:
+    """`wrangler kv bulk put` input: [{"key": ..., "value": <summary JSON as a string>}, ...]."""
+    out_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(out_dir, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[\n')
+        for i, record in enumerate(records):
+            item = {'key': KV_KEY_PREFIX + record[0], 'value': json.dumps(summary_body(record), ensure_ascii=False)}
+            f.write(('' if i == 0 else ',\n') + json.dumps(item, ensure_ascii=False))
+        f.write('\n]\n')
+    return len(records)
+
+
+def parse_lengths(text: str) -> List[int]:
+    lengths = []
+    for part in text.split(','):
+        if '-' in part:
+            lo, hi = part.split('-', 1)
+            lengths.extend(range(int(lo), int(hi) + 1))
+        elif part.strip():
+            lengths.append(int(part))
+    return lengths
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Precompute key_code prefix rollups of census_mesh_2020')
+    parser.add_argument('--indir', default=os.path.join(script_dir, 'census_mesh_2020_data'), help='Input directory with CSV files')
+    parser.add_argument('--workers', type=int, default=1, help='Convert input files in N worker processes')
+    parser.add_argument('--lengths', default='1-8', help='Prefix lengths to precompute, e.g. "1-8" or "4,6,8"')
+    parser.add_argument('--outdir', help='Write SQL parts for D1 to this directory')
+    parser.add_argument('--chunk-size', type=int, help='Rows per SQL part (default: one part unless --max-part-bytes)')
+    parser.add_argument('--max-part-bytes', type=int, help='Pack each SQL part up to this many bytes')
+    parser.add_argument('--sqlite', help=f'Load the rollup into {TABLE_NAME} of this local SQLite file')
+    parser.add_argument('--kv-json', help='Write a `wrangler kv bulk put` JSON file (key census_mesh_2020_summary:<prefix>)')
+    args = parser.parse_args()
+
+    if not (args.outdir or args.sqlite or args.kv_json):
+        parser.error('nothing to write: give --outdir, --sqlite and/or --kv-json')
+
+    source_files = input_files(args.indir)
+    if not source_files:
+        print(f'No files found in {args.indir}', file=sys.stderr)
+        sys.exit(1)
+
+    rows = collect_rows(source_files, args.workers)
+    records = rollup_records(rollup(rows, parse_lengths(args.lengths)))
+    print(f'{len(rows)} meshes -> {len(records)} prefix rollups')
+
+    if args.outdir:
+        parts = write_sql_parts(records, args.outdir, args.max_part_bytes, args.chunk_size)
+        print(size_report(parts, args.max_part_bytes))
+    if args.sqlite:
+        conn = sqlite_seed.connect(args.sqlite, [TABLE_NAME])
+        try:
+            count = sqlite_seed.load_rows(conn, TABLE_NAME, COLUMNS, records, delete_first=True)
+            print(f'Loaded {count} rows into {args.sqlite} ({TABLE_NAME})')
+        finally:
+            conn.close()
+    if args.kv_json:
+        count = write_kv_json(records, args.kv_json)
+        print(f'Wrote {count} KV entries to {args.kv_json}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""
+Compiled column projection for census mesh CSV files.
+
+CompiledSchema is built once per file header. It resolves where each of the
+54 `census_mesh_2020` columns lives in the raw row (and the normalised JSON
+key of every header cell) up front, so converting a row is a single pass
+over pre-computed indexes with no per-row header matching.
+
+Used by genarate_census_mesh_2020.py (SQL literals) and upload_kv.py (JSON
+objects). bench_census_schema.py compares it with the previous per-row code.
+"""
+
+import re
+from operator import itemgetter
+from typing import List, Optional, Sequence
+
+TARGET_COLS = [
+    'key_code','htk_syori','htk_saki','gassan'
+]
+# add t001101001 .. t001101050
+for i in range(1,51):
+    TARGET_COLS.append(f"t001101{str(i).zfill(3)}")
+
+# columns stored as TEXT; everything else is INTEGER
+TEXT_COLS = ('key_code', 'htk_saki', 'gassan')
+
+NULL_MARKERS = ('', '*', '　')
+
+
+def normalize_header_cell(s: str) -> str:
+    if s is None:
+        return ''
+    s = s.strip()
+    # lower, replace non-alnum with underscore
+    return ''.join([c.lower() if c.isalnum() else '_' for c in s])
+
+
+def norm_json_header(h: str) -> str:
+    """Header -> JSON key, as upload_kv.py has always written them."""
+    h = h.strip()
+    return re.sub(r'[^0-9a-z]+', '_', h.lower())
+
+
+def build_index_map(header):
+    normed = [normalize_header_cell(h) for h in header]
+    mapping = {}
+    for col in TARGET_COLS:
+        found = None
+        for i,h in enumerate(normed):
+            if h == col:
+                found = i
+                break
+        if found is None:
+            # try matching ignoring underscores
+            for i,h in enumerate(normed):
+                if h.replace('_','') == col.replace('_',''):
+                    found = i
+                    break
+        if found is None:
+            # try matching simple variants
+            for i,h in enumerate(normed):
+                if h == col.upper():
+                    found = i
+                    break
+        mapping[col] = found
+    return mapping
+
+
+def parse_int(raw: Optional[str]) -> Optional[int]:
+    """Census cell -> int, or None for blank / '*' / non-numeric cells."""
+    if raw is None:
+        return None
+    v = raw.strip()
+    if v in NULL_MARKERS:
+        return None
+    if v.isdecimal():
+        return int(v)
+    try:
+        return int(v.replace(',', ''))
+    except ValueError:
+        return None
+
+
+def parse_text(raw: Optional[str]) -> Optional[str]:
+    if raw is None:
+        return None
+    v = raw.strip()
+    if v in NULL_MARKERS:
+        return None
+    return v
+
+
+def quote_sql(s: str) -> str:
+    return "'" + s.replace("'", "''") + "'"
+
+
+def sql_literal(value) -> str:
+    """Typed Python value (None / int / str) -> SQL literal."""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, int):
+        return str(value)
+    return quote_sql(value)
+
+
+def json_value(raw: Optional[str]):
+    """Cell -> JSON value: None, int for integer-looking cells, else the cleaned string."""
+    if raw is None:
+        return None
+    s = raw.strip().strip('　')
+    if s == '' or s == '*':
+        return None
+    s2 = s.replace(',', '') if ',' in s else s
+    digits = s2[1:] if s2[:1] == '-' else s2
+    # str.isdecimal matches the same characters as \d in the old regex
+    if digits.isdecimal():
+        return int(s2)
+    return s
+
+
+def json_text_value(raw: Optional[str]):
+    if raw is None:
+        return None
+    s = raw.strip().strip('　')
+    if s == '' or s == '*':
+        return None
+    return s
+
+
+def json_list_value(raw: Optional[str]):
+    s = json_text_value(raw)
+    if s is None:
+        return None
+    return [p for p in re.split(r'[;，、]', s) if p != '']
+
+
+class _CellCache(dict):
+    """raw cell -> converted value, filled on first use.
+
+    Census cells are overwhelmingly small repeated integers, so a dict hit
+    replaces strip/parse/format on almost every cell. Long cells (mesh codes
+    and the like are unique per row) are converted but not stored, and the
+    cache stops growing at CELL_CACHE_LIMIT entries.
+    """
+
+    def __init__(self, convert):
+        super().__init__()
+        self.convert = convert
+
+    def __missing__(self, raw):
+        value = self.convert(raw)
+        if raw is not None and len(raw) <= CELL_CACHE_MAX_LEN and len(self) < CELL_CACHE_LIMIT:
+            self[raw] = value
+        return value
+
+
+CELL_CACHE_LIMIT = 100_000
+CELL_CACHE_MAX_LEN = 8
+
+
+def sql_int_literal(raw: Optional[str]) -> str:
+    value = parse_int(raw)
+    return 'NULL' if value is None else str(value)
+
+
+def sql_text_literal(raw: Optional[str]) -> str:
+    value = parse_text(raw)
+    return 'NULL' if value is None else quote_sql(value)
+
+
+_int_cells = _CellCache(parse_int)
+_sql_int_cells = _CellCache(sql_int_literal)
+_json_cells = _CellCache(json_value)
+
+
+class CompiledSchema:
+    """Row projector compiled from one CSV header.
+
+    Rows shorter than the header fall back to positional lookup exactly like
+    the original generator loop; full-width rows take the itemgetter path.
+    """
+
+    def __init__(self, header: Sequence[str], to_array_htksaki: bool = False):
+        self.header = list(header)
+        self.width = len(self.header)
+        self.to_array_htksaki = to_array_htksaki
+        index_map = build_index_map(self.header)
+        self.index_map = index_map
+
+        key_index = index_map.get('key_code')
+        self.key_index = key_index if key_index is not None else 0
+
+        # --- typed projection onto TARGET_COLS ---
+        self._mapped = [index_map.get(col) for col in TARGET_COLS]
+        indexes = [idx if idx is not None else pos for pos, idx in enumerate(self._mapped)]
+        self.indexes = indexes
+        self.min_width = max(indexes) + 1
+        self._text_positions = [pos for pos, col in enumerate(TARGET_COLS) if col in TEXT_COLS]
+        self._get_cells = itemgetter(*indexes)
+
+        # --- JSON projection (keyed by normalised header, like upload_kv) ---
+        last_index = {}
+        for i, h in enumerate(self.header):
+            last_index[h] = i  # csv.DictReader keeps the last column for duplicate names
+        self.json_keys = [norm_json_header(h) for h in self.header]
+        json_indexes = [last_index[h] for h in self.header]
+        # columns that do not use the generic json_value conversion
+        self._json_special = []
+        for pos, (h, key) in enumerate(zip(self.header, self.json_keys)):
+            if h.strip().upper() == 'HTKSAKI' or key == 'htk_saki':
+                self._json_special.append((pos, json_list_value if to_array_htksaki else json_text_value))
+        self._get_json_cells = itemgetter(*json_indexes) if json_indexes else (lambda row: ())
+        self._json_single = len(json_indexes) == 1
+
+    def key(self, row: Sequence[str]) -> str:
+        """Raw, stripped key_code ('' when missing)."""
+        if self.key_index < len(row):
+            return row[self.key_index].strip()
+        return row[0].strip() if row else ''
+
+    def _cells(self, row: Sequence[str]):
+        if len(row) >= self.min_width:
+            return self._get_cells(row)
+        # short row: header index if present in this row, else the column's own position
+        cells = []
+        for pos, idx in enumerate(self._mapped):
+            if idx is not None and idx < len(row):
+                cells.append(row[idx])
+            elif pos < len(row):
+                cells.append(row[pos])
+            else:
+                cells.append(None)
+        return cells
+
+    def project(self, row: Sequence[str]) -> List:
+        """Row -> list of typed values in TARGET_COLS order (str / int / None)."""
+        cells = self._cells(row)
+        values = list(map(_int_cells.__getitem__, cells))
+        for pos in self._text_positions:
+            values[pos] = parse_text(cells[pos])
+        return values
+
+    def sql_literals(self, row: Sequence[str]) -> List[str]:
+        """Row -> SQL literals in TARGET_COLS order."""
+        cells = self._cells(row)
+        out = list(map(_sql_int_cells.__getitem__, cells))
+        for pos in self._text_positions:
+            out[pos] = sql_text_literal(cells[pos])
+        return out
+
+    def sql_values(self, row: Sequence[str]) -> str:
+        """Row -> comma separated SQL literals in TARGET_COLS order."""
+        return ','.join(self.sql_literals(row))
+
+    def json_object(self, row: Sequence[str]) -> dict:
+        """Row -> dict keyed by normalised header names (upload_kv's JSON value)."""
+        if len(row) < self.width:
+            row = list(row) + [''] * (self.width - len(row))
+        cells = self._get_json_cells(row)
+        if self._json_single:
+            cells = (cells,)
+        values = list(map(_json_cells.__getitem__, cells))
+        for pos, convert in self._json_special:
+            values[pos] = convert(cells[pos])
+        return dict(zip(self.json_keys, values))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Resolve census secrecy merges (htk_syori / htk_saki / gassan) in bulk.
+
+A mesh with htk_syori=2 has its detailed counts folded into the mesh named
+in htk_saki, which may itself be folded further (chains). Its own totals
+(t001101001..003 population, 034..035 households) stay published; every
+other column is '*'. The mesh at the end of the chain publishes the
+detailed counts for the whole group and lists direct sources in gassan.
+
+This pass indexes all key_codes once, turns htk_saki into a parent array
+of row indexes and resolves every chain with whole-array pointer jumping
+(log2(depth) passes instead of chasing references mesh by mesh). It emits:
+
+  census_mesh_2020_group_member  key_code -> group_key (chain root), role, depth
+  census_mesh_2020_group         per group: members and effective values
+                                 (open columns summed over members, secret
+                                 columns from the root, which already holds them)
+
+Only groups with merged meshes are written; any other mesh is its own
+group with its own values. Tables: migrations/20260103000002_create_census_mesh_2020_groups.sql.
+
+  python census_secrecy.py --outdir SQL_groups
+  python census_secrecy.py --sqlite out.db
+"""
+
+import argparse
+import os
+import sys
+from typing import Dict, List, NamedTuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sqlite_seed  # noqa: E402
+from census_schema import TARGET_COLS, sql_literal  # noqa: E402
+from census_columnar import collect_rows  # noqa: E402
+from genarate_census_mesh_2020 import input_files  # noqa: E402
+from sql_parts import D1_MAX_STATEMENT_BYTES, SqlPartWriter, size_report  # noqa: E402
+
+VALUE_COLS = [col for col in TARGET_COLS if col.startswith('t')]
+# published for every mesh, including htk_syori=2 ones
+OPEN_COLS = ['t001101001', 't001101002', 't001101003', 't001101034', 't001101035']
+SECRET_COLS = [col for col in VALUE_COLS if col not in OPEN_COLS]
+
+MEMBER_TABLE = 'census_mesh_2020_group_member'
+GROUP_TABLE = 'census_mesh_2020_group'
+MEMBER_COLUMNS = ['key_code', 'group_key', 'role', 'depth']
+GROUP_COLUMNS = ['group_key', 'member_count', 'members'] + VALUE_COLS
+
+
+class Resolution(NamedTuple):
+    keys: List[str]            # sorted key_codes; list positions are the row indexes below
+    root: List[int]            # row index of each mesh's group root
+    depth: List[int]           # htk_saki hops to the root
+    unresolved: List[int]      # htk_syori=2 rows whose chain is broken (missing target or cycle)
+    gassan_mismatches: List[int]  # roots whose gassan names a mesh outside their group
+
+
+def resolve(rows: Dict[str, tuple]) -> Resolution:
+    keys = sorted(rows)
+    index = {key: i for i, key in enumerate(keys)}
+    pos_syori = TARGET_COLS.index('htk_syori')
+    pos_saki = TARGET_COLS.index('htk_saki')
+    pos_gassan = TARGET_COLS.index('gassan')
+
+    parent = list(range(len(keys)))
+    unresolved = []
+    for i, key in enumerate(keys):
+        row = rows[key]
+        if row[pos_syori] == 2:
+            target = index.get(row[pos_saki] or '')
+            if target is None or target == i:
+                unresolved.append(i)
+            else:
+                parent[i] = target
+    original = parent[:]
+    depth = [0 if p == i else 1 for i, p in enumerate(parent)]
+
+    # pointer jumping: after pass k every mesh points 2**k hops further along its chain
+    for _ in range(max(1, len(keys)).bit_length() + 1):
+        jumped = [parent[p] for p in parent]
+        if jumped == parent:
+            break
+        depth = [d + depth[p] for d, p in zip(depth, parent)]
+        parent = jumped
+    # a chain ends at a mesh that is not merged anywhere. On a cycle the jumping
+    # either never settles (e.g. 3 meshes) or, when the cycle length is a power
+    # of two (A->B->A), settles on a cycle mesh pointing to itself that the
+    # original parent array shows is merged. Either way the meshes on or
+    # leading into the cycle stay their own group
+    cyclic = [i for i, p in enumerate(parent) if parent[p] != p or original[p] != p]
+    for i in cyclic:
+        parent[i] = i
+        depth[i] = 0
+    unresolved.extend(cyclic)
+
+    mismatches = []
+    for i, key in enumerate(keys):
+        gassan = rows[key][pos_gassan]
+        if gassan and parent[i] == i:
+            for member in gassan.split(';'):
+                j = index.get(member.strip())
+                if j is None or parent[j] != i:
+                    mismatches.append(i)
+                    break
+    return Resolution(keys, parent, depth, sorted(set(unresolved)), mismatches)
+
+
+def groups(resolution: Resolution) -> Dict[int, List[int]]:
+    """root row index -> member row indexes (root first, then by key), merged groups only."""
+    out: Dict[int, List[int]] = {}
+    for i, r in enumerate(resolution.root):
+        if r != i:
+            out.setdefault(r, [r]).append(i)
+    return out
+
+
+def group_records(rows: Dict[str, tuple], resolution: Resolution):
+    """(member records, group records) in MEMBER_COLUMNS / GROUP_COLUMNS order."""
+    keys = resolution.keys
+    open_pos = [TARGET_COLS.index(col) for col in OPEN_COLS]
+    value_pos = [TARGET_COLS.index(col) for col in VALUE_COLS]
+    members_out = []
+    groups_out = []
+    for r, members in sorted(groups(resolution).items()):
+        root_key = keys[r]
+        root_row = rows[root_key]
+        values = {pos: root_row[pos] for pos in value_pos}
+        for pos in open_pos:
+            values[pos] = sum(rows[keys[m]][pos] or 0 for m in members)
+        groups_out.append((root_key, len(members), ';'.join(keys[m] for m in members),
+                           *(values[pos] for pos in value_pos)))
+        for m in members:
+            members_out.append((keys[m], root_key, 'root' if m == r else 'merged', resolution.depth[m]))
+    members_out.sort()
+    return members_out, groups_out
+
+
+def write_sql_parts(output_dir: str, table: str, columns: List[str], records, max_part_bytes=None) -> list:
+    os.makedirs(output_dir, exist_ok=True)
+    pk = columns[0]
+    assignments = ','.join(f'{col}=excluded.{col}' for col in columns if col != pk)
+    writer = SqlPartWriter(
+        lambda n: os.path.join(output_dir, f'seed_{table}_part_{str(n).zfill(4)}.sql'),
+        header_for=lambda n: '-- Generated by census_secrecy.py\n\n',
+        max_part_bytes=max_part_bytes, max_statement_bytes=D1_MAX_STATEMENT_BYTES)
+    writer.set_statement(f'INSERT INTO {table} ({",".join(columns)}) VALUES\n',
+                         f'\nON CONFLICT({pk}) DO UPDATE SET {assignments};\n')
+    with writer:
+        for record in records:
+            writer.add_row('(' + ','.join(sql_literal(v) for v in record) + ')')
+    return writer.parts
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Resolve census secrecy merges into mesh groups with effective values')
+    parser.add_argument('--indir', default=os.path.join(script_dir, 'census_mesh_2020_data'), help='Input directory with CSV files')
+    parser.add_argument('--workers', type=int, default=1, help='Convert input files in N worker processes')
+    parser.add_argument('--outdir', help='Write SQL parts for D1 to this directory')
+    parser.add_argument('--max-part-bytes', type=int, help='Pack each SQL part up to this many bytes')
+    parser.add_argument('--sqlite', help='Load both tables into this local SQLite file')
+    args = parser.parse_args()
+
+    if not (args.outdir or args.sqlite):
+        parser.error('nothing to write: give --outdir and/or --sqlite')
+
+    source_files = input_files(args.indir)
+    if not source_files:
+        print(f'No files found in {args.indir}', file=sys.stderr)
+        sys.exit(1)
+
+    rows = collect_rows(source_files, args.workers)
+    resolution = resolve(rows)
+    members, group_rows = group_records(rows, resolution)
+    print(f'{len(rows)} meshes: {len(group_rows)} merged groups, {len(members)} member meshes, '
+          f'max chain depth {max(resolution.depth, default=0)}')
+    if resolution.unresolved:
+        sample = ', '.join(resolution.keys[i] for i in resolution.unresolved[:5])
+        print(f'WARNING: {len(resolution.unresolved)} htk_syori=2 meshes have a broken htk_saki chain '
+              f'and were kept as their own group (e.g. {sample})', file=sys.stderr)
+    if resolution.gassan_mismatches:
+        # htk_saki is where the counts were folded, so it decides the grouping
+        sample = ', '.join(resolution.keys[i] for i in resolution.gassan_mismatches[:5])
+        print(f'WARNING: gassan of {len(resolution.gassan_mismatches)} meshes names meshes outside the group '
+              f'their htk_saki chains form (e.g. {sample})', file=sys.stderr)
+
+    if args.outdir:
+        for table, columns, records in ((MEMBER_TABLE, MEMBER_COLUMNS, members), (GROUP_TABLE, GROUP_COLUMNS, group_rows)):
+            parts = write_sql_parts(args.outdir, table, columns, records, args.max_part_bytes)
+            print(f'{table}:')
+            print(size_report(parts, args.max_part_bytes))
+    if args.sqlite:
+        conn = sqlite_seed.connect(args.sqlite, [MEMBER_TABLE, GROUP_TABLE])
+        try:
+            for table, columns, records in ((MEMBER_TABLE, MEMBER_COLUMNS, members), (GROUP_TABLE, GROUP_COLUMNS, group_rows)):
+                count = sqlite_seed.load_rows(conn, table, columns, records, delete_first=True)
+                print(f'Loaded {count} rows into {args.sqlite} ({table})')
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,81 +4,343 @@ CSV -> INSERT generator for `census_mesh_2020`.
 Usage: python genarate_census_mesh_2020.py --indir <dir> --outfile <file>
 
 This processes all CSV files in the input directory and writes SQL
-inserts (one per row) into the output file. Empty or "*" values become NULL.
-Existing `key_code` are skipped by using INSERT ... SELECT ... WHERE NOT EXISTS.
+inserts into the output file. Empty or "*" values become NULL.
+
+Output modes (--insert-mode):
+  not-exists  one INSERT ... SELECT ... WHERE NOT EXISTS per row (default)
+  values      multi-row INSERT ... VALUES (...),(...) ON CONFLICT(key_code)
+              DO NOTHING / DO UPDATE, --rows-per-statement rows per statement
+Both modes are idempotent, so parts can be re-run against D1.
+
+Parts are split by --chunk-size rows, or packed up to --max-part-bytes per
+file; statements stay under --max-statement-bytes (D1's 100KB statement
+limit by default). A size distribution of the parts is printed at the end.
+
+--workers N converts input files in a process pool; part numbering and
+file contents are identical to a sequential run.
+
+--sqlite out.db loads the rows into a local SQLite file instead (schema from
+migrations/); --dump out.sql then exports them as multi-row INSERTs for D1.
+
+--manifest FILE makes reruns incremental: parts are written per input file
+(seed_census_mesh_2020_<input>_NNNN.sql) and only inputs whose content or
+output options changed are converted again; their old parts are replaced
+and parts of deleted inputs removed. With --sqlite only changed inputs are
+reloaded. Use --on-conflict update (values mode / --sqlite) so re-applied
+rows overwrite their earlier versions; rows dropped from an input are not
+deleted from D1.
 """
 
 import os
 import glob
-import csv
 import sys
 import argparse
-import io
-
-TARGET_COLS = [
-    'key_code','htk_syori','htk_saki','gassan'
-]
-# add t001101001 .. t001101050
-for i in range(1,51):
-    TARGET_COLS.append(f"t001101{str(i).zfill(3)}")
-
-
-def normalize_header_cell(s: str) -> str:
-    if s is None:
-        return ''
-    s = s.strip()
-    # lower, replace non-alnum with underscore
-    return ''.join([c.lower() if c.isalnum() else '_' for c in s])
-
-
-def quote_sql(s: str) -> str:
-    return "'" + s.replace("'", "''") + "'"
-
-
-def value_to_sql(col: str, raw: str) -> str:
-    if raw is None:
-        return 'NULL'
-    v = raw.strip()
-    if v == '' or v == '*' or v == '\u3000':  # include full-width space
-        return 'NULL'
-    if col in ('key_code','htk_saki','gassan'):
-        return quote_sql(v)
-    # numeric column
-    # remove commas and spaces
-    v2 = v.replace(',', '').strip()
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from seed_io import ENCODINGS, open_csv_stream  # noqa: E402
+import sqlite_seed  # noqa: E402
+from sql_parts import D1_MAX_STATEMENT_BYTES, SqlPartWriter, size_report  # noqa: E402
+from census_schema import TARGET_COLS, CompiledSchema  # noqa: E402
+from census_manifest import Manifest, remove_outputs  # noqa: E402
+
+# iso-2022-jp/latin1 are kept as last resorts for odd inputs; latin1 accepts
+# any bytes, so it is only picked when nothing else decodes the sample
+GENERATOR_ENCODINGS = ENCODINGS + ('iso-2022-jp', 'latin1')
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_ROWS_PER_STATEMENT = 100
+# rows handed from a converted input file to the writer at a time
+CONVERT_CHUNK_ROWS = 10000
+
+
+class ConvertedFile:
+    """Decode and format one CSV file, handing the rows over in chunks.
+
+    Iterating yields lists of up to CONVERT_CHUNK_ROWS rows: (key_sql,
+    values_sql) tuples, or with typed=True tuples of Python values in
+    TARGET_COLS order. skipped is True when no header was read (empty file,
+    or the file could not be opened). error is a message when processing
+    stopped early (e.g. the encoding breaks mid-file); rows converted up to
+    that point are still yielded. error and rows are final once the chunks
+    are exhausted.
+    """
+
+    def __init__(self, csv_path, typed=False, chunk_rows=None):
+        self.path = csv_path
+        self.typed = typed
+        self.chunk_rows = chunk_rows or CONVERT_CHUNK_ROWS
+        self.rows = 0
+        self.error = None
+        self.skipped = False
+        self._reader = None
+        self._schema = None
+        self._loaded = None
+        try:
+            self._reader = open_csv_stream(csv_path, encodings=GENERATOR_ENCODINGS)
+            if self._reader.header is None:
+                self.skipped = True
+                self._close()
+            else:
+                self._schema = CompiledSchema(self._reader.header)
+        except Exception as e:
+            self.skipped = True
+            self.error = str(e)
+            self._close()
+
+    def __iter__(self):
+        if self._loaded is not None:
+            yield from self._loaded
+            return
+        if self._reader is None:
+            return
+        try:
+            chunk = []
+            for row in self._convert():
+                chunk.append(row)
+                if len(chunk) >= self.chunk_rows:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        finally:
+            self._close()
+
+    def load(self):
+        """Convert the whole file now (the result of a --workers process); returns self."""
+        self._loaded = list(self)
+        return self
+
+    def _convert(self):
+        schema = self._schema
+        try:
+            for csv_row in self._reader:
+                if schema.key(csv_row) == '':
+                    continue
+                self.rows += 1
+                if self.typed:
+                    yield tuple(schema.project(csv_row))
+                    continue
+                literals = schema.sql_literals(csv_row)
+                yield literals[0], ','.join(literals)
+        except Exception as e:
+            self.error = str(e)
+
+    def _close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def __getstate__(self):
+        # only loaded results cross the process boundary
+        state = dict(self.__dict__)
+        state.update(_reader=None, _schema=None)
+        return state
+
+
+def convert_file(csv_path, typed=False):
+    """Convert one CSV file completely. Runs in worker processes with --workers."""
+    return ConvertedFile(csv_path, typed=typed).load()
+
+
+def convert_files(source_files, workers=1, typed=False):
+    """Yield a ConvertedFile for each file, in input order.
+
+    Sequentially the rows are read while the caller consumes the chunks.
+    With --workers each file is converted whole in a worker process; at most
+    `workers` files are in flight, and results are handed over in input
+    order so part numbering and file contents match a sequential run exactly.
+    """
+    if not (workers and workers > 1 and len(source_files) > 1):
+        for csv_path in source_files:
+            yield ConvertedFile(csv_path, typed=typed)
+        return
+    convert = partial(convert_file, typed=typed)
+    pending = deque()
+    remaining = iter(source_files)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        try:
+            for csv_path in islice(remaining, workers):
+                pending.append(executor.submit(convert, csv_path))
+            while pending:
+                converted = pending.popleft().result()
+                for csv_path in islice(remaining, 1):
+                    pending.append(executor.submit(convert, csv_path))
+                yield converted
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def input_files(input_dir):
+    """Every regular file in input_dir, sorted: the inputs of the generator and of the census_* tools."""
+    return sorted(path for path in glob.glob(os.path.join(input_dir, '*')) if os.path.isfile(path))
+
+
+def build_sqlite(args, input_dir, source_files):
+    """--sqlite: load rows into a local SQLite file (and optionally --dump SQL for D1)."""
+    manifest = None
+    if args.manifest:
+        manifest = Manifest(args.manifest, {'sqlite': os.path.abspath(args.sqlite), 'on_conflict': args.on_conflict})
+        if not os.path.exists(args.sqlite):
+            manifest.entries.clear()
+        pending = [path for path in source_files if not manifest.unchanged(path)]
+        print(f'{len(source_files) - len(pending)} of {len(source_files)} inputs unchanged since the last load')
+        for name in manifest.missing_inputs(source_files):
+            print(f'Input {name} was removed; its rows stay in {args.sqlite}', file=sys.stderr)
+            manifest.forget(name)
+        source_files = pending
+
+    conn = sqlite_seed.connect(args.sqlite, ['census_mesh_2020'])
+    # first row wins like the NOT EXISTS / DO NOTHING output; --on-conflict update keeps the last
+    conflict = 'replace' if args.on_conflict == 'update' else 'ignore'
+    total = 0
     try:
-        # allow integers only
-        ival = int(v2)
-        return str(ival)
-    except Exception:
-        return 'NULL'
-
-
-def build_index_map(header):
-    normed = [normalize_header_cell(h) for h in header]
-    mapping = {}
-    for col in TARGET_COLS:
-        # possible header names to match
-        candidates = [col, col.upper(), col.replace('_',''), col.replace('_','').upper(), col.replace('t','T')]
-        found = None
-        for i,h in enumerate(normed):
-            if h == col:
-                found = i
-                break
-        if found is None:
-            # try matching ignoring underscores
-            for i,h in enumerate(normed):
-                if h.replace('_','') == col.replace('_',''):
-                    found = i
-                    break
-        if found is None:
-            # try matching simple variants
-            for i,h in enumerate(normed):
-                if h == col.upper():
-                    found = i
-                    break
-        mapping[col] = found
-    return mapping
+        for converted in convert_files(source_files, args.workers, typed=True):
+            for chunk in converted:
+                total += sqlite_seed.load_rows(conn, 'census_mesh_2020', TARGET_COLS, chunk, conflict=conflict)
+            if converted.error:
+                print(f'Error processing {converted.path}: {converted.error}', file=sys.stderr)
+            elif manifest is not None:
+                manifest.record(converted.path, rows=converted.rows)
+                manifest.save()
+        in_table = conn.execute('SELECT COUNT(*) FROM census_mesh_2020').fetchone()[0]
+        print(f'Loaded {total} rows into {args.sqlite} ({in_table} rows in census_mesh_2020)')
+        if args.dump:
+            limits = part_limits(args, insert_mode='values')
+            if args.chunk_size is None and not args.max_part_bytes:
+                # one dump file unless it was asked to be split
+                limits.update(max_part_rows=None, max_part_bytes=None)
+            dump_root, dump_ext = os.path.splitext(args.dump)
+
+            def dump_path(part_index):
+                if limits['max_part_rows'] is None and limits['max_part_bytes'] is None:
+                    return args.dump
+                return f'{dump_root}_{str(part_index).zfill(4)}{dump_ext or ".sql"}'
+
+            os.makedirs(os.path.dirname(os.path.abspath(args.dump)), exist_ok=True)
+            writer = SqlPartWriter(dump_path, header_for=lambda n: part_header(input_dir), **limits)
+            with writer:
+                dumped = sqlite_seed.export_sql_parts(conn, 'census_mesh_2020', writer, columns=TARGET_COLS,
+                                                      on_conflict=args.on_conflict)
+                if not dumped:
+                    writer.write_raw('')
+            print(f'Wrote {dumped} rows to {len(writer.parts)} dump parts')
+            print(size_report(writer.parts, limits['max_part_bytes']))
+    finally:
+        conn.close()
+        if manifest is not None:
+            manifest.save()
+
+
+def build_incremental(args, input_dir, source_files, output_dir):
+    """--manifest: regenerate the parts of changed inputs only."""
+    limits = part_limits(args)
+    manifest = Manifest(args.manifest, {
+        'outdir': os.path.abspath(output_dir),
+        'insert_mode': args.insert_mode,
+        'on_conflict': args.on_conflict if args.insert_mode == 'values' else None,
+        **limits,
+    })
+
+    for name in manifest.missing_inputs(source_files):
+        removed = remove_outputs(manifest.entries[name].get('outputs', ()))
+        print(f'Input {name} was removed; deleted {removed} parts')
+        manifest.forget(name)
+    pending = [path for path in source_files if not manifest.unchanged(path)]
+    print(f'{len(source_files) - len(pending)} of {len(source_files)} inputs unchanged; regenerating {len(pending)}')
+
+    written = []
+    try:
+        for converted in convert_files(pending, args.workers):
+            csv_path = converted.path
+            # parts left by the previous run of this input (fewer parts now, or a different chunk size)
+            remove_outputs(manifest.outputs(csv_path))
+            manifest.forget(csv_path)
+            if converted.skipped:
+                if converted.error:
+                    print(f'Error processing {csv_path}: {converted.error}', file=sys.stderr)
+                continue
+            stem = os.path.splitext(os.path.basename(csv_path))[0]
+            writer = SqlPartWriter(
+                lambda n: os.path.join(output_dir, f'seed_census_mesh_2020_{stem}_{str(n).zfill(4)}.sql'),
+                header_for=lambda n: part_header(input_dir) + f'-- source: {csv_path}\n',
+                **limits)
+            with writer:
+                write_rows(writer, converted, args)
+                if not converted.rows:
+                    writer.write_raw('')
+            if converted.error:
+                print(f'Error processing {csv_path}: {converted.error}', file=sys.stderr)
+            outputs = [part.path for part in writer.parts]
+            written.extend(writer.parts)
+            if not converted.error:
+                # an input that failed part way is not recorded, so the next run retries it
+                manifest.record(csv_path, outputs, rows=converted.rows)
+            manifest.save()
+            print(f'{os.path.basename(csv_path)}: {converted.rows} rows -> {len(outputs)} parts')
+    finally:
+        manifest.save()
+    if written:
+        print(size_report(written, limits['max_part_bytes']))
+
+
+def part_limits(args, insert_mode=None):
+    """SqlPartWriter limits from the command line.
+
+    insert_mode overrides --insert-mode (the --dump output is always
+    multi-row VALUES statements). A byte budget given without the matching row count lifts the row count,
+    so parts / statements are packed by size alone.
+    """
+    chunk_size = args.chunk_size
+    if chunk_size is None:
+        chunk_size = 0 if args.max_part_bytes else DEFAULT_CHUNK_SIZE
+    rows_per_statement = None
+    if (insert_mode or args.insert_mode) == 'values':
+        rows_per_statement = args.rows_per_statement
+        if rows_per_statement is None:
+            rows_per_statement = 0 if args.max_statement_bytes else DEFAULT_ROWS_PER_STATEMENT
+    return {
+        'max_part_rows': chunk_size or None,
+        'max_part_bytes': args.max_part_bytes or None,
+        'max_statement_rows': rows_per_statement or None,
+        'max_statement_bytes': args.max_statement_bytes or D1_MAX_STATEMENT_BYTES,
+    }
+
+
+def part_header(input_dir):
+    return '-- Generated by genarate_census_mesh_2020.py\n-- Input dir: ' + input_dir + '\n\n'
+
+
+def write_rows(writer, chunks, args):
+    """Write chunks of (key_sql, values_sql) rows of one source file through a SqlPartWriter."""
+    if args.insert_mode == 'values':
+        cols_sql = ','.join(TARGET_COLS)
+        writer.set_statement(f'INSERT INTO census_mesh_2020 ({cols_sql}) VALUES\n', f'\n{conflict_clause(args.on_conflict)};\n')
+        for rows in chunks:
+            for _, values_sql in rows:
+                writer.add_row(f'({values_sql})')
+        # keep statements from spanning source files so the `-- source:` comments stay accurate
+        writer.flush_statement()
+    else:
+        cols_sql = ','.join(TARGET_COLS)
+        for rows in chunks:
+            for key_sql, values_sql in rows:
+                writer.add_statement(render_not_exists_insert(cols_sql, values_sql, key_sql))
+
+
+def conflict_clause(on_conflict: str) -> str:
+    if on_conflict == 'update':
+        assignments = ','.join(f'{col}=excluded.{col}' for col in TARGET_COLS if col != 'key_code')
+        return f'ON CONFLICT(key_code) DO UPDATE SET {assignments}'
+    return 'ON CONFLICT(key_code) DO NOTHING'
+
+
+def render_not_exists_insert(cols_sql: str, values_sql: str, key_sql: str) -> str:
+    return f'INSERT INTO census_mesh_2020 ({cols_sql}) SELECT {values_sql} WHERE NOT EXISTS (SELECT 1 FROM census_mesh_2020 WHERE key_code = {key_sql});\n'
 
 
 def main():
@@ -86,122 +348,67 @@ def main():
     parser.add_argument('--indir', default='work1/party-admin/seed/06_seed_census_mesh_2020/census_mesh_2020_data', help='Input directory with CSV files')
     # removed --outfile option per request; single-file output will use default path below
     parser.add_argument('--outdir', default='C:/Users/minamide/workspace/cloudflear/d1_project/party-admin-api/work1/party-admin/seed/06_seed_census_mesh_2020/SQL', help='Output directory for split SQL files')
-    parser.add_argument('--chunk-size', type=int, default=1000, help='Number of INSERTs per output file')
+    parser.add_argument('--chunk-size', type=int, help=f'Rows per output file (default {DEFAULT_CHUNK_SIZE}; unlimited with --max-part-bytes; 0 = unlimited)')
+    parser.add_argument('--insert-mode', choices=['not-exists', 'values'], default='not-exists', help='not-exists: one INSERT ... WHERE NOT EXISTS per row; values: multi-row INSERT ... VALUES ... ON CONFLICT')
+    parser.add_argument('--rows-per-statement', type=int, help=f'Rows per INSERT statement in --insert-mode values (default {DEFAULT_ROWS_PER_STATEMENT}; unlimited with --max-statement-bytes; 0 = unlimited)')
+    parser.add_argument('--max-part-bytes', type=int, help='Pack each output file up to this many bytes')
+    parser.add_argument('--max-statement-bytes', type=int, help=f'Maximum bytes per SQL statement (default {D1_MAX_STATEMENT_BYTES}, the D1 limit)')
+    parser.add_argument('--workers', type=int, default=1, help='Convert input files in N worker processes (output is identical to a sequential run)')
+    parser.add_argument('--on-conflict', choices=['nothing', 'update'], default='nothing', help='ON CONFLICT(key_code) action in --insert-mode values')
+    parser.add_argument('--sqlite', help='Load rows into this local SQLite file (schema from migrations/) instead of writing SQL parts')
+    parser.add_argument('--dump', help='With --sqlite: also export the table as multi-row INSERT SQL for D1 import (split into numbered parts with --chunk-size / --max-part-bytes)')
+    parser.add_argument('--manifest', help='Manifest file for incremental reruns: only inputs that changed since the last run are regenerated/reloaded')
     args = parser.parse_args()
 
-    cols_sql = ','.join(TARGET_COLS)
-
     input_dir = os.path.expanduser(args.indir)
-    csv_files = sorted(glob.glob(os.path.join(input_dir, '*')))
-    if not csv_files:
+    source_files = input_files(input_dir)
+    if not source_files:
         print(f'No files found in {input_dir}', file=sys.stderr)
         return
 
+    if args.sqlite:
+        build_sqlite(args, input_dir, source_files)
+        return
+
     output_dir = os.path.expanduser(args.outdir) if args.outdir else None
-    chunk_size = int(args.chunk_size or 1000)
 
     if output_dir:
         os.makedirs(output_dir, exist_ok=True)
 
+    if args.manifest:
+        if not output_dir:
+            print('--manifest needs --outdir (parts are written per input file)', file=sys.stderr)
+            sys.exit(1)
+        build_incremental(args, input_dir, source_files, output_dir)
+        return
+
     # default single-file output path (used when outdir is not provided)
     script_dir = os.path.dirname(os.path.abspath(__file__))
     default_output_file = os.path.join(script_dir, 'SQL', '06_seed_census_mesh_2020.sql')
     if not output_dir:
         os.makedirs(os.path.dirname(default_output_file), exist_ok=True)
 
-    def open_new_file(part_index):
-        filename = f'seed_census_mesh_2020_part_{str(part_index).zfill(4)}.sql'
-        full_path = os.path.join(output_dir, filename) if output_dir else default_output_file
-        fh = open(full_path, 'w', encoding='utf-8')
-        fh.write('-- Generated by genarate_census_mesh_2020.py\n')
-        fh.write('-- Input dir: ' + input_dir + '\n\n')
-        return fh, full_path
-
-    part_index = 1
-    part_count = 0
-    outfile_handle = None
-    output_file_path = None
-
-    # open first file
-    if output_dir:
-        outfile_handle, output_file_path = open_new_file(part_index)
-    else:
-        outfile_handle = open(default_output_file, 'w', encoding='utf-8')
-        outfile_handle.write('-- Generated by genarate_census_mesh_2020.py\n')
-        outfile_handle.write('-- Input dir: ' + input_dir + '\n\n')
+    limits = part_limits(args)
+    if not output_dir:
+        # a single file: nothing to rotate
+        limits.update(max_part_rows=None, max_part_bytes=None)
 
-    for csv_path in csv_files:
-            # skip non-files
-            if not os.path.isfile(csv_path):
-                continue
-            try:
-                # try multiple encodings (utf-8-sig, cp932, euc_jp, ...)
-                encodings_to_try = ['utf-8-sig','utf-8','cp932','shift_jis','euc_jp','iso-2022-jp','latin1']
-                text_io = None
-                with open(csv_path, 'rb') as binary_file:
-                    data = binary_file.read()
-                for enc in encodings_to_try:
-                    try:
-                        text = data.decode(enc)
-                        text_io = io.StringIO(text)
-                        break
-                    except Exception:
-                        text_io = None
-                if text_io is None:
-                    print(f'Error processing {csv_path}: unable to decode file with tried encodings', file=sys.stderr)
-                    continue
+    def part_path(part_index):
+        if not output_dir:
+            return default_output_file
+        return os.path.join(output_dir, f'seed_census_mesh_2020_part_{str(part_index).zfill(4)}.sql')
 
-                reader = csv.reader(text_io)
-                try:
-                    header = next(reader)
-                except StopIteration:
-                    continue
-                column_index_map = build_index_map(header)
-
-                outfile_handle.write(f'-- source: {csv_path}\n')
-
-                for csv_row in reader:
-                        key_index = column_index_map.get('key_code')
-                        key_value = None
-                        if key_index is None or key_index >= len(csv_row):
-                            key_value = csv_row[0].strip() if len(csv_row) > 0 else ''
-                        else:
-                            key_value = csv_row[key_index].strip()
-                        if key_value == '':
-                            continue
-
-                        values_list = []
-                        for column in TARGET_COLS:
-                            idx = column_index_map.get(column)
-                            raw = None
-                            if idx is not None and idx < len(csv_row):
-                                raw = csv_row[idx]
-                            else:
-                                pos = TARGET_COLS.index(column)
-                                if pos < len(csv_row):
-                                    raw = csv_row[pos]
-                            values_list.append(value_to_sql(column, raw))
-
-                        values_sql = ','.join(values_list)
-                        key_sql = values_list[0]
-                        outfile_handle.write(f'INSERT INTO census_mesh_2020 ({cols_sql}) SELECT {values_sql} WHERE NOT EXISTS (SELECT 1 FROM census_mesh_2020 WHERE key_code = {key_sql});\n')
-                        part_count += 1
-                        # rotate files when reaching chunk size
-                        if output_dir and part_count >= chunk_size:
-                            outfile_handle.close()
-                            part_index += 1
-                            part_count = 0
-                            outfile_handle, output_file_path = open_new_file(part_index)
-            except Exception as e:
-                print(f'Error processing {csv_path}: {e}', file=sys.stderr)
-                continue
-    # close final handle
+    writer = SqlPartWriter(part_path, header_for=lambda n: part_header(input_dir), **limits)
     try:
-        if out:
-            out.close()
-    except Exception:
-        pass
-
+        for converted in convert_files(source_files, args.workers):
+            if not converted.skipped:
+                writer.write_raw(f'-- source: {converted.path}\n')
+                write_rows(writer, converted, args)
+            if converted.error:
+                print(f'Error processing {converted.path}: {converted.error}', file=sys.stderr)
+    finally:
+        writer.close()
+    print(size_report(writer.parts, limits['max_part_bytes']))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,266 @@
+"""
+Asyncio upload engine for upload_kv.py (stdlib only).
+
+request_with_retry sends every GET / PUT through `requests.request`, i.e.
+a new connection (and TLS handshake) per mesh. Here one event loop keeps a
+bounded pool of keep-alive HTTP/1.1 connections per origin and runs a
+configurable number of requests in flight over it:
+
+  client = AsyncKVClient(in_flight=64, connections=64)
+  client.upload(items, on_result)   # items: process_single-style dicts
+  client.close()
+
+Items are pulled from the iterator only as slots free up, so the CSV is
+read at the pace of the network and never buffered ahead. Results reach
+on_result(item, (kv_key, ok_flag, msg)) in completion order, with the same
+values process_single returns. Responses are handled like
+request_with_retry: 2xx and 404 are final, other statuses and connection
+errors are retried after Retry-After or an exponential backoff. An
+AdaptiveLimiter (kv_rate.py) can drive the number in flight, and a Metrics
+(kv_metrics.py) records every attempt.
+"""
+
+import asyncio
+import ssl
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+from kv_metrics import Metrics
+from kv_rate import AdaptiveLimiter, retry_delay
+
+DEFAULT_TIMEOUT = 30
+MAX_HEADER_LINES = 100
+
+
+class Response(NamedTuple):
+    status_code: int
+    headers: Dict[str, str]  # lower-cased names
+    content: bytes
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', 'replace')
+
+
+class _Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    def close(self):
+        self.reusable = False
+        self.writer.close()
+
+
+Origin = Tuple[str, str, int]
+
+
+class ConnectionPool:
+    """At most `max_connections` open connections; idle ones are reused (LIFO)."""
+
+    def __init__(self, max_connections: int = 10, timeout: float = DEFAULT_TIMEOUT):
+        self.max_connections = max(1, max_connections)
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(self.max_connections)
+        self._idle: Dict[Origin, List[_Connection]] = {}
+        self._ssl = None
+        self.opened = 0
+        self.requests = 0
+
+    async def _connect(self, origin: Origin) -> _Connection:
+        scheme, host, port = origin
+        if scheme == 'https' and self._ssl is None:
+            self._ssl = ssl.create_default_context()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=self._ssl if scheme == 'https' else None), self.timeout)
+        self.opened += 1
+        return _Connection(reader, writer)
+
+    async def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                      data: Optional[bytes] = None) -> Response:
+        parts = urlsplit(url)
+        origin = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        lines = [f'{method} {target} HTTP/1.1', f'Host: {parts.netloc}']
+        lines.extend(f'{name}: {value}' for name, value in (headers or {}).items())
+        body = data or b''
+        if body or method in ('PUT', 'POST', 'PATCH'):
+            lines.append(f'Content-Length: {len(body)}')
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        async with self._slots:
+            idle = self._idle.setdefault(origin, [])
+            while True:
+                reused = bool(idle)
+                conn = idle.pop() if reused else await self._connect(origin)
+                try:
+                    resp = await asyncio.wait_for(self._exchange(conn, method, head + body), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    conn.close()
+                    if reused:
+                        continue  # the server dropped an idle keep-alive connection; not a request failure
+                    raise
+                except BaseException:
+                    conn.close()
+                    raise
+                self.requests += 1
+                if conn.reusable:
+                    idle.append(conn)
+                else:
+                    conn.close()
+                return resp
+
+    async def _exchange(self, conn: _Connection, method: str, request: bytes) -> Response:
+        conn.writer.write(request)
+        await conn.writer.drain()
+        reader = conn.reader
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('connection closed before the response')
+        version, status, _ = (status_line.decode('latin-1').rstrip('\r\n') + '  ').split(' ', 2)
+        if not status.isdigit():
+            raise ValueError(f'bad status line: {status_line[:100]!r}')
+        headers: Dict[str, str] = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError('too many response headers')
+
+        connection = headers.get('connection', '').lower()
+        if connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive'):
+            conn.reusable = False
+        code = int(status)
+        if method == 'HEAD' or code in (204, 304) or 100 <= code < 200:
+            content = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0].strip() or b'0', 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass  # trailers
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            content = b''.join(chunks)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            conn.reusable = False
+        return Response(code, headers, content)
+
+    async def close(self):
+        for idle in self._idle.values():
+            for conn in idle:
+                conn.close()
+        self._idle.clear()
+
+
+async def request_with_retry(pool: ConnectionPool, method: str, url: str, headers: Dict[str, str],
+                             data: Optional[bytes] = None, max_retries: int = 3,
+                             limiter: Optional[AdaptiveLimiter] = None,
+                             metrics: Optional[Metrics] = None) -> Optional[Response]:
+    attempt = 0
+    loop = asyncio.get_running_loop()
+    while True:
+        if limiter is not None and limiter.pause_remaining() > 0:
+            await asyncio.sleep(limiter.pause_remaining())
+        started = loop.time()
+        try:
+            resp = await pool.request(method, url, headers=headers, data=data)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            resp = None
+        if limiter is not None:
+            limiter.record(resp.status_code if resp is not None else None, loop.time() - started,
+                           resp.headers if resp is not None else None)
+        if metrics is not None:
+            metrics.request(method, resp.status_code if resp is not None else None, loop.time() - started,
+                            len(data) if data else 0, retry=attempt > 0)
+        if resp is not None and (200 <= resp.status_code < 300 or resp.status_code == 404):
+            return resp
+        attempt += 1
+        if attempt > max_retries:
+            return resp
+        delay = retry_delay(attempt, resp.headers if resp is not None else None)
+        if metrics is not None:
+            metrics.waited(delay)
+        await asyncio.sleep(delay)
+
+
+async def process_single(pool: ConnectionPool, item: dict):
+    """The HTTP path of upload_kv.process_single on the pool."""
+    kv_key = item['kv_key']
+    put_url = item['put_url']
+    headers = item['headers']
+    retries = item['retries']
+    limiter = item.get('limiter')
+    metrics = item.get('metrics')
+    if item['skip_existing']:
+        resp = await request_with_retry(pool, 'GET', put_url, headers, max_retries=retries, limiter=limiter, metrics=metrics)
+        if resp is None:
+            return (kv_key, False, 'GET failed (no response)')
+        if resp.status_code == 200:
+            return (kv_key, 'skipped', 'exists')
+        if resp.status_code != 404:
+            return (kv_key, False, f'GET status {resp.status_code} body={resp.text[:200]}')
+    resp = await request_with_retry(pool, 'PUT', put_url, {**headers, 'Content-Type': item.get('content_type', 'application/json')},
+                                    data=item['payload'], max_retries=retries, limiter=limiter, metrics=metrics)
+    if resp is None:
+        return (kv_key, False, 'PUT failed (no response)')
+    if 200 <= resp.status_code < 300:
+        return (kv_key, True, '')
+    return (kv_key, False, f'PUT status {resp.status_code} body={resp.text[:200]}')
+
+
+async def upload_items(pool: ConnectionPool, items: Iterable[dict], in_flight: Callable[[], int],
+                       on_result: Callable[[dict, tuple], None]):
+    """Keep up to in_flight() items in progress until `items` is exhausted."""
+    items = iter(items)
+    pending: Dict[asyncio.Future, dict] = {}
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < in_flight():
+            item = next(items, None)
+            if item is None:
+                exhausted = True
+                break
+            pending[asyncio.ensure_future(process_single(pool, item))] = item
+        if not pending:
+            return
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            item = pending.pop(task)
+            try:
+                result = task.result()
+            except Exception as e:
+                result = (item['kv_key'], False, f'{type(e).__name__}: {e}')
+            on_result(item, result)
+
+
+class AsyncKVClient:
+    """Synchronous front for the engine; the pool (and its connections) lives across upload() calls.
+
+    With a limiter the number in flight follows limiter.limit, and the pool
+    is sized for its upper bound.
+    """
+
+    def __init__(self, in_flight: int = 64, connections: Optional[int] = None, timeout: float = DEFAULT_TIMEOUT,
+                 limiter: Optional[AdaptiveLimiter] = None):
+        self.in_flight = max(1, in_flight)
+        self.limiter = limiter
+        self.loop = asyncio.new_event_loop()
+        self.pool = ConnectionPool(connections or (limiter.maximum if limiter else self.in_flight), timeout)
+
+    def upload(self, items: Iterable[dict], on_result: Callable[[dict, tuple], None]):
+        window = (lambda: self.limiter.limit) if self.limiter else (lambda: self.in_flight)
+        self.loop.run_until_complete(upload_items(self.pool, items, window, on_result))
+
+    def close(self):
+        self.loop.run_until_complete(self.pool.close())
+        self.loop.close()
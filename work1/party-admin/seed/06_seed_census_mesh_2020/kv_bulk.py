@@ -0,0 +1,278 @@
+"""
+Bulk writes for upload_kv.py (--bulk).
+
+Instead of one `PUT .../values/{key}` per mesh, rows are packed into
+`PUT .../namespaces/{namespace}/bulk` requests whose body is a JSON array
+of {"key": ..., "value": ...} pairs. A request holds at most
+BULK_MAX_KEYS pairs and BULK_MAX_BYTES of body, the limits of the
+Cloudflare API; both can be lowered from the command line.
+
+The response lists keys that could not be written
+(result.unsuccessful_keys); those are reported as failures of their own
+rows and every other key in the request as written. A request that fails
+as a whole (after retries) fails all of its keys.
+
+BulkWriter.delete removes keys the same way, BULK_MAX_KEYS names per
+`POST .../bulk/delete` request (--delete-missing).
+
+WranglerBulkWriter is the same for --use-wrangler: each batch goes into a
+temporary JSON file (the same array of pairs) and is written with one
+`wrangler kv bulk put FILE --namespace-id NS`, instead of starting a
+wrangler process per key. The CLI reports only success or failure of the
+whole file, so a failed call is retried and then split in halves: the
+half that goes through is written, the half that fails is split again
+down to the one key that is at fault. When both halves fail the cause is
+not a single key (network, auth) and the whole batch is reported failed
+without further calls. Keys and values over the KV size limits fail on
+their own without being sent.
+"""
+
+import base64
+import json
+import os
+import subprocess
+import tempfile
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import requests
+
+from kv_metrics import Metrics
+from kv_rate import retry_delay
+
+BULK_MAX_KEYS = 10_000
+BULK_MAX_BYTES = 100 * 1024 * 1024
+KV_MAX_KEY_BYTES = 512
+KV_MAX_VALUE_BYTES = 25 * 1024 * 1024
+
+
+def bulk_entry(kv_key: str, payload: bytes) -> bytes:
+    """One element of the bulk body; the stored value is the payload text itself (base64 for binary values)."""
+    try:
+        entry = {'key': kv_key, 'value': payload.decode('utf-8')}
+    except UnicodeDecodeError:
+        entry = {'key': kv_key, 'value': base64.b64encode(payload).decode('ascii'), 'base64': True}
+    return json.dumps(entry, ensure_ascii=False).encode('utf-8')
+
+
+def pack_batches(items: Iterable[dict], max_keys: int = BULK_MAX_KEYS,
+                 max_bytes: int = BULK_MAX_BYTES) -> Iterator[List[Tuple[dict, bytes]]]:
+    """Group items into [(item, entry), ...] lists whose JSON body stays within both limits.
+
+    An entry too large for a request on its own is still sent alone (and
+    rejected by the API as that row's failure), so no row is dropped.
+    """
+    batch: List[Tuple[dict, bytes]] = []
+    size = 2  # '[' ']'
+    for item in items:
+        entry = bulk_entry(item['kv_key'], item['payload'])
+        grown = size + len(entry) + (1 if batch else 0)
+        if batch and (len(batch) >= max_keys or grown > max_bytes):
+            yield batch
+            batch, grown = [], 2 + len(entry)
+        batch.append((item, entry))
+        size = grown
+    if batch:
+        yield batch
+
+
+class BulkWriter:
+    """Sends packed batches over one keep-alive session."""
+
+    def __init__(self, bulk_url: str, headers: dict, retries: int = 3, timeout: float = 120,
+                 metrics: Optional[Metrics] = None):
+        self.bulk_url = bulk_url
+        self.headers = {**headers, 'Content-Type': 'application/json'}
+        self.retries = retries
+        self.timeout = timeout
+        self.metrics = metrics
+        self.session = requests.Session()
+        self.requests = 0
+
+    def _put(self, body: bytes, method: str = 'PUT', url: Optional[str] = None) -> Optional[requests.Response]:
+        attempt = 0
+        kind = 'bulk' if method == 'PUT' else 'bulk delete'
+        while True:
+            started = time.monotonic()
+            try:
+                resp = self.session.request(method, url or self.bulk_url, headers=self.headers, data=body, timeout=self.timeout)
+                self.requests += 1
+            except requests.RequestException:
+                resp = None
+            if self.metrics is not None:
+                self.metrics.request(kind, resp.status_code if resp is not None else None, time.monotonic() - started,
+                                     len(body), retry=attempt > 0)
+            if resp is not None and (200 <= resp.status_code < 300 or resp.status_code in (400, 413)):
+                return resp  # a malformed or oversized body fails the same way on every attempt
+            attempt += 1
+            if attempt > self.retries:
+                return resp
+            delay = retry_delay(attempt, resp.headers if resp is not None else None)
+            if self.metrics is not None:
+                self.metrics.waited(delay)
+            time.sleep(delay)
+
+    def put(self, batch: List[Tuple[dict, bytes]]) -> List[Tuple[dict, tuple]]:
+        """[(item, (kv_key, ok_flag, msg)), ...] for every item of the batch."""
+        body = b'[' + b','.join(entry for _, entry in batch) + b']'
+        resp = self._put(body)
+        if resp is None:
+            return [(item, (item['kv_key'], False, 'bulk PUT failed (no response)')) for item, _ in batch]
+        try:
+            data = resp.json()
+        except ValueError:
+            data = None
+        if not (200 <= resp.status_code < 300) or not isinstance(data, dict) or not data.get('success'):
+            msg = f'bulk PUT status {resp.status_code} body={resp.text[:200]}'
+            return [(item, (item['kv_key'], False, msg)) for item, _ in batch]
+        rejected = set((data.get('result') or {}).get('unsuccessful_keys') or ())
+        return [(item, (item['kv_key'], False, 'rejected by bulk write') if item['kv_key'] in rejected
+                 else (item['kv_key'], True, '')) for item, _ in batch]
+
+    def delete(self, keys: List[str], max_keys: int = BULK_MAX_KEYS) -> List[Tuple[str, str]]:
+        """Delete keys in bulk requests; returns [(key, message), ...] for the keys that could not be deleted."""
+        failed = []
+        for start in range(0, len(keys), max_keys):
+            chunk = keys[start:start + max_keys]
+            resp = self._put(json.dumps(chunk, ensure_ascii=False).encode('utf-8'), 'POST', self.bulk_url + '/delete')
+            if resp is None:
+                failed.extend((key, 'bulk delete failed (no response)') for key in chunk)
+                continue
+            try:
+                data = resp.json()
+            except ValueError:
+                data = None
+            if not (200 <= resp.status_code < 300) or not isinstance(data, dict) or not data.get('success'):
+                msg = f'bulk delete status {resp.status_code} body={resp.text[:200]}'
+                failed.extend((key, msg) for key in chunk)
+                continue
+            rejected = set((data.get('result') or {}).get('unsuccessful_keys') or ())
+            failed.extend((key, 'rejected by bulk delete') for key in chunk if key in rejected)
+        return failed
+
+    def close(self):
+        self.session.close()
+
+
+class WranglerBulkWriter:
+    """Writes packed batches with one `wrangler kv bulk put` per batch (--use-wrangler).
+
+    key_name maps a KV key of the uploader to the name stored through
+    wrangler. `requests` counts wrangler processes started.
+    """
+
+    def __init__(self, namespace_id: str, key_name: Callable[[str], str] = lambda key: key, retries: int = 3,
+                 timeout: float = 600, tmp_dir: Optional[str] = None, metrics: Optional[Metrics] = None):
+        self.namespace_id = namespace_id
+        self.key_name = key_name
+        self.retries = retries
+        self.timeout = timeout
+        self.tmp_dir = tmp_dir
+        self.metrics = metrics
+        self.requests = 0
+
+    def _run(self, command: str, body: bytes, retry: bool = False) -> Optional[str]:
+        """One `wrangler kv bulk <command>` with body as its file; None on success, else the error."""
+        started = time.monotonic()
+        status, error = self._call(command, body)
+        if self.metrics is not None:
+            self.metrics.request(f'wrangler {command}', status, time.monotonic() - started, len(body), retry=retry)
+        return error
+
+    def _call(self, command: str, body: bytes) -> Tuple[str, Optional[str]]:
+        """(status label for the metrics, error or None)."""
+        fd, path = tempfile.mkstemp(prefix='census_kv_bulk_', suffix='.json', dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            cmd = ['wrangler', 'kv', 'bulk', command, path, '--namespace-id', self.namespace_id]
+            if command == 'delete':
+                cmd.append('--force')  # no confirmation prompt
+            self.requests += 1
+            try:
+                p = subprocess.run(cmd, capture_output=True, text=True, timeout=self.timeout)
+            except FileNotFoundError:
+                return 'not found', 'wrangler not found'
+            except subprocess.TimeoutExpired:
+                return 'timeout', f'wrangler kv bulk {command} timed out after {self.timeout:.0f}s'
+            if p.returncode == 0:
+                return 'exit 0', None
+            lines = (p.stderr or p.stdout).strip().splitlines()
+            return f'exit {p.returncode}', f'wrangler kv bulk {command} exit {p.returncode}: {lines[-1][:200] if lines else "no output"}'
+        finally:
+            os.remove(path)
+
+    def _run_with_retry(self, command: str, body: bytes) -> Optional[str]:
+        attempt = 0
+        while True:
+            error = self._run(command, body, retry=attempt > 0)
+            if error is None or error == 'wrangler not found':
+                return error
+            attempt += 1
+            if attempt > self.retries:
+                return error
+            delay = retry_delay(attempt)
+            if self.metrics is not None:
+                self.metrics.waited(delay)
+            time.sleep(delay)
+
+    def _settle(self, entries: List[Tuple[dict, bytes]], error: str) -> List[Tuple[dict, tuple]]:
+        """entries failed together with `error`: split them to find the keys at fault (results in entry order)."""
+        if len(entries) == 1:
+            item = entries[0][0]
+            return [(item, (item['kv_key'], False, error))]
+        halves = [entries[:len(entries) // 2], entries[len(entries) // 2:]]
+        errors = [self._run('put', self._body(half), retry=True) for half in halves]
+        if all(errors):
+            return [(item, (item['kv_key'], False, error)) for item, _ in entries]
+        results = []
+        for half, half_error in zip(halves, errors):
+            if half_error is None:
+                results.extend((item, (item['kv_key'], True, '')) for item, _ in half)
+            else:
+                results.extend(self._settle(half, half_error))
+        return results
+
+    @staticmethod
+    def _body(entries: List[Tuple[dict, bytes]]) -> bytes:
+        return b'[' + b','.join(entry for _, entry in entries) + b']'
+
+    def put(self, batch: List[Tuple[dict, bytes]]) -> List[Tuple[dict, tuple]]:
+        """[(item, (kv_key, ok_flag, msg)), ...] for every item of the batch, in batch order."""
+        results: List[Optional[Tuple[dict, tuple]]] = [None] * len(batch)
+        sent: List[int] = []  # batch positions of the entries in the file
+        entries = []
+        for n, (item, _) in enumerate(batch):
+            name = self.key_name(item['kv_key'])
+            if len(name.encode('utf-8')) > KV_MAX_KEY_BYTES:
+                results[n] = (item, (item['kv_key'], False, f'key longer than {KV_MAX_KEY_BYTES} bytes'))
+            elif len(item['payload']) > KV_MAX_VALUE_BYTES:
+                results[n] = (item, (item['kv_key'], False, f'value larger than {KV_MAX_VALUE_BYTES} bytes'))
+            else:
+                sent.append(n)
+                entries.append((item, bulk_entry(name, item['payload'])))
+        if entries:
+            error = self._run_with_retry('put', self._body(entries))
+            if error is None:
+                settled = [(item, (item['kv_key'], True, '')) for item, _ in entries]
+            elif error == 'wrangler not found':
+                settled = [(item, (item['kv_key'], False, error)) for item, _ in entries]
+            else:
+                settled = self._settle(entries, error)
+            for n, result in zip(sent, settled):
+                results[n] = result
+        return results
+
+    def delete(self, keys: List[str], max_keys: int = BULK_MAX_KEYS) -> List[Tuple[str, str]]:
+        """Delete keys with one `wrangler kv bulk delete` per max_keys; [(key, message), ...] for the failed ones."""
+        failed = []
+        for start in range(0, len(keys), max_keys):
+            chunk = keys[start:start + max_keys]
+            body = json.dumps([self.key_name(key) for key in chunk], ensure_ascii=False).encode('utf-8')
+            error = self._run_with_retry('delete', body)
+            if error is not None:
+                failed.extend((key, error) for key in chunk)
+        return failed
+
+    def close(self):
+        pass
@@ -0,0 +1,190 @@
+"""
+Row-exact checkpoints for upload_kv.py (--checkpoint-file).
+
+The old checkpoint was a single {"file", "index"}: every row below `index`
+was taken as done. With --parallel / --async-requests completions arrive
+out of order and rows can fail, so that index either lagged behind or
+skipped rows that never made it. Resuming also re-parsed the whole file up
+to `index`.
+
+Now the checkpoint records, per input file, the set of rows that are done
+(written, skipped as existing / unchanged, or without a key) as a list of
+[start, end) ranges, and the byte offset of the first row that is not.
+A resume seeks straight to that offset and then skips only rows inside a
+done range, so exactly the missing and failed rows are sent again:
+
+  {"version": 2,
+   "files": {"/abs/tblT001101H47.txt": {
+       "size": 284913, "mtime_ns": 1700000000000000000,
+       "done": [[0, 1200], [1203, 1400]],
+       "offset": 101833, "offset_row": 1200, "offset_line": 1202,
+       "rows": null, "complete": false}}}
+
+`rows` is the number of rows once the file was read to the end; a file
+whose done ranges cover all of them is `complete` and not opened again.
+An entry whose file changed size or mtime is dropped, since its row
+numbers and offsets no longer apply. A checkpoint in the old format is
+read as: files before `file` complete, rows below `index` done.
+"""
+
+import bisect
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+CHECKPOINT_VERSION = 2
+
+
+class RangeSet:
+    """Set of non-negative ints kept as sorted, disjoint [start, end) ranges."""
+
+    def __init__(self, ranges: Iterable[Sequence[int]] = ()):
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+        for start, end in ranges:
+            self.add_range(start, end)
+
+    def add(self, value: int):
+        self.add_range(value, value + 1)
+
+    def add_range(self, start: int, end: int):
+        if end <= start:
+            return
+        lo = bisect.bisect_left(self._ends, start)  # first range ending at or after start (touching counts)
+        hi = bisect.bisect_right(self._starts, end)  # ranges starting at or before end
+        if lo < hi:
+            start = min(start, self._starts[lo])
+            end = max(end, self._ends[hi - 1])
+        self._starts[lo:hi] = [start]
+        self._ends[lo:hi] = [end]
+
+    def __contains__(self, value: int) -> bool:
+        k = bisect.bisect_right(self._starts, value) - 1
+        return k >= 0 and value < self._ends[k]
+
+    def first_missing(self, start: int = 0) -> int:
+        """Smallest value >= start that is not in the set."""
+        k = bisect.bisect_right(self._starts, start) - 1
+        if k >= 0 and start < self._ends[k]:
+            return self._ends[k]
+        return start
+
+    def __len__(self) -> int:
+        return sum(end - start for start, end in zip(self._starts, self._ends))
+
+    def __bool__(self) -> bool:
+        return bool(self._starts)
+
+    def ranges(self) -> List[List[int]]:
+        return [[start, end] for start, end in zip(self._starts, self._ends)]
+
+
+class FileProgress:
+    """Done rows of one input file, plus what is needed to seek back to the first row that is not."""
+
+    def __init__(self, entry: Optional[dict] = None):
+        entry = entry or {}
+        self.done = RangeSet(entry.get('done', ()))
+        self.rows: Optional[int] = entry.get('rows')
+        self._complete = bool(entry.get('complete'))
+        self.resumed = bool(self.done) or self._complete
+        # byte offset and line number of a row, kept from when it is read until it is done
+        self._positions: Dict[int, Tuple[int, int]] = {}
+        if entry.get('offset') is not None and entry.get('offset_row') is not None:
+            self._positions[entry['offset_row']] = (entry['offset'], entry.get('offset_line', 0))
+        self._read_end: Optional[Tuple[int, int, int]] = None  # (next row, its offset, its line)
+
+    @property
+    def complete(self) -> bool:
+        return self._complete or (self.rows is not None and self.done.first_missing() >= self.rows)
+
+    def seek_position(self) -> Optional[Tuple[int, int, int]]:
+        """(row, byte offset, line number) of the first row that is not done, if known."""
+        row = self.done.first_missing()
+        if row == 0 or row not in self._positions:
+            return None
+        offset, line = self._positions[row]
+        return row, offset, line
+
+    def seen(self, row: int, offset: int, line: int, next_offset: int, next_line: int):
+        """Row `row` starts at byte `offset` (line `line`); the next one at next_offset."""
+        if row not in self.done:
+            self._positions[row] = (offset, line)
+        self._read_end = (row + 1, next_offset, next_line)
+
+    def position(self, row: int) -> Optional[Tuple[int, int]]:
+        """(byte offset, line number) of a row read but not done yet (e.g. one that failed)."""
+        return self._positions.get(row)
+
+    def mark(self, row: int):
+        self.done.add(row)
+        self._positions.pop(row, None)
+
+    def finish(self, rows: int):
+        """The file was read to the end and holds `rows` rows."""
+        self.rows = rows
+
+    def to_json(self) -> dict:
+        row = self.done.first_missing()
+        position = self._positions.get(row)
+        if position is None and self._read_end is not None and self._read_end[0] == row:
+            position = self._read_end[1:]
+        return {
+            'done': self.done.ranges(),
+            'offset': position[0] if position else None,
+            'offset_row': row if position else None,
+            'offset_line': position[1] if position else None,
+            'rows': self.rows,
+            'complete': self.complete,
+        }
+
+
+class Checkpoint:
+    """All FileProgress of a run, loaded from and saved to one JSON file."""
+
+    def __init__(self, path: str, input_paths: Sequence[str] = ()):
+        self.path = path
+        self.files: Dict[str, dict] = {}
+        self._progress: Dict[str, FileProgress] = {}
+        self._stat: Dict[str, Tuple[int, int]] = {}  # (size, mtime_ns) of each file when it was opened
+        self.dropped: List[str] = []  # entries discarded because their file changed
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        if isinstance(data, dict) and data.get('version') == CHECKPOINT_VERSION:
+            self.files = data.get('files') or {}
+        elif isinstance(data, dict) and data.get('file'):
+            # {"file", "index"} from before: earlier files done, rows below index done
+            resume_file = os.path.abspath(data['file'])
+            for p in input_paths:
+                if os.path.abspath(p) < resume_file:
+                    self.files[os.path.abspath(p)] = {'complete': True}
+            self.files[resume_file] = {'done': [[0, data.get('index', 0)]] if data.get('index') else []}
+
+    def progress(self, path: str) -> FileProgress:
+        key = os.path.abspath(path)
+        if key not in self._progress:
+            entry = self.files.get(key)
+            try:
+                st = os.stat(key)
+                self._stat[key] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                pass
+            if entry is not None and 'size' in entry and self._stat.get(key) != (entry['size'], entry.get('mtime_ns')):
+                self.dropped.append(key)
+                entry = None
+            self._progress[key] = FileProgress(entry)
+        return self._progress[key]
+
+    def save(self):
+        for key, progress in self._progress.items():
+            entry = progress.to_json()
+            if key in self._stat:
+                entry['size'], entry['mtime_ns'] = self._stat[key]
+            self.files[key] = entry
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': CHECKPOINT_VERSION, 'files': self.files}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
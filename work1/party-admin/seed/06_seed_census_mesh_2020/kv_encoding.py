@@ -0,0 +1,216 @@
+"""
+Compact value encodings for the census KV entries (upload_kv.py --value-encoding).
+
+A `json` value repeats the 54 column names in every mesh, and the names
+are most of its ~1 KB. The two compact encodings store the values only,
+in the column order of a schema descriptor that is written once under
+SCHEMA_KEY_PREFIX + version:
+
+  json    {"key_code":362257353,"htksyori":0,"htksaki":null,...}   (unchanged)
+  array   [1,362257353,0,null,null,29,15,14,...]                   JSON array, schema version first
+  binary  b'CM' + version byte + one varint-tagged field per column
+
+binary fields (unsigned LEB128 varint u, tag = u & 3):
+
+  u == 0    null
+  tag 1     integer, zigzag(n) = u >> 2
+  tag 2     UTF-8 string of u >> 2 bytes follows
+  tag 3     list of u >> 2 strings follows, each a varint length + UTF-8 bytes
+
+decode_value() tells the three apart from the first byte, so readers
+(kv_shard.py) need only the descriptor, not the encoding name.
+"""
+
+import json
+from typing import Dict, List, Optional, Sequence
+
+SCHEMA_KEY_PREFIX = 'census_mesh_2020_schema:'
+SCHEMA_VERSION = 1
+VALUE_ENCODINGS = ('json', 'array', 'binary')
+BINARY_MAGIC = b'CM'
+
+# JSON keys upload_kv.py derives from the census header, in file order
+CENSUS_COLUMNS = ['key_code', 'htksyori', 'htksaki', 'gassan'] + [f't001101{i:03d}' for i in range(1, 51)]
+
+CONTENT_TYPES = {'json': 'application/json', 'array': 'application/json', 'binary': 'application/octet-stream'}
+
+
+def schema_key(version: int = SCHEMA_VERSION) -> str:
+    return SCHEMA_KEY_PREFIX + str(version)
+
+
+def schema_descriptor(columns: Sequence[str] = CENSUS_COLUMNS, version: int = SCHEMA_VERSION) -> dict:
+    """The value stored under schema_key(version)."""
+    return {
+        'version': version,
+        'columns': list(columns),
+        'array': 'JSON array: [version, value per column...], null for a missing value',
+        'binary': 'magic "CM", version byte, per column a LEB128 varint u: 0 = null; '
+                  'u&3 == 1: integer zigzag(u>>2); 2: UTF-8 string of u>>2 bytes; '
+                  '3: u>>2 strings, each varint length + UTF-8 bytes',
+    }
+
+
+def _put_varint(out: bytearray, u: int):
+    while u > 0x7f:
+        out.append((u & 0x7f) | 0x80)
+        u >>= 7
+    out.append(u)
+
+
+def _get_varint(data: bytes, pos: int):
+    u = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        u |= (b & 0x7f) << shift
+        if b < 0x80:
+            return u, pos
+        shift += 7
+
+
+def _put_text(out: bytearray, tag: int, text: str):
+    raw = text.encode('utf-8')
+    _put_varint(out, (len(raw) << 2) | tag)
+    out += raw
+
+
+def encode_binary(values: Sequence, version: int = SCHEMA_VERSION) -> bytes:
+    out = bytearray(BINARY_MAGIC)
+    out.append(version)
+    for value in values:
+        if value is None:
+            out.append(0)
+        elif isinstance(value, int):
+            zigzag = value << 1 if value >= 0 else ((-value) << 1) - 1
+            _put_varint(out, (zigzag << 2) | 1)
+        elif isinstance(value, str):
+            _put_text(out, 2, value)
+        elif isinstance(value, list):
+            _put_varint(out, (len(value) << 2) | 3)
+            for part in value:
+                raw = part.encode('utf-8')
+                _put_varint(out, len(raw))
+                out += raw
+        else:
+            raise TypeError(f'cannot encode {type(value).__name__} value')
+    return bytes(out)
+
+
+def decode_binary(data: bytes):
+    """(version, [value per column])."""
+    if data[:2] != BINARY_MAGIC:
+        raise ValueError('not a binary census value')
+    version = data[2]
+    values: List = []
+    pos = 3
+    while pos < len(data):
+        u, pos = _get_varint(data, pos)
+        tag, n = u & 3, u >> 2
+        if u == 0:
+            values.append(None)
+        elif tag == 1:
+            values.append(n >> 1 if not n & 1 else -((n + 1) >> 1))
+        elif tag == 2:
+            values.append(data[pos:pos + n].decode('utf-8'))
+            pos += n
+        elif tag == 3:
+            parts = []
+            for _ in range(n):
+                size, pos = _get_varint(data, pos)
+                parts.append(data[pos:pos + size].decode('utf-8'))
+                pos += size
+            values.append(parts)
+        else:
+            raise ValueError(f'bad field tag at byte {pos}')
+    return version, values
+
+
+class ValueEncoder:
+    """Mesh JSON object -> stored bytes in one encoding, for files whose header gives `columns`."""
+
+    def __init__(self, encoding: str, columns: Sequence[str], version: int = SCHEMA_VERSION):
+        if encoding not in VALUE_ENCODINGS:
+            raise ValueError(f'unknown value encoding {encoding!r}')
+        if encoding != 'json' and list(columns) != CENSUS_COLUMNS:
+            raise ValueError(f'header does not match value schema v{version} (columns {list(columns)[:6]}...)')
+        self.encoding = encoding
+        self.version = version
+        self.content_type = CONTENT_TYPES[encoding]
+
+    def encode(self, obj: dict) -> bytes:
+        if self.encoding == 'json':
+            return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        if self.encoding == 'array':
+            return json.dumps([self.version, *obj.values()], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return encode_binary(list(obj.values()), self.version)
+
+
+def decode_value(data: bytes, descriptors: Optional[Dict[int, dict]] = None) -> dict:
+    """Stored bytes in any encoding -> the mesh JSON object; descriptors: version -> schema descriptor."""
+    if data[:1] == b'{':
+        return json.loads(data)
+    if data[:1] == b'[':
+        values = json.loads(data)
+        version, values = values[0], values[1:]
+    else:
+        version, values = decode_binary(data)
+    descriptor = (descriptors or {}).get(version)
+    if descriptor is None:
+        raise ValueError(f'no schema descriptor for version {version} (stored under {schema_key(version)})')
+    columns = descriptor['columns']
+    if len(columns) != len(values):
+        raise ValueError(f'{len(values)} values for {len(columns)} columns of schema v{version}')
+    return dict(zip(columns, values))
+
+
+def other_sizes(obj: dict, selected: str) -> Dict[str, int]:
+    """Size of obj in every encoding but `selected` (encodings its columns do not fit are left out)."""
+    sizes = {}
+    for name in VALUE_ENCODINGS:
+        if name == selected:
+            continue
+        try:
+            sizes[name] = len(ValueEncoder(name, list(obj)).encode(obj))
+        except ValueError:
+            continue
+    return sizes
+
+
+class EncodingStats:
+    """Average value size per encoding.
+
+    Every row's stored value is counted for the selected encoding; the
+    other encodings are measured on one row in SAMPLE_EVERY to keep the
+    extra encoding work small. Rows encoded in worker processes
+    (kv_pipeline.py) bring their sampled sizes along and go through add().
+    """
+
+    SAMPLE_EVERY = 100
+
+    def __init__(self, selected: str):
+        self.selected = selected
+        self.rows = 0
+        self.bytes = {name: 0 for name in VALUE_ENCODINGS}
+        self.counts = {name: 0 for name in VALUE_ENCODINGS}
+
+    def record(self, obj: dict, payload: bytes):
+        self.add(len(payload), other_sizes(obj, self.selected) if self.rows % self.SAMPLE_EVERY == 0 else None)
+
+    def add(self, size: int, others: Optional[Dict[str, int]] = None):
+        self.rows += 1
+        self.bytes[self.selected] += size
+        self.counts[self.selected] += 1
+        for name, other in (others or {}).items():
+            self.bytes[name] += other
+            self.counts[name] += 1
+
+    def summary(self) -> str:
+        parts = []
+        for name in VALUE_ENCODINGS:
+            if not self.counts[name]:
+                continue
+            note = ' (selected)' if name == self.selected else f' (sampled, {self.counts[name]} rows)'
+            parts.append(f'{name} {self.bytes[name] / self.counts[name]:.0f} B{note}')
+        return 'Average value size: ' + ', '.join(parts)
@@ -0,0 +1,204 @@
+"""
+Failure journal for upload_kv.py (--failure-journal, --retry-failed).
+
+Failures used to pile up in a list for the whole run, of which the first
+20 were printed at the end. Now every failure is appended to an NDJSON
+journal as it happens, and the run keeps only a count and a SAMPLE_SIZE
+sample in memory:
+
+  {"key": "census_mesh_2020:362257353", "file": "/abs/tblT001101H36.txt",
+   "row": 1200, "offset": 101833, "line": 1202, "size": 284913,
+   "mtime_ns": 1700000000000000000, "reason": "PUT status 503 ...",
+   "at": "2024-05-01T12:00:00+09:00"}
+
+`row` is the row index in the file as the checkpoint counts it
+(kv_checkpoint.py), `offset` / `line` where the row starts, and `size` /
+`mtime_ns` the file as it was read, so a replay can tell whether the
+offsets still apply. Failures that do not come from one input row (a file
+that cannot be decoded, a shard, a bulk delete) have no row. Rows without
+a key_code are not journaled: they fail the same way on every run.
+
+--retry-failed reads the journal instead of the input directory. For
+each file it seeks straight to the journaled rows, checks that the row
+still holds the journaled key and sends only those rows through the usual
+pipeline. The journal is then replaced by what still fails: the rows that
+failed again, the entries of files that changed or are gone, and the
+entries without a row, which a replay cannot redo.
+
+A normal run appends to the journal an earlier run left and compacts it on
+close(): entries of rows that are done now (per the checkpoint), of files
+that changed since, and of files that failed as a whole but were read again
+are dropped, and only the latest entry of each row is kept. So a resume
+that sends the failed rows again leaves --retry-failed nothing to resend.
+"""
+
+import datetime
+import json
+import os
+from typing import Container, Dict, List, Optional, Tuple
+
+SAMPLE_SIZE = 20
+
+
+class FailureJournal:
+    """Failures of a run: a count and a sample in memory, every entry in the journal file.
+
+    With replace=True (a --retry-failed run) entries go to a temporary file
+    that takes the journal's place on close(); otherwise they are appended,
+    and an existing journal is compacted on close() against the inputs
+    passed to settle().
+    """
+
+    def __init__(self, path: Optional[str], replace: bool = False):
+        self.path = path
+        self.count = 0
+        self.journaled = 0
+        self.sample: List[Tuple[Optional[str], str]] = []
+        self._stat: Dict[str, Tuple[Optional[int], Optional[int]]] = {}
+        self._replace = replace
+        self._fh = None  # opened on the first entry, so a run without failures leaves no file behind
+        self.dropped = 0
+        # size of the journal an earlier run left: the entries before it are the old ones
+        self._start = os.path.getsize(path) if path and not replace and os.path.isfile(path) else None
+        self._settled: Dict[str, Optional[Container[int]]] = {}
+
+    def _file_stat(self, path: str) -> Tuple[Optional[int], Optional[int]]:
+        if path not in self._stat:
+            try:
+                st = os.stat(path)
+                self._stat[path] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                self._stat[path] = (None, None)
+        return self._stat[path]
+
+    def add(self, key: Optional[str], reason: str, path: Optional[str] = None, row: Optional[int] = None,
+            position: Optional[Tuple[int, int]] = None, journal: bool = True):
+        """One failure; position is the (byte offset, line number) where the row starts."""
+        self.count += 1
+        if len(self.sample) < SAMPLE_SIZE:
+            label = key
+            if label is None and row is None and path:
+                label = os.path.basename(path)  # the file as a whole failed
+            self.sample.append((label, reason))
+        if not self.path or not journal:
+            return
+        entry = {'key': key, 'file': os.path.abspath(path) if path else None, 'row': row,
+                 'offset': position[0] if position else None, 'line': position[1] if position else None}
+        if path:
+            entry['size'], entry['mtime_ns'] = self._file_stat(os.path.abspath(path))
+        entry['reason'] = reason
+        entry['at'] = datetime.datetime.now().astimezone().isoformat(timespec='seconds')
+        self._write(entry)
+
+    def settle(self, path: str, done: Optional[Container[int]] = None):
+        """An input this run went through, with the rows now done in it (None: all of them)."""
+        self._settled[os.path.abspath(path)] = done
+
+    def carry(self, entry: dict):
+        """Keep a journal entry that a replay did not redo."""
+        if self.path:
+            self._write(entry)
+
+    def _open(self):
+        if self._fh is None:
+            self._fh = open(self.path + '.tmp' if self._replace else self.path, 'w' if self._replace else 'a',
+                            encoding='utf-8', buffering=1)
+
+    def _write(self, entry: dict):
+        self._open()
+        self._fh.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.journaled += 1
+
+    def close(self):
+        if not self.path:
+            return
+        if self._replace:
+            self._open()  # nothing failed again: the journal is emptied
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if self._replace:
+            os.replace(self.path + '.tmp', self.path)
+            self._replace = False
+        elif self._start is not None:
+            self._compact()
+            self._start = None
+
+    def _compact(self):
+        with open(self.path, 'rb') as f:
+            old = f.read(self._start).splitlines()
+            new = f.read().splitlines()
+        entries = [(True, line) for line in old] + [(False, line) for line in new]
+        new_keys = set()
+        for _, line in entries[len(old):]:
+            entry = _parse(line)
+            if entry is not None and not entry.get('file'):
+                new_keys.add(entry.get('key'))
+        stats = {}
+        kept: Dict[tuple, dict] = {}
+        for n, (earlier, line) in enumerate(entries):
+            entry = _parse(line)
+            if entry is None:
+                continue  # a line cut short by a crash
+            path, row = entry.get('file'), entry.get('row')
+            if path in self._settled:
+                done = self._settled[path]
+                if row is not None and (done is None or row in done):
+                    continue
+                if earlier:
+                    if row is None:
+                        continue  # the file was read again: it failed again in this run or not at all
+                    if path not in stats:
+                        try:
+                            st = os.stat(path)
+                            stats[path] = (st.st_size, st.st_mtime_ns)
+                        except OSError:
+                            stats[path] = None
+                    if (entry.get('size'), entry.get('mtime_ns')) != stats[path]:
+                        continue  # written before the file changed; this run read the new one
+            elif earlier and not path and entry.get('key') in new_keys:
+                continue  # failed again in this run
+            slot = ('row', path, row) if path and row is not None else ('entry', n)
+            kept.pop(slot, None)  # the latest failure of a row wins
+            kept[slot] = entry
+        self.dropped = len(entries) - len(kept)
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            for entry in kept.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+        self.journaled = len(kept)
+
+
+def _parse(line) -> Optional[dict]:
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None
+    return entry if isinstance(entry, dict) else None
+
+def read_journal(path: str) -> Tuple[Dict[str, List[dict]], List[dict]]:
+    """({file: entries with a row, in row order, one per row}, entries that cannot be replayed)."""
+    by_file: Dict[str, Dict[int, dict]] = {}
+    other: List[dict] = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            entry = _parse(line)
+            if entry is None:
+                continue  # a line cut short by a crash
+            if entry.get('file') and entry.get('key') and entry.get('row') is not None and entry.get('offset') is not None:
+                by_file.setdefault(entry['file'], {})[entry['row']] = entry  # the latest failure of a row wins
+            else:
+                other.append(entry)
+    return {path: [rows[row] for row in sorted(rows)] for path, rows in by_file.items()}, other
+
+
+def split_stale(path: str, entries: List[dict]) -> Tuple[List[dict], List[dict]]:
+    """(entries whose offsets still apply, entries written before the file changed or vanished)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return [], entries
+    current, stale = [], []
+    for entry in entries:
+        (current if (entry.get('size'), entry.get('mtime_ns')) == (st.st_size, st.st_mtime_ns) else stale).append(entry)
+    return current, stale
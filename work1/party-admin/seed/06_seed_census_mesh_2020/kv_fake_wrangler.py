@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the `wrangler` KV commands upload_kv.py runs (--use-wrangler).
+
+Link it as `wrangler` on PATH and the uploader's wrangler path runs
+without Node.js or a Cloudflare account:
+
+  mkdir -p /tmp/fake-bin && ln -sf "$PWD/kv_fake_wrangler.py" /tmp/fake-bin/wrangler
+  PATH=/tmp/fake-bin:$PATH python upload_kv.py --use-wrangler --wrangler-namespace ns ...
+  python kv_fake_wrangler.py report          calls per command and keys per namespace
+
+Commands (the subset of wrangler 3 / 4 the uploader uses):
+
+  wrangler kv bulk put FILE --namespace-id NS       [{"key", "value", "base64"?}, ...]
+  wrangler kv bulk delete FILE --namespace-id NS    ["key", ...]
+  wrangler kv key list --namespace-id NS [--prefix P]
+  wrangler kv key get KEY --namespace-id NS
+
+Values live in a SQLite file, $FAKE_WRANGLER_DB (default fake_wrangler_kv.db
+in the temp directory), so they persist across the separate processes.
+$FAKE_WRANGLER_STARTUP adds that many seconds to every call (Node.js
+start-up of the real CLI is a few hundred ms). $FAKE_WRANGLER_REJECT is a
+comma separated list of keys: a bulk put holding any of them fails as a
+whole with exit status 1, as the real CLI does when the API rejects an
+entry. $FAKE_WRANGLER_DOWN=1 fails every call.
+"""
+
+import argparse
+import base64
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+
+def _connect() -> sqlite3.Connection:
+    path = os.environ.get('FAKE_WRANGLER_DB') or os.path.join(tempfile.gettempdir(), 'fake_wrangler_kv.db')
+    conn = sqlite3.connect(path, timeout=60)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS kv (
+            namespace TEXT NOT NULL,
+            key       TEXT NOT NULL,
+            value     BLOB NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS calls (command TEXT PRIMARY KEY, count INTEGER NOT NULL);
+    """)
+    return conn
+
+
+def _fail(message: str) -> int:
+    print(f'✘ [ERROR] {message}', file=sys.stderr)
+    return 1
+
+
+def bulk_put(conn: sqlite3.Connection, namespace: str, path: str) -> int:
+    with open(path, 'rb') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        return _fail('Unexpected JSON input from "' + path + '". Expected an array of key-value objects.')
+    rejected = {key for key in os.environ.get('FAKE_WRANGLER_REJECT', '').split(',') if key}
+    rows = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get('key'), str) or not isinstance(entry.get('value'), str):
+            return _fail(f'Unexpected JSON input from "{path}": every entry needs a string "key" and "value".')
+        if entry['key'] in rejected:
+            return _fail(f'A request to the Cloudflare API failed: invalid key {entry["key"]!r} [code: 10019]')
+        value = base64.b64decode(entry['value']) if entry.get('base64') else entry['value'].encode('utf-8')
+        rows.append((namespace, entry['key'], value))
+    conn.executemany('INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)', rows)
+    print('Success!')
+    return 0
+
+
+def bulk_delete(conn: sqlite3.Connection, namespace: str, path: str) -> int:
+    with open(path, 'rb') as f:
+        keys = json.load(f)
+    if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+        return _fail('Unexpected JSON input from "' + path + '". Expected an array of strings.')
+    conn.executemany('DELETE FROM kv WHERE namespace = ? AND key = ?', ((namespace, key) for key in keys))
+    print('Success!')
+    return 0
+
+
+def key_list(conn: sqlite3.Connection, namespace: str, prefix: str) -> int:
+    names = conn.execute('SELECT key FROM kv WHERE namespace = ? AND substr(key, 1, ?) = ? ORDER BY key',
+                         (namespace, len(prefix), prefix))
+    print(json.dumps([{'name': name} for name, in names]))
+    return 0
+
+
+def key_get(conn: sqlite3.Connection, namespace: str, key: str) -> int:
+    row = conn.execute('SELECT value FROM kv WHERE namespace = ? AND key = ?', (namespace, key)).fetchone()
+    if row is None:
+        print('Value not found', file=sys.stderr)
+        return 1
+    sys.stdout.buffer.write(row[0])
+    return 0
+
+
+def report(conn: sqlite3.Connection) -> int:
+    for command, count in conn.execute('SELECT command, count FROM calls ORDER BY command'):
+        print(f'{command}: {count} calls')
+    for namespace, count in conn.execute('SELECT namespace, COUNT(*) FROM kv GROUP BY namespace ORDER BY namespace'):
+        print(f'namespace {namespace}: {count} keys')
+    return 0
+
+
+def main() -> int:
+    argv = sys.argv[1:]
+    if argv[:1] == ['report']:
+        conn = _connect()
+        try:
+            return report(conn)
+        finally:
+            conn.close()
+    # `kv:bulk put` (wrangler 3) and `kv bulk put` (wrangler 3.60+, 4) name the same command
+    if argv and ':' in argv[0]:
+        argv = argv[0].split(':') + argv[1:]
+    parser = argparse.ArgumentParser(prog='wrangler')
+    parser.add_argument('group', choices=['kv'])
+    parser.add_argument('object', choices=['bulk', 'key'])
+    parser.add_argument('action', choices=['put', 'delete', 'list', 'get'])
+    parser.add_argument('target', nargs='?')
+    parser.add_argument('--namespace-id', required=True)
+    parser.add_argument('--prefix', default='')
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args(argv)
+
+    time.sleep(float(os.environ.get('FAKE_WRANGLER_STARTUP') or 0))
+    command = f'kv {args.object} {args.action}'
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute('INSERT INTO calls (command, count) VALUES (?, 1) '
+                         'ON CONFLICT (command) DO UPDATE SET count = count + 1', (command,))
+        if os.environ.get('FAKE_WRANGLER_DOWN') == '1':
+            return _fail('A request to the Cloudflare API failed: fetch failed')
+        with conn:
+            if command == 'kv bulk put' and args.target:
+                return bulk_put(conn, args.namespace_id, args.target)
+            if command == 'kv bulk delete' and args.target:
+                return bulk_delete(conn, args.namespace_id, args.target)
+            if command == 'kv key list':
+                return key_list(conn, args.namespace_id, args.prefix)
+            if command == 'kv key get' and args.target:
+                return key_get(conn, args.namespace_id, args.target)
+        return _fail(f'unsupported command: wrangler {" ".join(sys.argv[1:])}')
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
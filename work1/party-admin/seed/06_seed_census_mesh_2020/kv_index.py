@@ -0,0 +1,221 @@
+"""
+What is already in the KV namespace: existing keys and value hashes.
+
+--skip-existing used to send a GET (or spawn `wrangler kv key get`) for
+every row. Instead the uploader lists the namespace once under
+KV_KEY_PREFIX through the paginated list-keys endpoint (1000 names per
+request) and checks each row against a KeySet locally. Rows that already
+exist then cost no request at all.
+
+KeySet is exact and compact: census key codes are all digits, so their
+suffixes are kept as a sorted array of unsigned 64-bit ints (8 bytes per
+key, about 3.4 MB for the whole census) and looked up by bisection. Any
+other suffix goes into an ordinary set.
+
+HashIndex (--hash-index) goes further than existence: a local SQLite file
+maps each key this uploader wrote to an 8-byte hash of its value and the
+input file it came from, so a run sends only new or changed values and
+can tell which keys disappeared from their input (--delete-missing).
+"""
+
+import bisect
+import hashlib
+import json
+import sqlite3
+import subprocess
+import time
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import requests
+
+from kv_metrics import Metrics
+from kv_rate import retry_delay
+
+LIST_PAGE_LIMIT = 1000
+
+
+class KeySet:
+    """Membership of full KV keys under `prefix`; names outside the prefix are ignored."""
+
+    def __init__(self, prefix: str = '', names: Iterable[str] = ()):
+        self.prefix = prefix
+        self._numbers = array('Q')
+        self._others = set()
+        self._sorted = True
+        for name in names:
+            self.add(name)
+
+    @staticmethod
+    def _as_number(suffix: str) -> Optional[int]:
+        # only canonical digit strings, so '0123' and '123' stay distinct
+        if suffix.isdigit() and suffix.isascii() and (suffix == '0' or suffix[0] != '0') and len(suffix) < 20:
+            return int(suffix)
+        return None
+
+    def add(self, name: str):
+        if not name.startswith(self.prefix):
+            return
+        suffix = name[len(self.prefix):]
+        number = self._as_number(suffix)
+        if number is None:
+            self._others.add(suffix)
+            return
+        if self._numbers and number < self._numbers[-1]:
+            self._sorted = False
+        self._numbers.append(number)
+
+    def _ensure_sorted(self):
+        if not self._sorted:
+            self._numbers = array('Q', sorted(set(self._numbers)))
+            self._sorted = True
+
+    def __contains__(self, key: str) -> bool:
+        if not key.startswith(self.prefix):
+            return False
+        suffix = key[len(self.prefix):]
+        number = self._as_number(suffix)
+        if number is None:
+            return suffix in self._others
+        self._ensure_sorted()
+        i = bisect.bisect_left(self._numbers, number)
+        return i < len(self._numbers) and self._numbers[i] == number
+
+    def __len__(self) -> int:
+        self._ensure_sorted()
+        return len(self._numbers) + len(self._others)
+
+    def memory_bytes(self) -> int:
+        """Approximate size of the stored keys."""
+        return self._numbers.itemsize * len(self._numbers) + sum(len(s) + 49 for s in self._others)
+
+
+def list_keys(keys_url: str, headers: dict, prefix: str = '', retries: int = 3,
+              session: Optional[requests.Session] = None, stats: Optional[dict] = None,
+              metrics: Optional[Metrics] = None) -> Iterator[str]:
+    """Names under `prefix`, following result_info.cursor page by page (GET {namespace}/keys)."""
+    session = session or requests.Session()
+    cursor = None
+    while True:
+        params = {'limit': LIST_PAGE_LIMIT}
+        if prefix:
+            params['prefix'] = prefix
+        if cursor:
+            params['cursor'] = cursor
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                resp = session.get(keys_url, headers=headers, params=params, timeout=60)
+                if stats is not None:
+                    stats['requests'] = stats.get('requests', 0) + 1
+                error = None if resp.status_code == 200 else f'status {resp.status_code} body={resp.text[:200]}'
+            except requests.RequestException as e:
+                resp = None
+                error = str(e)
+            if metrics is not None:
+                metrics.request('list', resp.status_code if resp is not None else None, time.monotonic() - started,
+                                retry=attempt > 0)
+            if error is None:
+                break
+            attempt += 1
+            if attempt > retries:
+                raise RuntimeError(f'listing keys failed: {error}')
+            delay = retry_delay(attempt, resp.headers if resp is not None else None)
+            if metrics is not None:
+                metrics.waited(delay)
+            time.sleep(delay)
+        data = resp.json()
+        for entry in data.get('result') or ():
+            yield entry['name']
+        cursor = (data.get('result_info') or {}).get('cursor')
+        if not cursor:
+            return
+
+
+def wrangler_list_keys(ns: str, prefix: str = '') -> Iterator[str]:
+    """Names from `wrangler kv key list` (wrangler follows the cursor itself)."""
+    cmd = ['wrangler', 'kv', 'key', 'list', '--namespace-id', ns]
+    if prefix:
+        cmd += ['--prefix', prefix]
+    p = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
+    if p.returncode != 0:
+        raise RuntimeError(f'wrangler kv key list failed: {p.stderr.strip()[:200]}')
+    for entry in json.loads(p.stdout or '[]'):
+        yield entry['name']
+
+
+def value_hash(payload: bytes) -> bytes:
+    """8-byte digest of a stored value (collisions are negligible at census scale)."""
+    return hashlib.blake2b(payload, digest_size=8).digest()
+
+
+class HashIndex:
+    """SQLite record of what this uploader last wrote: key -> value hash and the input file it came from.
+
+    A row whose payload hashes to the recorded value is unchanged and not
+    sent again. `target` names the namespace (or output) the hashes describe;
+    an index written for another target is cleared on open, since its
+    hashes say nothing about this one. Writes are staged and flushed in
+    batches; losing unflushed entries only means re-uploading those rows.
+    """
+
+    FLUSH_EVERY = 10_000
+
+    def __init__(self, path: str, target: dict):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS kv_hash (
+                key    TEXT PRIMARY KEY,
+                hash   BLOB NOT NULL,
+                source TEXT NOT NULL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_kv_hash_source ON kv_hash (source);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+        target_json = json.dumps(target, sort_keys=True)
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'target'").fetchone()
+        if row is None or row[0] != target_json:
+            self.conn.execute('DELETE FROM kv_hash')
+            self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('target', ?)", (target_json,))
+            self.conn.commit()
+        self._staged = []
+
+    def load_source(self, source: str) -> Dict[str, bytes]:
+        """key -> hash for the keys last written from input file `source`."""
+        return dict(self.conn.execute('SELECT key, hash FROM kv_hash WHERE source = ?', (source,)))
+
+    def lookup(self, key: str) -> Optional[bytes]:
+        row = self.conn.execute('SELECT hash FROM kv_hash WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def source_of(self, key: str) -> Optional[str]:
+        row = self.conn.execute('SELECT source FROM kv_hash WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def stage(self, key: str, digest: bytes, source: str):
+        self._staged.append((key, digest, source))
+        if len(self._staged) >= self.FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        if self._staged:
+            self.conn.executemany('INSERT OR REPLACE INTO kv_hash (key, hash, source) VALUES (?, ?, ?)', self._staged)
+            self._staged = []
+        self.conn.commit()
+
+    def sources(self) -> List[str]:
+        return [row[0] for row in self.conn.execute('SELECT DISTINCT source FROM kv_hash')]
+
+    def forget(self, keys: Iterable[str]):
+        self.flush()
+        self.conn.executemany('DELETE FROM kv_hash WHERE key = ?', ((key,) for key in keys))
+        self.conn.commit()
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM kv_hash').fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,222 @@
+"""
+Throughput and latency instrumentation for upload_kv.py.
+
+  LatencyHistogram   log-scale buckets (two per doubling, 1 us .. ~1000 s); count,
+                     sum, min, max and bucket-resolution percentiles
+  Metrics            per request kind (PUT, GET, bulk, wrangler, list): attempts,
+                     retries, status code breakdown, latency histogram and bytes
+                     sent; the time spent waiting before retries
+  ThroughputReporter background thread logging rows/s, bytes/s and an ETA from
+                     the share of the input read so far every `interval` seconds
+
+The network paths take a Metrics the same way they take an AdaptiveLimiter
+(kv_rate.py): process_single items carry it as item['metrics'], the async
+client, BulkWriter and WranglerBulkWriter get it at construction. Every
+attempt is recorded, so retries and throttling show up in the status
+breakdown rather than only in the final result. The read / encode stages
+are timed per row by StageCounters (kv_pipeline.py), which keeps its own
+histograms.
+
+upload_kv.py --metrics-file writes Metrics.to_json(), the stage counters
+and the options that shape throughput as one JSON report at the end of a
+run, so runs with different --parallel, --async-requests or batch sizes
+can be compared side by side.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+HISTOGRAM_MIN_SECONDS = 1e-6
+HISTOGRAM_BUCKETS = 62  # two per doubling: 1 us * 2**31 ~ 36 min
+
+
+class LatencyHistogram:
+    """Durations in seconds, bucketed by half powers of two above HISTOGRAM_MIN_SECONDS."""
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    @staticmethod
+    def _bucket(seconds: float) -> int:
+        if seconds <= HISTOGRAM_MIN_SECONDS:
+            return 0
+        mantissa, exponent = math.frexp(seconds / HISTOGRAM_MIN_SECONDS)  # value = mantissa * 2**exponent, mantissa in [0.5, 1)
+        return min(HISTOGRAM_BUCKETS - 1, 2 * (exponent - 1) + (mantissa > 0.7071067811865476))
+
+    @staticmethod
+    def upper_bound(bucket: int) -> float:
+        return HISTOGRAM_MIN_SECONDS * 2 ** ((bucket + 1) / 2)
+
+    def add(self, seconds: float, count: int = 1):
+        self.counts[self._bucket(seconds)] += count
+        self.count += count
+        self.sum += seconds * count
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile (capped at the largest value seen)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+    def to_json(self) -> dict:
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_ms': round(1000 * self.sum / self.count, 4),
+            'min_ms': round(1000 * self.min, 4),
+            'p50_ms': round(1000 * self.percentile(0.5), 4),
+            'p90_ms': round(1000 * self.percentile(0.9), 4),
+            'p99_ms': round(1000 * self.percentile(0.99), 4),
+            'max_ms': round(1000 * self.max, 4),
+            'buckets': [{'le_ms': round(1000 * self.upper_bound(b), 4), 'count': n} for b, n in enumerate(self.counts) if n],
+        }
+
+    def summary(self) -> str:
+        if not self.count:
+            return 'no samples'
+        return (f'p50 {1000 * self.percentile(0.5):.1f} ms, p90 {1000 * self.percentile(0.9):.1f} ms, '
+                f'p99 {1000 * self.percentile(0.99):.1f} ms, max {1000 * self.max:.1f} ms')
+
+
+class _RequestKind:
+    def __init__(self):
+        self.attempts = 0
+        self.retries = 0
+        self.bytes = 0
+        self.statuses: Dict[str, int] = {}
+        self.latency = LatencyHistogram()
+
+
+class Metrics:
+    """Request attempts per kind, shared by worker threads and the event loop."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.kinds: Dict[str, _RequestKind] = {}
+        self.retry_wait = LatencyHistogram()
+        self.bytes_sent = 0
+        self.started = time.monotonic()
+
+    def request(self, kind: str, status, seconds: float, nbytes: int = 0, retry: bool = False):
+        """One attempt; status is an HTTP status, a label such as 'exit 1', or None for no response."""
+        label = 'error' if status is None else str(status)
+        with self._lock:
+            stats = self.kinds.get(kind)
+            if stats is None:
+                stats = self.kinds[kind] = _RequestKind()
+            stats.attempts += 1
+            stats.retries += retry
+            stats.bytes += nbytes
+            stats.statuses[label] = stats.statuses.get(label, 0) + 1
+            stats.latency.add(seconds)
+            self.bytes_sent += nbytes
+
+    def waited(self, seconds: float):
+        """Sleep before a retry (backoff or Retry-After)."""
+        with self._lock:
+            self.retry_wait.add(seconds)
+
+    def to_json(self) -> dict:
+        with self._lock:
+            return {
+                'bytes_sent': self.bytes_sent,
+                'requests': {kind: {'attempts': s.attempts, 'retries': s.retries, 'bytes': s.bytes,
+                                    'status': dict(sorted(s.statuses.items())), 'latency': s.latency.to_json()}
+                             for kind, s in sorted(self.kinds.items())},
+                'retry_wait': self.retry_wait.to_json(),
+            }
+
+    def summary(self) -> str:
+        with self._lock:
+            lines = []
+            for kind, s in sorted(self.kinds.items()):
+                statuses = ', '.join(f'{label}: {n}' for label, n in sorted(s.statuses.items()))
+                lines.append(f'Requests {kind}: {s.attempts} attempts ({s.retries} retries; {statuses}), '
+                             f'latency {s.latency.summary()}')
+            if self.retry_wait.count:
+                lines.append(f'Retry waits: {self.retry_wait.count}, {self.retry_wait.sum:.1f}s in total')
+            return '\n'.join(lines) or 'Requests: none'
+
+
+def _duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class ThroughputReporter:
+    """Logs a throughput line every `interval` seconds from a background thread.
+
+    snapshot() returns (rows finished, input bytes read, input bytes in total);
+    rates are over the last interval, the ETA over the whole run so far.
+    """
+
+    def __init__(self, metrics: Metrics, snapshot: Callable[[], Tuple[int, int, int]], log: Callable[[str], None],
+                 interval: float = 10.0):
+        self.metrics = metrics
+        self.snapshot = snapshot
+        self.log = log
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='throughput', daemon=True)
+        self._started = time.monotonic()
+        self._first_position: Optional[int] = None
+        self._last = (self._started, 0, 0)  # (time, rows, bytes sent)
+
+    def start(self):
+        self._started = time.monotonic()
+        self._first_position = self.snapshot()[1]
+        self._last = (self._started, 0, 0)
+        if self.interval > 0:
+            self._thread.start()
+
+    def line(self) -> str:
+        now = time.monotonic()
+        rows, position, input_total = self.snapshot()
+        sent = self.metrics.bytes_sent
+        if self._first_position is None:
+            self._first_position = 0
+        then, rows_then, sent_then = self._last
+        self._last = (now, rows, sent)
+        span = max(now - then, 1e-9)
+        text = (f'Throughput: {rows:,} rows ({(rows - rows_then) / span:,.0f} rows/s), '
+                f'{sent / 1e6:,.1f} MB sent ({(sent - sent_then) / span / 1e6:,.2f} MB/s)')
+        if input_total:
+            text += f', input {100 * position / input_total:.1f}%'
+            read = position - self._first_position
+            if 0 < read and position < input_total:
+                text += f', ETA {_duration((input_total - position) * (now - self._started) / read)}'
+        return text
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.log(self.line())
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+def write_report(path: str, report: dict):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+        f.write('\n')
+    os.replace(tmp, path)
@@ -0,0 +1,214 @@
+"""
+Row encoding stage for upload_kv.py, optionally in worker processes (--encode-workers).
+
+The uploader is a three stage pipeline on its main thread:
+
+  read     CSV decode and split (seed_io.open_csv_stream)
+  encode   key cleanup, CompiledSchema.json_object and the value encoding
+  upload   the bulk / asyncio / --parallel network paths
+
+With the network paths running many requests at once, encode becomes the
+GIL-bound ceiling. EncodePool moves it into a process pool: the main
+thread cuts the rows it reads into chunks of `chunk_rows`, keeps up to
+2 x workers chunks in progress and takes the results back in input
+order, so row indexes, checkpoints and the rest of the accounting are the
+same as with encode_rows() on the main thread. The key_code is cleaned on
+the main thread, so rows the caller does not want (already in KV) are
+never sent to a worker or encoded.
+
+StageCounters records rows and busy seconds per stage, and a latency
+histogram (kv_metrics.py) of the per-row read and encode times; summary()
+names the stage with the lowest throughput as the bottleneck.
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from census_schema import CompiledSchema, json_text_value  # noqa: E402
+from kv_encoding import EncodingStats, ValueEncoder, other_sizes  # noqa: E402
+from kv_metrics import LatencyHistogram  # noqa: E402
+
+DEFAULT_CHUNK_ROWS = 500
+
+# (row index, cleaned key_code or None, value bytes or None, sampled sizes in the other encodings or None);
+# the value is None for a row without a key and for a key the caller did not want
+EncodedRow = Tuple[int, Optional[str], Optional[bytes], Optional[Dict[str, int]]]
+
+
+class StageCounters:
+    """Rows and busy seconds per pipeline stage, with per-row latencies of read and encode."""
+
+    STAGES = ('read', 'encode', 'upload')
+
+    def __init__(self, encode_workers: int = 0):
+        self.encode_workers = encode_workers
+        self.rows = {stage: 0 for stage in self.STAGES}
+        self.seconds = {stage: 0.0 for stage in self.STAGES}
+        self.latency = {'read': LatencyHistogram(), 'encode': LatencyHistogram()}
+        self.encode_wait = 0.0  # main thread blocked on worker results
+        self.producing = 0.0  # main thread time spent reading and encoding (or waiting for encoded rows)
+
+    def add(self, stage: str, rows: int, seconds: float):
+        self.rows[stage] += rows
+        self.seconds[stage] += seconds
+
+    def encoded(self, seconds: float):
+        """One row encoded on the main thread."""
+        self.add('encode', 1, seconds)
+        self.latency['encode'].add(seconds)
+        self.producing += seconds
+
+    def rate(self, stage: str) -> Optional[float]:
+        """Rows per second of busy time; encode counts its workers as running side by side."""
+        seconds = self.seconds[stage]
+        if not self.rows[stage] or seconds <= 0:
+            return None
+        if stage == 'encode' and self.encode_workers:
+            seconds /= self.encode_workers
+        return self.rows[stage] / seconds
+
+    def summary(self) -> str:
+        parts = []
+        for stage in self.STAGES:
+            rate = self.rate(stage)
+            if rate is None:
+                continue
+            where = f' CPU on {self.encode_workers} workers' if stage == 'encode' and self.encode_workers else ''
+            parts.append(f'{stage} {self.rows[stage]} rows in {self.seconds[stage]:.2f}s{where} ({rate:,.0f} rows/s)')
+        rates = {stage: self.rate(stage) for stage in self.STAGES if self.rate(stage) is not None}
+        line = 'Stage throughput: ' + ', '.join(parts)
+        if self.encode_workers:
+            line += f'; waited {self.encode_wait:.2f}s for encoded rows'
+        if len(rates) > 1:
+            line += f' -> bottleneck: {min(rates, key=rates.get)}'
+        return line
+
+    def to_json(self) -> dict:
+        return {stage: {'rows': self.rows[stage], 'seconds': round(self.seconds[stage], 4), 'rows_per_s': round(self.rate(stage), 1) if self.rate(stage) else None,
+                        **({'latency': self.latency[stage].to_json()} if stage in self.latency else {})}
+                for stage in self.STAGES}
+
+
+def timed_rows(rows: Iterable[Tuple[int, Sequence[str]]], stages: StageCounters) -> Iterator[Tuple[int, Sequence[str]]]:
+    """Rows from `rows`, with the time spent producing them counted as the read stage."""
+    rows = iter(rows)
+    while True:
+        started = time.perf_counter()
+        row = next(rows, None)
+        elapsed = time.perf_counter() - started
+        stages.seconds['read'] += elapsed
+        stages.producing += elapsed
+        if row is None:
+            return
+        stages.rows['read'] += 1
+        stages.latency['read'].add(elapsed)
+        yield row
+
+
+def _keyed_rows(rows: Iterable[Tuple[int, Sequence[str]]], key_index: int, stages: StageCounters,
+                wanted: Optional[Callable[[str], bool]]) -> Iterator[Tuple[int, Optional[str], Optional[Sequence[str]]]]:
+    """(idx, key, row); row is None when there is nothing to encode."""
+    for idx, row in timed_rows(rows, stages):
+        key = json_text_value(row[key_index] if key_index < len(row) else None)
+        if key is None or (wanted is not None and not wanted(key)):
+            yield idx, key, None
+        else:
+            yield idx, key, row
+
+
+def _encode_one(idx: int, key: Optional[str], row: Optional[Sequence[str]], schema: CompiledSchema,
+                encoder: ValueEncoder) -> EncodedRow:
+    if row is None:
+        return idx, key, None, None
+    obj = schema.json_object(row)
+    others = other_sizes(obj, encoder.encoding) if idx % EncodingStats.SAMPLE_EVERY == 0 else None
+    return idx, key, encoder.encode(obj), others
+
+
+def encode_rows(rows: Iterable[Tuple[int, Sequence[str]]], schema: CompiledSchema, encoder: ValueEncoder,
+                key_index: int, stages: StageCounters,
+                wanted: Optional[Callable[[str], bool]] = None) -> Iterator[EncodedRow]:
+    """Encode (row index, row) pairs on the calling thread; keys failing wanted() are not encoded."""
+    for idx, key, row in _keyed_rows(rows, key_index, stages, wanted):
+        if row is None:
+            yield idx, key, None, None
+            continue
+        started = time.perf_counter()
+        encoded = _encode_one(idx, key, row, schema, encoder)
+        stages.encoded(time.perf_counter() - started)
+        yield encoded
+
+
+_worker_schemas: Dict[tuple, Tuple[CompiledSchema, ValueEncoder]] = {}
+
+
+def _encode_chunk(header: Tuple[str, ...], to_array_htksaki: bool, encoding: str,
+                  chunk: List[Tuple[int, Optional[str], Optional[Sequence[str]]]]) -> Tuple[List[EncodedRow], float]:
+    """Worker side: (encoded rows, CPU seconds); the compiled schema is kept per header."""
+    started = time.process_time()
+    cache_key = (header, to_array_htksaki, encoding)
+    compiled = _worker_schemas.get(cache_key)
+    if compiled is None:
+        schema = CompiledSchema(header, to_array_htksaki=to_array_htksaki)
+        compiled = _worker_schemas[cache_key] = (schema, ValueEncoder(encoding, schema.json_keys))
+    schema, encoder = compiled
+    encoded = [_encode_one(idx, key, row, schema, encoder) for idx, key, row in chunk]
+    return encoded, time.process_time() - started
+
+
+class EncodePool:
+    """Process pool for the encode stage, shared by every file of a run.
+
+    Workers are started with `spawn`, so forking a process that already
+    runs upload threads or an event loop is never an issue.
+    """
+
+    def __init__(self, workers: int, chunk_rows: int = DEFAULT_CHUNK_ROWS):
+        self.workers = max(1, workers)
+        self.chunk_rows = max(1, chunk_rows)
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def encode(self, rows: Iterable[Tuple[int, Sequence[str]]], schema: CompiledSchema, encoder: ValueEncoder,
+               key_index: int, stages: StageCounters,
+               wanted: Optional[Callable[[str], bool]] = None) -> Iterator[EncodedRow]:
+        """Same results as encode_rows(), in input order."""
+        header = tuple(schema.header)
+        pending = deque()
+        chunk: List[Tuple[int, Optional[str], Optional[Sequence[str]]]] = []
+
+        def submit():
+            nonlocal chunk
+            pending.append(self.executor.submit(_encode_chunk, header, schema.to_array_htksaki, encoder.encoding, chunk))
+            chunk = []
+
+        def collect():
+            started = time.perf_counter()
+            encoded, cpu_seconds = pending.popleft().result()
+            waited = time.perf_counter() - started
+            stages.encode_wait += waited
+            stages.producing += waited
+            rows = sum(1 for _, _, payload, _ in encoded if payload is not None)
+            stages.add('encode', rows, cpu_seconds)
+            if rows:
+                stages.latency['encode'].add(cpu_seconds / rows, rows)  # per-row CPU time, averaged over the chunk
+            return encoded
+
+        for entry in _keyed_rows(rows, key_index, stages, wanted):
+            chunk.append(entry)
+            if len(chunk) >= self.chunk_rows:
+                submit()
+                if len(pending) >= 2 * self.workers:
+                    yield from collect()
+        if chunk:
+            submit()
+        while pending:
+            yield from collect()
+
+    def close(self):
+        self.executor.shutdown()
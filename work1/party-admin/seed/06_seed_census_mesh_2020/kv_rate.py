@@ -0,0 +1,124 @@
+"""
+Adaptive concurrency for upload_kv.py (--adaptive).
+
+AdaptiveLimiter is an AIMD controller over the number of requests in
+flight. Every healthy response raises the limit by 1/limit, so about one
+more request per round trip. A 429 or 5xx, or a latency spike (the
+smoothed latency rising to LATENCY_SPIKE_FACTOR x the best seen so far),
+cuts it multiplicatively. Only one cut is made per cooldown of about one
+round trip, so a burst of 429s from the same window counts as a single
+signal. A Retry-After header pauses every sender until it has passed.
+
+The --parallel and --async-requests paths size their window from
+`limiter.limit`; request retries sleep for Retry-After when the server
+sends one (retry_delay), otherwise for the usual exponential backoff.
+"""
+
+import email.utils
+import threading
+import time
+from typing import Callable, Optional
+
+LATENCY_SPIKE_FACTOR = 3.0
+MAX_RETRY_AFTER = 300.0
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After as seconds from now (delta-seconds or an HTTP date), or None."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return min(float(value), MAX_RETRY_AFTER)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    return min(max(0.0, when.timestamp() - time.time()), MAX_RETRY_AFTER)
+
+
+def retry_delay(attempt: int, headers=None) -> float:
+    """Seconds to wait before retry `attempt` (1-based): Retry-After if given, else 0.5 * 2**(attempt-1)."""
+    retry_after = parse_retry_after(headers.get('retry-after') if headers is not None else None)
+    if retry_after is not None:
+        return retry_after
+    return (2 ** (attempt - 1)) * 0.5
+
+
+def is_throttle(status: Optional[int]) -> bool:
+    return status is not None and (status == 429 or status >= 500)
+
+
+class AdaptiveLimiter:
+    """AIMD limit on requests in flight, shared by the worker threads or the event loop."""
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 256,
+                 on_change: Optional[Callable[[str], None]] = None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self._limit = float(min(max(initial, self.minimum), self.maximum))
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self._last_cut = 0.0
+        self._latency = None  # EWMA of response latency
+        self._best_latency = None
+        self.peak = self._limit
+        self.cuts = 0
+        self.throttled = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def record(self, status: Optional[int], latency: float, headers=None):
+        """Feed one response (status None = no response)."""
+        now = time.monotonic()
+        with self._lock:
+            retry_after = parse_retry_after(headers.get('retry-after') if headers is not None else None)
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            if status is None or is_throttle(status):
+                if status is not None:
+                    self.throttled += 1
+                self._cut(now, 0.5, f'status {status}' if status is not None else 'no response')
+                return
+            self._latency = latency if self._latency is None else 0.9 * self._latency + 0.1 * latency
+            if self._best_latency is None or self._latency < self._best_latency:
+                self._best_latency = self._latency
+            if self._latency > LATENCY_SPIKE_FACTOR * self._best_latency:
+                self._cut(now, 0.8, f'latency {self._latency * 1000:.0f} ms vs best {self._best_latency * 1000:.0f} ms')
+                return
+            self._limit = min(self.maximum, self._limit + 1.0 / self._limit)
+            self.peak = max(self.peak, self._limit)
+
+    def _cut(self, now: float, factor: float, reason: str):
+        cooldown = max(0.1, self._latency or 0.0)
+        if now - self._last_cut < cooldown:
+            return
+        self._last_cut = now
+        before = self.limit
+        self._limit = max(float(self.minimum), self._limit * factor)
+        self.cuts += 1
+        if self._latency is not None and self._best_latency is not None:
+            # the backlog that caused a spike drains after the cut; judge the next window on its own
+            self._best_latency = min(self._latency, self._best_latency * 1.5)
+        if self.on_change is not None and self.limit != before:
+            self.on_change(f'Concurrency limit {before} -> {self.limit} ({reason})')
+
+    def pause_remaining(self) -> float:
+        return max(0.0, self._paused_until - time.monotonic())
+
+    def wait(self):
+        """Block the calling thread while a Retry-After pause is in effect."""
+        remaining = self.pause_remaining()
+        while remaining > 0:
+            time.sleep(remaining)
+            remaining = self.pause_remaining()
+
+    def summary(self) -> str:
+        latency = f', latency ~{self._latency * 1000:.0f} ms' if self._latency is not None else ''
+        return (f'Concurrency limit settled at {self.limit} (peak {int(self.peak)}, range {self.minimum}-{self.maximum}); '
+                f'{self.cuts} cuts, {self.throttled} throttled responses{latency}')
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Sharded KV layout for the census meshes (upload_kv.py --layout shard).
+
+Instead of one KV entry per mesh, all meshes whose key_code starts with
+the same prefix (default 6 digits = 2nd level mesh, up to ~400 meshes)
+are packed into one value under SHARD_KEY_PREFIX + prefix. A 2nd level
+mesh is one read for a neighbourhood query and ~100x fewer writes to
+load the data.
+
+Shard value (bytes):
+
+  {"v":1,"prefix":"523973","keys":["001","002",...],"offsets":[0,812,...]}\n
+  <value of 523973001><value of 523973002>...
+
+The first line is the index: key_code suffixes in ascending order and n+1
+byte offsets into the body that follows the newline, so value i is
+body[offsets[i]:offsets[i+1]] (the same bytes a per-mesh entry holds, in
+any --value-encoding). A reader parses only the index line and the one
+value it needs.
+
+2nd level meshes cross prefecture borders, so a shard can only be built
+after every input file was read. ShardBuilder spools the rows into a
+temporary SQLite file and returns them grouped by prefix, keeping memory
+flat.
+
+  python kv_shard.py verify --indir census_mesh_2020_data      local round trip of every mesh
+                         [--value-encoding array|binary]
+  python kv_shard.py get 523973001 [--api-base URL]            read one mesh through its shard in KV
+"""
+
+import argparse
+import bisect
+import glob
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from kv_encoding import VALUE_ENCODINGS, ValueEncoder, decode_value, schema_descriptor, schema_key
+
+SHARD_KEY_PREFIX = 'census_mesh_2020_shard:'
+SHARD_FORMAT_VERSION = 1
+DEFAULT_SHARD_PREFIX_LEN = 6  # 2nd level mesh
+
+
+def encode_shard(prefix: str, entries: List[Tuple[str, bytes]]) -> bytes:
+    """entries: (key_code, value) sorted by key_code, all starting with prefix."""
+    offsets = [0]
+    for _, value in entries:
+        offsets.append(offsets[-1] + len(value))
+    index = {'v': SHARD_FORMAT_VERSION, 'prefix': prefix,
+             'keys': [key[len(prefix):] for key, _ in entries], 'offsets': offsets}
+    return json.dumps(index, separators=(',', ':')).encode('utf-8') + b'\n' + b''.join(value for _, value in entries)
+
+
+class ShardReader:
+    """Resolve single meshes from one shard value."""
+
+    def __init__(self, blob: bytes):
+        newline = blob.index(b'\n')
+        index = json.loads(blob[:newline])
+        if index.get('v') != SHARD_FORMAT_VERSION:
+            raise ValueError(f"unsupported shard format {index.get('v')!r}")
+        self.prefix: str = index['prefix']
+        self.suffixes: List[str] = index['keys']
+        self.offsets: List[int] = index['offsets']
+        self._body = memoryview(blob)[newline + 1:]
+
+    def keys(self) -> List[str]:
+        return [self.prefix + suffix for suffix in self.suffixes]
+
+    def raw(self, key_code: str) -> Optional[bytes]:
+        if not key_code.startswith(self.prefix):
+            return None
+        suffix = key_code[len(self.prefix):]
+        i = bisect.bisect_left(self.suffixes, suffix)
+        if i == len(self.suffixes) or self.suffixes[i] != suffix:
+            return None
+        return bytes(self._body[self.offsets[i]:self.offsets[i + 1]])
+
+    def get(self, key_code: str, descriptors: Optional[Dict[int, dict]] = None) -> Optional[dict]:
+        """The mesh object; descriptors (version -> schema descriptor) decode array / binary values."""
+        value = self.raw(key_code)
+        return None if value is None else decode_value(value, descriptors)
+
+
+class ShardBuilder:
+    """Collect (key_code, value) pairs on disk and hand them back shard by shard.
+
+    A key_code added twice keeps the later value, as a second PUT of the
+    same KV key would.
+    """
+
+    def __init__(self, prefix_len: int = DEFAULT_SHARD_PREFIX_LEN, tmp_dir: Optional[str] = None):
+        self.prefix_len = prefix_len
+        fd, self.path = tempfile.mkstemp(prefix='census_shards_', suffix='.db', dir=tmp_dir)
+        os.close(fd)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=OFF')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('CREATE TABLE rows (key_code TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID')
+        self._pending: List[Tuple[str, bytes]] = []
+
+    def add(self, key_code: str, value: bytes):
+        self._pending.append((key_code, value))
+        if len(self._pending) >= 10_000:
+            self._flush()
+
+    def _flush(self):
+        self.conn.executemany('INSERT OR REPLACE INTO rows (key_code, value) VALUES (?, ?)', self._pending)
+        self._pending = []
+
+    def shards(self) -> Iterator[Tuple[str, List[Tuple[str, bytes]]]]:
+        """(prefix, [(key_code, value), ...]) in prefix order."""
+        self._flush()
+        prefix = None
+        entries: List[Tuple[str, bytes]] = []
+        for key_code, value in self.conn.execute('SELECT key_code, value FROM rows ORDER BY key_code'):
+            p = key_code[:self.prefix_len]
+            if p != prefix and entries:
+                yield prefix, entries
+                entries = []
+            prefix = p
+            entries.append((key_code, value))
+        if entries:
+            yield prefix, entries
+
+    def close(self):
+        self.conn.close()
+        os.remove(self.path)
+
+
+def _load_rows(indir: str) -> Iterator[Tuple[str, dict]]:
+    """(key_code, JSON object) for every keyed row, as upload_kv.py builds them."""
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from seed_io import ENCODINGS, open_csv_stream
+    from census_schema import CompiledSchema
+    from upload_kv import clean_raw_value, find_key_field
+
+    for path in sorted(p for p in glob.glob(os.path.join(indir, '*')) if os.path.isfile(p)):
+        reader = open_csv_stream(path, encodings=ENCODINGS)
+        try:
+            header = reader.header
+            schema = CompiledSchema(header)
+            key_field = find_key_field(header)
+            key_index = len(header) - 1 - header[::-1].index(key_field)
+            for row in reader:
+                key = clean_raw_value(row[key_index]) if row and key_index < len(row) else None
+                if key is not None:
+                    yield key, schema.json_object(row)
+        finally:
+            reader.close()
+
+
+def verify(indir: str, prefix_len: int, encoding: str = 'json') -> int:
+    builder = ShardBuilder(prefix_len)
+    descriptor = schema_descriptor()
+    descriptors = {descriptor['version']: descriptor}
+    expected: Dict[str, dict] = {}
+    encoder = None
+    try:
+        for key, obj in _load_rows(indir):
+            encoder = encoder or ValueEncoder(encoding, list(obj))
+            builder.add(key, encoder.encode(obj))
+            expected[key] = obj
+        shards = meshes = largest = 0
+        for prefix, entries in builder.shards():
+            blob = encode_shard(prefix, entries)
+            reader = ShardReader(blob)
+            for key in reader.keys():
+                if reader.get(key, descriptors) != expected[key]:
+                    print(f'MISMATCH {key} in shard {prefix}', file=sys.stderr)
+                    return 1
+            meshes += len(entries)
+            shards += 1
+            largest = max(largest, len(blob))
+    finally:
+        builder.close()
+    if meshes != len(expected):
+        print(f'MISMATCH: {len(expected)} meshes read, {meshes} in shards', file=sys.stderr)
+        return 1
+    print(f'OK: {meshes} {encoding} meshes round-trip through {shards} shards '
+          f'(prefix length {prefix_len}, {meshes / max(1, shards):.0f} meshes per shard, largest {largest:,} bytes)')
+    return 0
+
+
+def fetch(key_code: str, api_base: str, prefix_len: int) -> int:
+    import requests
+
+    account_id = os.environ.get('CF_ACCOUNT_ID')
+    namespace_id = os.environ.get('CF_NAMESPACE_ID')
+    api_token = os.environ.get('CF_API_TOKEN')
+    if not (account_id and namespace_id and api_token):
+        print('ERROR: CF_ACCOUNT_ID, CF_NAMESPACE_ID, CF_API_TOKEN must be set', file=sys.stderr)
+        return 1
+    values_url = f'{api_base.rstrip("/")}/accounts/{account_id}/storage/kv/namespaces/{namespace_id}/values/'
+    auth = {'Authorization': f'Bearer {api_token}'}
+    shard_key = SHARD_KEY_PREFIX + key_code[:prefix_len]
+    resp = requests.get(values_url + requests.utils.requote_uri(shard_key), headers=auth, timeout=30)
+    if resp.status_code == 404:
+        print(f'{shard_key} not found', file=sys.stderr)
+        return 1
+    resp.raise_for_status()
+    reader = ShardReader(resp.content)
+    raw = reader.raw(key_code)
+    descriptors = {}
+    if raw is not None and raw[:1] != b'{':
+        # array / binary values: fetch the descriptor of their schema version
+        resp = requests.get(values_url + requests.utils.requote_uri(schema_key()), headers=auth, timeout=30)
+        resp.raise_for_status()
+        descriptor = resp.json()
+        descriptors[descriptor['version']] = descriptor
+    value = reader.get(key_code, descriptors)
+    if value is None:
+        print(f'{key_code} is not in {shard_key}', file=sys.stderr)
+        return 1
+    print(json.dumps(value, ensure_ascii=False, indent=2))
+    return 0
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Sharded census KV layout: verify round trips or read one mesh')
+    parser.add_argument('--prefix-len', type=int, default=DEFAULT_SHARD_PREFIX_LEN, help='key_code prefix length per shard')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_verify = sub.add_parser('verify', help='build every shard locally and check each mesh reads back byte for byte')
+    p_verify.add_argument('--indir', default=os.path.join(script_dir, 'census_mesh_2020_data'))
+    p_verify.add_argument('--value-encoding', choices=VALUE_ENCODINGS, default='json')
+    p_get = sub.add_parser('get', help='fetch the shard holding KEY_CODE from KV and print the mesh')
+    p_get.add_argument('key_code')
+    p_get.add_argument('--api-base', default='https://api.cloudflare.com/client/v4')
+    args = parser.parse_args()
+
+    if args.command == 'verify':
+        sys.exit(verify(args.indir, args.prefix_len, args.value_encoding))
+    sys.exit(fetch(args.key_code, args.api_base, args.prefix_len))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Local in-memory stand-in for the Cloudflare Workers KV REST API.
+
+Serves the endpoints the uploader uses,
+
+  GET / PUT / DELETE {base}/accounts/{account}/storage/kv/namespaces/{namespace}/values/{key}
+  PUT                {base}/accounts/{account}/storage/kv/namespaces/{namespace}/bulk
+  POST               {base}/accounts/{account}/storage/kv/namespaces/{namespace}/bulk/delete
+  GET                {base}/accounts/{account}/storage/kv/namespaces/{namespace}/keys?prefix=&limit=&cursor=
+
+over HTTP/1.1 keep-alive, so upload_kv.py can be run and measured without
+a Cloudflare account:
+
+  python kv_stub_server.py --port 8787 --latency 0.02
+  CF_ACCOUNT_ID=acc CF_NAMESPACE_ID=ns CF_API_TOKEN=x \
+      python upload_kv.py --api-base http://127.0.0.1:8787/client/v4 --async-requests 64
+
+--latency adds a fixed delay to every request (a stand-in for the round
+trip to Cloudflare). Throttling can be injected: --rate-limit answers
+429 with Retry-After once more than that many requests per second arrive
+(token bucket, one second of burst), --concurrency-limit answers 429
+(without Retry-After) while more requests than that are being served.
+--error-rate answers that share of the admitted requests with a 500 or 503
+before touching the store (--seed makes the choice repeatable), so the
+retry paths can be exercised too. Request and connection counts are printed on exit
+(Ctrl+C / SIGTERM). serve() starts the same server on a background thread for
+scripts; bench_upload_kv.py runs the uploader against it.
+"""
+
+import argparse
+import base64
+import bisect
+import json
+import math
+import random
+import signal
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+API_PREFIX = '/client/v4'
+BULK_MAX_KEYS = 10_000
+BULK_MAX_BYTES = 100 * 1024 * 1024
+LIST_MAX_LIMIT = 1000
+
+
+class KVStore:
+    """Namespaces of key -> bytes, plus request statistics."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.namespaces: Dict[str, Dict[str, bytes]] = {}
+        self.requests = Counter()  # (method, endpoint) -> count
+        self.statuses = Counter()
+        self.connections = 0
+        self._sorted: Dict[str, Tuple[int, list]] = {}  # namespace -> (size when sorted, names)
+
+    def namespace(self, namespace_id: str) -> Dict[str, bytes]:
+        with self.lock:
+            return self.namespaces.setdefault(namespace_id, {})
+
+    def sorted_names(self, namespace_id: str) -> list:
+        """Names in list order, re-sorted only after the namespace changed size."""
+        kv = self.namespace(namespace_id)
+        with self.lock:
+            cached = self._sorted.get(namespace_id)
+            if cached is None or cached[0] != len(kv):
+                cached = (len(kv), sorted(kv))
+                self._sorted[namespace_id] = cached
+            return cached[1]
+
+
+class KVServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address: Tuple[str, int], latency: float = 0.0,
+                 rate_limit: float = 0.0, concurrency_limit: int = 0,
+                 error_rate: float = 0.0, seed: Optional[int] = None):
+        super().__init__(address, KVHandler)
+        self.store = KVStore()
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.concurrency_limit = concurrency_limit
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self.active = 0
+        self._tokens = rate_limit
+        self._refilled = time.monotonic()
+
+    def admit(self) -> Optional[Tuple[int, Optional[int]]]:
+        """None to serve the request, or (status, retry_after) to throttle it; counts it as active."""
+        with self.store.lock:
+            if self.rate_limit:
+                now = time.monotonic()
+                self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit)
+                self._refilled = now
+                if self._tokens < 1:
+                    return 429, max(1, math.ceil((1 - self._tokens) / self.rate_limit))
+                self._tokens -= 1
+            if self.concurrency_limit and self.active >= self.concurrency_limit:
+                return 429, None
+            self.active += 1
+            return None
+
+    def injected_error(self) -> Optional[int]:
+        """500 or 503 for an --error-rate share of the requests, else None."""
+        if not self.error_rate:
+            return None
+        with self.store.lock:
+            if self._random.random() >= self.error_rate:
+                return None
+            return self._random.choice((500, 503))
+
+    def done(self):
+        with self.store.lock:
+            self.active -= 1
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}{API_PREFIX}'
+
+
+def _envelope(success: bool, result=None, errors=()):
+    return {'success': success, 'errors': list(errors), 'messages': [], 'result': result}
+
+
+class KVHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as separate writes; without TCP_NODELAY each response waits on a delayed ACK
+    disable_nagle_algorithm = True
+    server: KVServer
+
+    def setup(self):
+        super().setup()
+        with self.server.store.lock:
+            self.server.store.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str = 'application/json', retry_after: Optional[int] = None):
+        with self.server.store.lock:
+            self.server.store.statuses[status] += 1
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, obj):
+        self._send(status, json.dumps(obj).encode('utf-8'))
+
+    def _error(self, status: int, code: int, message: str):
+        self._send_json(status, _envelope(False, errors=[{'code': code, 'message': message}]))
+
+    def _route(self):
+        """(namespace_id, endpoint, rest) for .../namespaces/{ns}/{endpoint}/{rest}, or None."""
+        path = urlsplit(self.path).path
+        if not path.startswith(API_PREFIX + '/accounts/'):
+            return None
+        parts = path[len(API_PREFIX) + 1:].split('/', 6)
+        # accounts, {account}, storage, kv, namespaces, {ns}, endpoint[/rest]
+        if len(parts) < 7 or parts[2:5] != ['storage', 'kv', 'namespaces']:
+            return None
+        endpoint, _, rest = parts[6].partition('/')
+        return parts[5], endpoint, unquote(rest)
+
+    def _handle(self, method: str):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        route = self._route()
+        endpoint = route[1] if route else None
+        with self.server.store.lock:
+            self.server.store.requests[(method, endpoint)] += 1
+        throttle = self.server.admit()
+        if throttle is not None:
+            status, retry_after = throttle
+            body = json.dumps(_envelope(False, errors=[{'code': 10429, 'message': 'Too many requests'}])).encode('utf-8')
+            return self._send(status, body, retry_after=retry_after)
+        try:
+            self._serve(method, route, body)
+        finally:
+            self.server.done()
+
+    def _serve(self, method: str, route, body: bytes):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self._error(401, 10000, 'Authentication error')
+        status = self.server.injected_error()
+        if status is not None:
+            return self._error(status, 10013, 'Internal server error (injected)')
+        if route is None:
+            return self._error(404, 7003, 'Could not route to ' + urlsplit(self.path).path)
+        namespace_id, endpoint, key = route
+        kv = self.server.store.namespace(namespace_id)
+        if endpoint == 'values' and key:
+            if method == 'GET':
+                value = kv.get(key)
+                if value is None:
+                    return self._error(404, 10009, "get: 'key not found'")
+                return self._send(200, value, 'application/octet-stream')
+            if method == 'PUT':
+                kv[key] = body
+                return self._send_json(200, _envelope(True))
+            if method == 'DELETE':
+                kv.pop(key, None)
+                return self._send_json(200, _envelope(True))
+        if endpoint == 'bulk' and not key and method == 'PUT':
+            return self._bulk_put(kv, body)
+        if endpoint == 'bulk' and key == 'delete' and method == 'POST':
+            return self._bulk_delete(kv, body)
+        if endpoint == 'keys' and not key and method == 'GET':
+            return self._list_keys(namespace_id)
+        return self._error(405, 10000, f'{method} not supported on {endpoint}')
+
+    def _list_keys(self, namespace_id: str):
+        query = parse_qs(urlsplit(self.path).query)
+        prefix = query.get('prefix', [''])[0]
+        cursor = query.get('cursor', [''])[0]
+        limit = min(int(query.get('limit', [LIST_MAX_LIMIT])[0]), LIST_MAX_LIMIT)
+        names = self.server.store.sorted_names(namespace_id)
+        # the cursor is the last name of the previous page
+        start = bisect.bisect_right(names, cursor) if cursor else bisect.bisect_left(names, prefix)
+        page = []
+        for name in names[start:start + limit]:
+            if not name.startswith(prefix):
+                break
+            page.append({'name': name})
+        more = len(page) == limit and start + limit < len(names) and names[start + limit].startswith(prefix)
+        info = {'count': len(page), 'cursor': page[-1]['name'] if more else ''}
+        body = _envelope(True, page)
+        body['result_info'] = info
+        return self._send_json(200, body)
+
+    def _bulk_put(self, kv: Dict[str, bytes], body: bytes):
+        if len(body) > BULK_MAX_BYTES:
+            return self._error(413, 10005, f'request body exceeds {BULK_MAX_BYTES} bytes')
+        try:
+            entries = json.loads(body)
+        except ValueError:
+            return self._error(400, 10026, 'could not parse request body')
+        if not isinstance(entries, list) or len(entries) > BULK_MAX_KEYS:
+            return self._error(400, 10026, f'body must be an array of at most {BULK_MAX_KEYS} pairs')
+        rejected = []
+        for entry in entries:
+            key = entry.get('key') if isinstance(entry, dict) else None
+            value = entry.get('value') if isinstance(entry, dict) else None
+            if not key or not isinstance(value, str):
+                rejected.append(key)
+                continue
+            kv[key] = base64.b64decode(value) if entry.get('base64') else value.encode('utf-8')
+        return self._send_json(200, _envelope(True, {'successful_key_count': len(entries) - len(rejected),
+                                                     'unsuccessful_keys': rejected}))
+
+    def _bulk_delete(self, kv: Dict[str, bytes], body: bytes):
+        try:
+            keys = json.loads(body)
+        except ValueError:
+            return self._error(400, 10026, 'could not parse request body')
+        if not isinstance(keys, list) or len(keys) > BULK_MAX_KEYS:
+            return self._error(400, 10026, f'body must be an array of at most {BULK_MAX_KEYS} keys')
+        for key in keys:
+            kv.pop(key, None)
+        return self._send_json(200, _envelope(True, {'successful_key_count': len(keys), 'unsuccessful_keys': []}))
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+def serve(host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+          rate_limit: float = 0.0, concurrency_limit: int = 0,
+          error_rate: float = 0.0, seed: Optional[int] = None) -> KVServer:
+    """Start a server on a daemon thread; port 0 picks a free port (see .base_url)."""
+    server = KVServer((host, port), latency=latency, rate_limit=rate_limit, concurrency_limit=concurrency_limit,
+                      error_rate=error_rate, seed=seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def report(store: KVStore) -> str:
+    keys = sum(len(kv) for kv in store.namespaces.values())
+    requests = ', '.join(f'{method} {endpoint}={count}' for (method, endpoint), count in sorted(store.requests.items(), key=str))
+    statuses = ', '.join(f'{status}={count}' for status, count in sorted(store.statuses.items()))
+    return (f'{keys} keys stored; {sum(store.requests.values())} requests ({requests}); '
+            f'statuses: {statuses or "-"}; {store.connections} connections')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='In-memory stand-in for the Cloudflare Workers KV REST API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='Answer 429 + Retry-After above this many requests per second')
+    parser.add_argument('--concurrency-limit', type=int, default=0, help='Answer 429 while this many requests are being served')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Answer this share of the requests (0..1) with 500 / 503')
+    parser.add_argument('--seed', type=int, help='Seed for --error-rate')
+    args = parser.parse_args()
+    if not 0 <= args.error_rate <= 1:
+        parser.error('--error-rate must be between 0 and 1')
+
+    server = KVServer((args.host, args.port), latency=args.latency,
+                      rate_limit=args.rate_limit, concurrency_limit=args.concurrency_limit,
+                      error_rate=args.error_rate, seed=args.seed)
+    print(f'Serving KV API at {server.base_url}', flush=True)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(report(server.store))
+
+
+if __name__ == '__main__':
+    main()
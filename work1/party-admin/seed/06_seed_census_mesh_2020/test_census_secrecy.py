@@ -0,0 +1,65 @@
+"""Tests for census_secrecy.resolve(): chains, broken targets and htk_saki cycles.
+
+  python -m pytest test_census_secrecy.py
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from census_schema import TARGET_COLS  # noqa: E402
+from census_secrecy import resolve  # noqa: E402
+
+
+def mesh(key, saki=None, gassan=None):
+    values = dict.fromkeys(TARGET_COLS)
+    values.update(key_code=key, htk_syori=2 if saki is not None else None, htk_saki=saki, gassan=gassan)
+    return key, tuple(values[col] for col in TARGET_COLS)
+
+
+def resolved(*meshes):
+    res = resolve(dict(meshes))
+    keys = res.keys
+    return ({keys[i]: keys[r] for i, r in enumerate(res.root)},
+            {keys[i]: d for i, d in enumerate(res.depth)},
+            [keys[i] for i in res.unresolved])
+
+
+class ResolveTest(unittest.TestCase):
+    def test_chain(self):
+        root, depth, unresolved = resolved(mesh('a', 'b'), mesh('b', 'c'), mesh('c', 'd'), mesh('d'), mesh('e'))
+        self.assertEqual(root, {'a': 'd', 'b': 'd', 'c': 'd', 'd': 'd', 'e': 'e'})
+        self.assertEqual(depth, {'a': 3, 'b': 2, 'c': 1, 'd': 0, 'e': 0})
+        self.assertEqual(unresolved, [])
+
+    def test_missing_and_self_target(self):
+        root, _, unresolved = resolved(mesh('a', 'zz'), mesh('b', 'b'), mesh('c', 'a'))
+        self.assertEqual(unresolved, ['a', 'b'])
+        # c merges into a, which is left as its own group
+        self.assertEqual(root['c'], 'a')
+
+    def assert_cycle(self, length):
+        keys = [f'm{n}' for n in range(length)]
+        cycle = [mesh(key, keys[(n + 1) % length]) for n, key in enumerate(keys)]
+        root, depth, unresolved = resolved(*cycle, mesh('feeder', keys[0]), mesh('x', 'y'), mesh('y'))
+        self.assertEqual(unresolved, sorted(keys + ['feeder']))
+        for key in keys + ['feeder']:
+            self.assertEqual(root[key], key)
+            self.assertEqual(depth[key], 0)
+        # meshes off the cycle still resolve
+        self.assertEqual(root['x'], 'y')
+        self.assertEqual(depth['x'], 1)
+
+    def test_two_cycle(self):
+        self.assert_cycle(2)
+
+    def test_three_cycle(self):
+        self.assert_cycle(3)
+
+    def test_four_cycle(self):
+        self.assert_cycle(4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+"""Tests for kv_checkpoint: RangeSet merging and resuming a file from its saved byte offset.
+
+  python -m pytest test_kv_checkpoint.py
+"""
+
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kv_checkpoint import Checkpoint, RangeSet  # noqa: E402
+from seed_io import open_csv_stream  # noqa: E402
+
+
+class RangeSetTest(unittest.TestCase):
+    def test_out_of_order_values_merge(self):
+        values = list(range(20))
+        random.Random(1).shuffle(values)
+        s = RangeSet()
+        for n, value in enumerate(values):
+            s.add(value)
+            self.assertEqual(len(s), n + 1)
+        self.assertEqual(s.ranges(), [[0, 20]])
+
+    def test_overlapping_and_touching_ranges(self):
+        s = RangeSet([[10, 20], [30, 40]])
+        s.add_range(15, 25)
+        self.assertEqual(s.ranges(), [[10, 25], [30, 40]])
+        s.add_range(25, 30)  # touches both neighbours
+        self.assertEqual(s.ranges(), [[10, 40]])
+        s.add_range(0, 5)
+        s.add_range(50, 60)
+        s.add_range(3, 55)  # swallows everything in between
+        self.assertEqual(s.ranges(), [[0, 60]])
+
+    def test_contained_and_empty_ranges(self):
+        s = RangeSet([[0, 10]])
+        s.add_range(2, 5)
+        s.add_range(7, 7)
+        s.add_range(9, 3)
+        self.assertEqual(s.ranges(), [[0, 10]])
+
+    def test_membership_and_first_missing(self):
+        s = RangeSet()
+        for value in (5, 1, 0, 3, 2, 9):
+            s.add(value)
+        self.assertEqual(s.ranges(), [[0, 4], [5, 6], [9, 10]])
+        self.assertEqual([v for v in range(11) if v in s], [0, 1, 2, 3, 5, 9])
+        self.assertEqual(s.first_missing(), 4)
+        self.assertEqual(s.first_missing(5), 6)
+        self.assertEqual(s.first_missing(7), 7)
+        self.assertEqual(RangeSet().first_missing(), 0)
+
+
+class ResumeTest(unittest.TestCase):
+    ROWS = 60
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self._tmp.name, 'tblT001101H01.txt')
+        self.checkpoint_path = os.path.join(self._tmp.name, 'checkpoint.json')
+        lines = ['KEY_CODE,NAME\r\n']
+        for n in range(self.ROWS):
+            if n % 7 == 3:
+                lines.append('\r\n')  # blank lines do not count as rows
+            # CP932 text and a quoted field spanning two lines, so rows and lines differ in bytes and count
+            name = f'"町{n}\r\n丁目"' if n % 5 == 2 else f'区{n}'
+            lines.append(f'{533900000 + n},{name}\r\n')
+        with open(self.csv_path, 'wb') as f:
+            f.write(''.join(lines).encode('cp932'))
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def read(self, progress, stop_after=None):
+        """Pending (row index, key) pairs, read the way upload_kv does: seek, then skip done rows."""
+        rows = []
+        with open_csv_stream(self.csv_path) as reader:
+            idx = 0
+            position = progress.seek_position()
+            if position is not None:
+                idx, offset, line_no = position
+                reader.seek(offset, line_no)
+            for row in reader:
+                if not row:
+                    continue
+                if idx not in progress.done:
+                    progress.seen(idx, reader.row_offset, reader.row_line_no, reader.text.offset, reader.text.line_no)
+                    rows.append((idx, row[0]))
+                    if stop_after is not None and len(rows) == stop_after:
+                        return rows
+                idx += 1
+            progress.finish(idx)
+        return rows
+
+    def key(self, idx):
+        return str(533900000 + idx)
+
+    def test_resume_from_offset_without_skipping_or_repeating(self):
+        checkpoint = Checkpoint(self.checkpoint_path, [self.csv_path])
+        progress = checkpoint.progress(self.csv_path)
+        first = self.read(progress, stop_after=30)
+        self.assertEqual(first, [(n, self.key(n)) for n in range(30)])
+        # completions arrive out of order; 4 and 12 failed, 25..29 are still in flight
+        done = [n for n in range(25) if n not in (4, 12)]
+        random.Random(2).shuffle(done)
+        for n in done:
+            progress.mark(n)
+        checkpoint.save()
+
+        resumed = Checkpoint(self.checkpoint_path, [self.csv_path])
+        progress = resumed.progress(self.csv_path)
+        self.assertTrue(progress.resumed)
+        self.assertEqual(progress.seek_position()[0], 4)
+        second = self.read(progress)
+        self.assertEqual(second, [(n, self.key(n)) for n in [4, 12] + list(range(25, self.ROWS))])
+        self.assertEqual(progress.rows, self.ROWS)
+
+    def test_resume_past_every_earlier_row(self):
+        checkpoint = Checkpoint(self.checkpoint_path, [self.csv_path])
+        progress = checkpoint.progress(self.csv_path)
+        self.read(progress, stop_after=41)
+        for n in range(41):
+            progress.mark(n)
+        checkpoint.save()
+
+        progress = Checkpoint(self.checkpoint_path, [self.csv_path]).progress(self.csv_path)
+        row, offset, _ = progress.seek_position()
+        self.assertEqual(row, 41)
+        self.assertGreater(offset, 0)
+        self.assertEqual(self.read(progress), [(n, self.key(n)) for n in range(41, self.ROWS)])
+
+    def test_complete_file_is_recorded(self):
+        checkpoint = Checkpoint(self.checkpoint_path, [self.csv_path])
+        progress = checkpoint.progress(self.csv_path)
+        for n, _ in self.read(progress):
+            progress.mark(n)
+        checkpoint.save()
+        progress = Checkpoint(self.checkpoint_path, [self.csv_path]).progress(self.csv_path)
+        self.assertTrue(progress.complete)
+
+    def test_changed_file_is_read_again(self):
+        checkpoint = Checkpoint(self.checkpoint_path, [self.csv_path])
+        progress = checkpoint.progress(self.csv_path)
+        for n, _ in self.read(progress, stop_after=10):
+            progress.mark(n)
+        checkpoint.save()
+        with open(self.csv_path, 'ab') as f:
+            f.write(b'533999999,x\r\n')
+
+        resumed = Checkpoint(self.checkpoint_path, [self.csv_path])
+        progress = resumed.progress(self.csv_path)
+        self.assertEqual(resumed.dropped, [os.path.abspath(self.csv_path)])
+        self.assertIsNone(progress.seek_position())
+        self.assertEqual(len(self.read(progress)), self.ROWS + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
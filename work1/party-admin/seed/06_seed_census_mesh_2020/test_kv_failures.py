@@ -0,0 +1,194 @@
+"""Tests for kv_failures: NDJSON appends, --retry-failed replay and compaction of an earlier journal.
+
+  python -m pytest test_kv_failures.py
+"""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kv_checkpoint import RangeSet  # noqa: E402
+from kv_failures import FailureJournal, read_journal, split_stale  # noqa: E402
+from seed_io import open_csv_stream  # noqa: E402
+
+ROWS = 10
+
+
+def kv_key(row):
+    return f'census_mesh_2020:{533900000 + row}'
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = self._tmp.name
+        self.journal = os.path.join(self.dir, 'failures.ndjson')
+        self.csv_path = self.input_file('tblT001101H01.txt')
+        self.positions = {}
+        with open_csv_stream(self.csv_path) as reader:
+            for row, _ in enumerate(reader):
+                self.positions[row] = (reader.row_offset, reader.row_line_no)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def input_file(self, name):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write('KEY_CODE,NAME\r\n'.encode('cp932'))
+            for row in range(ROWS):
+                f.write(f'{533900000 + row},町{row}\r\n'.encode('cp932'))
+        return path
+
+    def fail(self, journal, row, reason='PUT status 503'):
+        journal.add(kv_key(row), reason, path=self.csv_path, row=row, position=self.positions[row])
+
+    def entries(self):
+        with open(self.journal, 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def rows(self, entries=None):
+        return sorted(e['row'] for e in (self.entries() if entries is None else entries) if e.get('row') is not None)
+
+    def done_except(self, *failed):
+        done = RangeSet()
+        for row in range(ROWS):
+            if row not in failed:
+                done.add(row)
+        return done
+
+    def test_entries_are_appended_as_ndjson(self):
+        journal = FailureJournal(self.journal)
+        self.fail(journal, 3)
+        journal.add(None, 'cannot decode', path=self.input_file('broken.txt'))
+        journal.add(None, 'missing key_code', journal=False)
+        self.assertEqual(journal.count, 3)
+        self.assertEqual(len(journal.sample), 3)
+        # line buffered: each entry is on disk as soon as it is added
+        self.assertEqual(len(self.entries()), 2)
+        journal.close()
+
+        first, whole_file = self.entries()
+        self.assertEqual(first['key'], kv_key(3))
+        self.assertEqual(first['file'], os.path.abspath(self.csv_path))
+        self.assertEqual((first['row'], first['offset'], first['line']), (3, *self.positions[3]))
+        st = os.stat(self.csv_path)
+        self.assertEqual((first['size'], first['mtime_ns']), (st.st_size, st.st_mtime_ns))
+        self.assertIsNone(whole_file['row'])
+
+        # a later run appends; nothing was settled, so nothing is dropped
+        journal = FailureJournal(self.journal)
+        self.fail(journal, 5)
+        journal.close()
+        self.assertEqual(self.rows(), [3, 5])
+        self.assertEqual(journal.dropped, 0)
+
+    def test_no_failures_no_file(self):
+        journal = FailureJournal(self.journal)
+        journal.close()
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_retry_failed_keeps_only_what_still_fails(self):
+        journal = FailureJournal(self.journal)
+        for row in (2, 4, 7):
+            self.fail(journal, row)
+        journal.add('census_mesh_2020_shard:533900', 'bulk write failed')
+        other_path = self.input_file('tblT001101H02.txt')
+        journal.add(kv_key(1), 'PUT status 500', path=other_path, row=1, position=self.positions[1])
+        journal.close()
+        with open(other_path, 'ab') as f:
+            f.write(b'533999999,x\r\n')  # changed since: its offsets no longer apply
+
+        # the replay as upload_kv --retry-failed does it
+        replay, unreplayable = read_journal(self.journal)
+        self.assertEqual(sorted(replay), sorted([os.path.abspath(self.csv_path), os.path.abspath(other_path)]))
+        self.assertEqual([e['key'] for e in unreplayable], ['census_mesh_2020_shard:533900'])
+        retry = FailureJournal(self.journal, replace=True)
+        for entry in unreplayable:
+            retry.carry(entry)
+        sent = []
+        for path in sorted(replay):
+            current, stale = split_stale(path, replay[path])
+            for entry in stale:
+                retry.carry(entry)
+            with open_csv_stream(path) as reader:
+                for entry in current:
+                    reader.seek(entry['offset'], entry['line'])
+                    row = next(reader)
+                    self.assertEqual(f'census_mesh_2020:{row[0]}', entry['key'])
+                    sent.append(entry['row'])
+                    if entry['row'] == 4:
+                        self.fail(retry, 4, 'PUT status 503 again')
+        retry.close()
+
+        self.assertEqual(sent, [2, 4, 7])
+        self.assertFalse(os.path.exists(self.journal + '.tmp'))
+        entries = self.entries()
+        by_file = {}
+        for entry in entries:
+            by_file.setdefault(entry['file'], []).append(entry)
+        # rows 2 and 7 went through and left the journal; 4 failed again
+        self.assertEqual(self.rows(by_file[os.path.abspath(self.csv_path)]), [4])
+        self.assertEqual(by_file[os.path.abspath(self.csv_path)][0]['reason'], 'PUT status 503 again')
+        # the stale entry and the entry without a file are carried over
+        self.assertEqual(self.rows(by_file[os.path.abspath(other_path)]), [1])
+        self.assertEqual([e['key'] for e in by_file[None]], ['census_mesh_2020_shard:533900'])
+
+    def test_retry_with_nothing_failing_empties_the_journal(self):
+        journal = FailureJournal(self.journal)
+        self.fail(journal, 2)
+        journal.close()
+        FailureJournal(self.journal, replace=True).close()
+        self.assertEqual(self.entries(), [])
+
+    def test_resume_compacts_the_earlier_journal(self):
+        journal = FailureJournal(self.journal)
+        for row in (1, 2, 5):
+            self.fail(journal, row)
+        broken = self.input_file('broken.txt')
+        journal.add(None, 'cannot decode', path=broken)
+        journal.add('census_mesh_2020:999', 'delete failed')
+        journal.add('census_mesh_2020:998', 'delete failed')
+        journal.close()
+
+        # a resumed run: rows 1 and 5 go through, 2 fails again, broken.txt now reads fine
+        journal = FailureJournal(self.journal)
+        self.fail(journal, 2, 'PUT status 429')
+        journal.add('census_mesh_2020:999', 'delete failed again')
+        journal.settle(self.csv_path, self.done_except(2))
+        journal.settle(broken)
+        journal.close()
+
+        entries = self.entries()
+        self.assertEqual(self.rows(entries), [2])
+        self.assertEqual([e['reason'] for e in entries if e.get('row') == 2], ['PUT status 429'])
+        self.assertFalse(any(e['file'] == os.path.abspath(broken) for e in entries))
+        self.assertEqual(sorted((e['key'], e['reason']) for e in entries if not e.get('file')),
+                         [('census_mesh_2020:998', 'delete failed'), ('census_mesh_2020:999', 'delete failed again')])
+        self.assertEqual(journal.dropped, 5)
+        self.assertEqual(journal.journaled, len(entries))
+
+    def test_compaction_drops_rows_of_a_changed_file(self):
+        journal = FailureJournal(self.journal)
+        self.fail(journal, 3)
+        journal.close()
+        with open(self.csv_path, 'ab') as f:
+            f.write(b'533999999,x\r\n')
+
+        # the run read the changed file; row 3 of the new file still failed and is kept
+        journal = FailureJournal(self.journal)
+        journal.add(kv_key(3), 'PUT status 500', path=self.csv_path, row=3, position=self.positions[3])
+        journal.settle(self.csv_path, self.done_except(3))
+        journal.close()
+        entries = self.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['reason'], 'PUT status 500')
+        self.assertEqual(entries[0]['size'], os.path.getsize(self.csv_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
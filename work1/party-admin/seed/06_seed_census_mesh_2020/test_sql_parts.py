@@ -0,0 +1,137 @@
+"""Tests for sql_parts.SqlPartWriter: part and statement budgets, oversized rows and last-part flags.
+
+  python -m pytest test_sql_parts.py
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sql_parts import D1_MAX_STATEMENT_BYTES, SqlPartWriter, utf8_len  # noqa: E402
+
+PREFIX = 'INSERT INTO t (k,v) VALUES\n'
+SUFFIX = ';\n'
+
+
+def row(n, width=0):
+    # non-ASCII padding, so byte and character counts differ
+    return f"({n},'{'あ' * width}')"
+
+
+class PartWriterTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def writer(self, **limits):
+        return SqlPartWriter(lambda n: os.path.join(self.dir, f'part_{n:04d}.sql'),
+                             header_for=lambda n: f'-- part {n}\nBEGIN;\n',
+                             footer_for=lambda n: 'COMMIT;\n', **limits)
+
+    def read(self, part):
+        with open(part.path, 'rb') as f:
+            return f.read()
+
+    def statements(self, part):
+        body = self.read(part).decode('utf-8')
+        return [s + SUFFIX for s in body.split(SUFFIX) if s.startswith(PREFIX)]
+
+    def test_parts_and_statements_stay_within_budgets(self):
+        max_part_bytes = 250_000
+        writer = self.writer(max_part_bytes=max_part_bytes, max_statement_bytes=D1_MAX_STATEMENT_BYTES)
+        writer.set_statement(PREFIX, SUFFIX)
+        with writer:
+            for n in range(2000):
+                writer.add_row(row(n, width=100 + n % 50))
+        parts = writer.parts
+
+        self.assertGreater(len(parts), 1)
+        rows = 0
+        for part in parts:
+            data = self.read(part)
+            self.assertEqual(part.bytes, len(data))
+            self.assertLessEqual(part.bytes, max_part_bytes)
+            statements = self.statements(part)
+            self.assertEqual(part.statements, len(statements))
+            for sql in statements:
+                self.assertLessEqual(utf8_len(sql), D1_MAX_STATEMENT_BYTES)
+            rows += part.rows
+        self.assertEqual(rows, 2000)
+        # every row is written exactly once, in order
+        written = [line for part in parts for line in self.read(part).decode('utf-8').splitlines()
+                   if line.startswith('(')]
+        self.assertEqual([int(line[1:line.index(',')]) for line in written], list(range(2000)))
+
+    def test_row_larger_than_statement_budget(self):
+        writer = self.writer(max_statement_bytes=1000)
+        writer.set_statement(PREFIX, SUFFIX)
+        with writer:
+            writer.add_row(row(1, width=10))
+            with self.assertRaises(ValueError):
+                writer.add_row(row(2, width=1000))
+            # the writer is still usable after the rejected row
+            writer.add_row(row(3, width=10))
+        self.assertEqual([p.rows for p in writer.parts], [2])
+
+    def test_row_larger_than_part_budget(self):
+        writer = self.writer(max_part_bytes=200)
+        writer.set_statement(PREFIX, SUFFIX)
+        with writer:
+            with self.assertRaises(ValueError):
+                writer.add_row(row(1, width=200))
+
+    def test_statement_larger_than_budget(self):
+        writer = self.writer(max_statement_bytes=100)
+        with writer:
+            with self.assertRaises(ValueError):
+                writer.add_statement('SELECT ' + '1,' * 100 + '1;\n')
+
+    def test_last_part_flag(self):
+        writer = self.writer(max_part_rows=3)
+        writer.set_statement(PREFIX, SUFFIX)
+        with writer:
+            for n in range(7):
+                writer.add_row(row(n))
+        self.assertEqual([p.rows for p in writer.parts], [3, 3, 1])
+        self.assertEqual([p.last for p in writer.parts], [False, False, True])
+
+    def test_exact_fit_leaves_no_empty_last_part(self):
+        writer = self.writer(max_part_rows=3)
+        writer.set_statement(PREFIX, SUFFIX)
+        with writer:
+            for n in range(6):
+                writer.add_row(row(n))
+        self.assertEqual([p.rows for p in writer.parts], [3, 3])
+        self.assertEqual([p.last for p in writer.parts], [False, True])
+
+    def test_no_rows_no_parts(self):
+        writer = self.writer(max_part_rows=3)
+        self.assertEqual(writer.close(), [])
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_set_statement_splits_statements(self):
+        writer = self.writer(max_statement_rows=3)
+        with writer:
+            writer.set_statement(PREFIX, SUFFIX)
+            for n in range(4):
+                writer.add_row(row(n))
+            # a new template closes the statement being collected
+            writer.set_statement('INSERT INTO u (k,v) VALUES\n', SUFFIX)
+            writer.add_row(row(4))
+        body = self.read(writer.parts[0]).decode('utf-8')
+        self.assertEqual(body, '-- part 1\nBEGIN;\n'
+                               f'{PREFIX}(0,\'\'),\n(1,\'\'),\n(2,\'\'){SUFFIX}'
+                               f'{PREFIX}(3,\'\'){SUFFIX}'
+                               f'INSERT INTO u (k,v) VALUES\n(4,\'\'){SUFFIX}'
+                               'COMMIT;\n')
+        self.assertEqual(writer.parts[0].statements, 3)
+        self.assertEqual(writer.parts[0].rows, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
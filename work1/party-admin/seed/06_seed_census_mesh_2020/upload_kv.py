@@ -6,6 +6,7 @@ upload_kv.py
  CSV を読み、各行を JSON 化して Cloudflare Workers KV に登録する。
  必須環境変数: CF_ACCOUNT_ID, CF_NAMESPACE_ID, CF_API_TOKEN
  依存: requests  -> pip install requests
+ 並列・非同期・bulk・シャードなどの送信モードとチェックポイント・失敗ジャーナルの詳細は README.md と各 kv_*.py を参照。
 
 実行例:
  CF_ACCOUNT_ID=... CF_NAMESPACE_ID=... CF_API_TOKEN=... python upload_kv.py --indir census_mesh_2020_data --skip-existing --dry-run
@@ -16,23 +17,34 @@ import sys
 import argparse
 import time
 import json
-import csv
 import glob
-import re
 import requests
 import subprocess
+import threading
 from typing import Optional
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import shutil
 
-ENCODINGS = ['utf-8-sig', 'utf-8', 'cp932', 'shift_jis', 'euc_jp']
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from seed_io import ENCODINGS, EncodingError, open_csv_stream  # noqa: E402
+from census_schema import CompiledSchema  # noqa: E402
+from census_manifest import Manifest  # noqa: E402
+from census_json_output import DEFAULT_PART_BYTES, JSON_LAYOUTS, JsonOutput  # noqa: E402
+from kv_async import AsyncKVClient  # noqa: E402
+from kv_rate import AdaptiveLimiter, retry_delay  # noqa: E402
+from kv_index import HashIndex, KeySet, list_keys, value_hash, wrangler_list_keys  # noqa: E402
+from kv_bulk import BULK_MAX_BYTES, BULK_MAX_KEYS, BulkWriter, WranglerBulkWriter, pack_batches  # noqa: E402
+from kv_encoding import VALUE_ENCODINGS, EncodingStats, ValueEncoder, schema_descriptor, schema_key  # noqa: E402
+from kv_checkpoint import Checkpoint, FileProgress  # noqa: E402
+from kv_failures import SAMPLE_SIZE, FailureJournal, read_journal, split_stale  # noqa: E402
+from kv_pipeline import DEFAULT_CHUNK_ROWS, EncodePool, StageCounters, encode_rows, timed_rows  # noqa: E402
+from kv_metrics import Metrics, ThroughputReporter, write_report  # noqa: E402
+from kv_shard import DEFAULT_SHARD_PREFIX_LEN, SHARD_KEY_PREFIX, ShardBuilder, encode_shard  # noqa: E402
+
 KV_KEY_PREFIX = 'census_mesh_2020:'
+CF_API_BASE = 'https://api.cloudflare.com/client/v4'
 SIZE_WARNING_BYTES = 25 * 1024 * 1024  # 25MB
 
-def norm_header(h: str) -> str:
-    h = h.strip()
-    return re.sub(r'[^0-9a-z]+', '_', h.lower())
-
 def clean_raw_value(raw: Optional[str]) -> Optional[str]:
     if raw is None:
         return None
@@ -41,67 +53,31 @@ def clean_raw_value(raw: Optional[str]) -> Optional[str]:
         return None
     return s
 
-def try_int_conversion(s: Optional[str]) -> Optional[int]:
-    if s is None:
-        return None
-    s2 = s.replace(',', '')
-    if re.fullmatch(r'-?\d+', s2):
-        try:
-            return int(s2)
-        except Exception:
-            return None
-    return None
-
-def read_csv_with_encoding(path: str):
-    last_exc = None
-    for enc in ENCODINGS:
-        try:
-            with open(path, 'r', encoding=enc, newline='') as f:
-                reader = csv.DictReader(f)
-                rows = list(reader)
-                if reader.fieldnames is None:
-                    raise ValueError("no header")
-                return reader.fieldnames, rows, enc
-        except Exception as e:
-            last_exc = e
-            continue
-    raise last_exc
-
-
-def read_csv_stream(path: str):
-    """Open CSV and return (fieldnames, iterator_of_rows, encoding).
-
-    The iterator is a csv.DictReader which yields rows lazily so the caller
-    can process rows while the file is being read and report progress.
-    """
-    last_exc = None
-    for enc in ENCODINGS:
-        try:
-            f = open(path, 'r', encoding=enc, newline='')
-            reader = csv.DictReader(f)
-            if reader.fieldnames is None:
-                f.close()
-                raise ValueError('no header')
-            return reader.fieldnames, reader, enc
-        except Exception as e:
-            last_exc = e
-            continue
-    raise last_exc
-
-def request_with_retry(method, url, headers, data=None, params=None, max_retries=3, timeout=30):
+def request_with_retry(method, url, headers, data=None, params=None, max_retries=3, timeout=30, limiter=None, metrics=None):
     attempt = 0
     while True:
+        if limiter is not None:
+            limiter.wait()
+        started = time.monotonic()
         try:
             resp = requests.request(method, url, headers=headers, data=data, params=params, timeout=timeout)
-            if 200 <= resp.status_code < 300 or resp.status_code == 404:
-                return resp
         except requests.RequestException:
             resp = None
+        if limiter is not None:
+            limiter.record(resp.status_code if resp is not None else None, time.monotonic() - started,
+                           resp.headers if resp is not None else None)
+        if metrics is not None:
+            metrics.request(method, resp.status_code if resp is not None else None, time.monotonic() - started,
+                            len(data) if data else 0, retry=attempt > 0)
+        if resp is not None and (200 <= resp.status_code < 300 or resp.status_code == 404):
+            return resp
         attempt += 1
         if attempt > max_retries:
             return resp
-        sleep = (2 ** (attempt - 1)) * 0.5
-        time.sleep(sleep)
+        delay = retry_delay(attempt, resp.headers if resp is not None else None)
+        if metrics is not None:
+            metrics.waited(delay)
+        time.sleep(delay)
 
 def find_key_field(fieldnames):
     for f in fieldnames:
@@ -109,77 +85,6 @@ def find_key_field(fieldnames):
             return f
     return fieldnames[0]
 
-def process_row_to_json(fieldnames, row, to_array_htksaki=False):
-    out = {}
-    for orig_h in fieldnames:
-        norm_h = norm_header(orig_h)
-        raw = row.get(orig_h)
-        cleaned = clean_raw_value(raw)
-        if orig_h.strip().upper() == 'HTKSAKI' or norm_h == 'htk_saki':
-            if cleaned is None:
-                val = None
-            else:
-                if to_array_htksaki:
-                    val = [p for p in re.split(r'[;，、]', cleaned) if p != '']
-                else:
-                    val = cleaned
-        else:
-            num = try_int_conversion(cleaned)
-            if num is not None:
-                val = num
-            else:
-                val = cleaned
-        out[norm_h] = val
-    return out
-
-def load_checkpoint(path):
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception:
-        return None
-
-def save_checkpoint(path, data):
-    tmp = path + '.tmp'
-    with open(tmp, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False)
-    os.replace(tmp, path)
-
-def wrangler_get(ns: str, key: str, max_retries=3) -> Optional[int]:
-    # returncode 0 means exists, 1 or non-zero means not found/error
-    attempt = 0
-    while True:
-        try:
-            # add timeout and capture output to avoid hanging subprocess
-            p = subprocess.run(['wrangler', 'kv:key', 'get', ns, key], capture_output=True, text=True, timeout=30)
-            # wrangler returns 0 when found; non-zero otherwise
-            return p.returncode
-        except FileNotFoundError:
-            return None
-        except Exception:
-            attempt += 1
-            if attempt > max_retries:
-                return None
-            time.sleep((2 ** (attempt - 1)) * 0.5)
-
-def wrangler_put(ns: str, key: str, payload: bytes, max_retries=3) -> bool:
-    attempt = 0
-    while True:
-        try:
-            # use '-' to read value from stdin
-            p = subprocess.run(['wrangler', 'kv:key', 'put', ns, key, '-'], input=payload, capture_output=True, text=True, timeout=60)
-            if p.returncode == 0:
-                return True
-            # else treat as retryable
-        except FileNotFoundError:
-            return False
-        except Exception:
-            pass
-        attempt += 1
-        if attempt > max_retries:
-            return False
-        time.sleep((2 ** (attempt - 1)) * 0.5)
-
 def process_single(item):
     # item: dict with keys needed
     kv_key = item['kv_key']
@@ -188,25 +93,11 @@ def process_single(item):
     put_url = item['put_url']
     skip_existing = item['skip_existing']
     retries = item['retries']
-    use_wrangler = item.get('use_wrangler', False)
-    wrangler_ns = item.get('wrangler_ns')
-    # wrangler path
-    if use_wrangler:
-        # check existing
-        if skip_existing:
-            rc = wrangler_get(wrangler_ns, kv_key.replace('census_mesh_2020:', ''), max_retries=retries)
-            if rc is None:
-                return (kv_key, False, 'wrangler GET failed or wrangler not found')
-            if rc == 0:
-                return (kv_key, 'skipped', 'exists')
-        ok = wrangler_put(wrangler_ns, kv_key.replace('census_mesh_2020:', ''), payload, max_retries=retries)
-        if ok:
-            return (kv_key, True, '')
-        return (kv_key, False, 'wrangler PUT failed')
-    # existing HTTP path
+    limiter = item.get('limiter')
+    metrics = item.get('metrics')
     # GET if skip_existing
     if skip_existing:
-        resp = request_with_retry('GET', put_url, headers=headers, max_retries=retries)
+        resp = request_with_retry('GET', put_url, headers=headers, max_retries=retries, limiter=limiter, metrics=metrics)
         if resp is None:
             return (kv_key, False, f'GET failed (no response)')
         if resp.status_code == 200:
@@ -214,7 +105,7 @@ def process_single(item):
         if resp.status_code != 404:
             return (kv_key, False, f'GET status {resp.status_code} body={resp.text[:200]}')
     # PUT
-    resp = request_with_retry('PUT', put_url, headers={**headers, 'Content-Type': 'application/json'}, data=payload, max_retries=retries)
+    resp = request_with_retry('PUT', put_url, headers={**headers, 'Content-Type': item.get('content_type', 'application/json')}, data=payload, max_retries=retries, limiter=limiter, metrics=metrics)
     if resp is None:
         return (kv_key, False, 'PUT failed (no response)')
     if 200 <= resp.status_code < 300:
@@ -225,30 +116,74 @@ def main():
     p = argparse.ArgumentParser(description='Upload CSV rows to Cloudflare Workers KV as JSON.')
     p.add_argument('--indir', default='census_mesh_2020_data', help='input directory with CSV files')
     p.add_argument('--skip-existing', action='store_true', help='skip keys that already exist in KV')
+    p.add_argument('--exists-check', choices=['list', 'get'], default='list', help='how --skip-existing finds existing keys: list the namespace once (default) or GET each key')
     p.add_argument('--dry-run', action='store_true', help="don't PUT; just show planned actions")
     p.add_argument('--batch-size', type=int, default=100)
     p.add_argument('--sleep', type=float, default=0.5, help='sleep seconds between batches')
     p.add_argument('--retries', type=int, default=3, help='retry count for HTTP operations')
     p.add_argument('--to-array-htksaki', action='store_true', help='split HTKSAKI by ; into array')
     p.add_argument('--parallel', type=int, default=0, help='number of worker threads (0 = sequential)')
+    p.add_argument('--queue-size', type=int, help='rows submitted but not yet finished with --parallel (default: 2 x --parallel)')
     p.add_argument('--log-file', help='append logs to file')
     p.add_argument('--checkpoint-file', default='.upload_kv.checkpoint', help='checkpoint file for resume')
+    p.add_argument('--failure-journal', default='.upload_kv.failures.ndjson', help='append every failed key with its input file, row, byte offset and reason to this NDJSON file (kv_failures.py)')
+    p.add_argument('--retry-failed', action='store_true', help='send only the rows in --failure-journal again, seeking straight to them; the journal then keeps what still fails')
     p.add_argument('--checkpoint-every', type=int, default=100, help='write checkpoint every N processed rows')
     p.add_argument('--progress-every', type=int, default=100, help='print progress every N processed rows')
     p.add_argument('--upload-batch-size', type=int, default=1000, help='number of uploads to group per batch')
-    p.add_argument('--only-json', action='store_true', help='do not contact Cloudflare; write per-row JSON files to --outdir')
+    p.add_argument('--only-json', action='store_true', help='do not contact Cloudflare; write the JSON objects to --outdir')
     p.add_argument('--outdir', default='out_json', help='output directory for --only-json mode')
-    p.add_argument('--use-wrangler', action='store_true', help='use wrangler cli instead of direct HTTP API')
+    p.add_argument('--json-layout', choices=JSON_LAYOUTS, default='ndjson', help='--only-json output: NDJSON parts (default), tar or zip parts with an index, or one file per mesh (census_json_output.py)')
+    p.add_argument('--json-part-bytes', type=int, default=DEFAULT_PART_BYTES, help=f'size budget of one --json-layout ndjson / tar / zip part (default {DEFAULT_PART_BYTES}; 0 = one part per input file)')
+    p.add_argument('--use-wrangler', action='store_true', help='use wrangler cli instead of direct HTTP API (one `wrangler kv bulk put` per batch of --bulk-max-keys)')
     p.add_argument('--wrangler-namespace', help='wrangler namespace id (defaults to CF_NAMESPACE_ID env)')
+    p.add_argument('--async-requests', type=int, default=0, help='keep N requests in flight on the asyncio engine over pooled keep-alive connections (0 = off)')
+    p.add_argument('--connections', type=int, help='connection pool size for --async-requests (default: N)')
+    p.add_argument('--adaptive', action='store_true', help='adapt the number of requests in flight (--parallel / --async-requests is the start value) to 429/5xx responses and latency')
+    p.add_argument('--min-concurrency', type=int, default=1, help='lower bound for --adaptive')
+    p.add_argument('--max-concurrency', type=int, default=64, help='upper bound for --adaptive')
+    p.add_argument('--bulk', action='store_true', help='write rows through the bulk endpoint, many keys per request')
+    p.add_argument('--bulk-max-keys', type=int, default=BULK_MAX_KEYS, help=f'keys per bulk request or wrangler bulk file (API limit {BULK_MAX_KEYS})')
+    p.add_argument('--bulk-max-bytes', type=int, default=BULK_MAX_BYTES, help=f'body bytes per bulk request or wrangler bulk file (API limit {BULK_MAX_BYTES})')
+    p.add_argument('--hash-index', help='SQLite file of value hashes per key: send only new or changed values')
+    p.add_argument('--delete-missing', action='store_true', help='with --hash-index: bulk-delete keys whose rows disappeared from their (fully read) input file or whose input file is gone')
+    p.add_argument('--layout', choices=['mesh', 'shard'], default='mesh', help='one KV entry per mesh (default) or one per key_code prefix with an offset index (kv_shard.py)')
+    p.add_argument('--shard-prefix-len', type=int, default=DEFAULT_SHARD_PREFIX_LEN, help=f'key_code digits shared by the meshes of a shard with --layout shard (default {DEFAULT_SHARD_PREFIX_LEN} = 2nd level mesh)')
+    p.add_argument('--value-encoding', choices=VALUE_ENCODINGS, default='json', help='stored value: JSON object (default), positional JSON array or binary, the last two described once under a schema key (kv_encoding.py)')
+    p.add_argument('--encode-workers', type=int, default=0, help='encode rows in N worker processes ahead of the upload stage (0 = on the main thread)')
+    p.add_argument('--encode-chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS, help='rows per chunk handed to an encode worker')
+    p.add_argument('--api-base', default=CF_API_BASE, help='KV REST API base URL (e.g. a local kv_stub_server.py)')
+    p.add_argument('--manifest', help='manifest file: skip input files whose content is unchanged since they were last uploaded without failures')
+    p.add_argument('--metrics-file', help='write request counts, status codes, latency histograms and stage throughput as JSON at the end (kv_metrics.py)')
+    p.add_argument('--stats-interval', type=float, default=10.0, help='log rows/s, bytes/s and an ETA every N seconds (0 = off)')
     args = p.parse_args()
+    api_base = args.api_base.rstrip('/')
+
+    # the log file is opened once for the run; the throughput thread logs too
+    log_file = None
+    if args.log_file:
+        try:
+            log_file = open(args.log_file, 'a', encoding='utf-8', buffering=1)
+        except OSError as e:
+            print(f"ERROR: cannot open log file {args.log_file}: {e}", file=sys.stderr)
+            sys.exit(1)
+    log_lock = threading.Lock()
+
+    def log(msg):
+        with log_lock:
+            print(msg)
+            if log_file is not None:
+                log_file.write(msg + '\n')
 
     # prepare outdir for only-json mode
+    json_output = None
     if args.only_json:
         try:
             os.makedirs(args.outdir, exist_ok=True)
         except Exception as e:
             print(f"ERROR: cannot create outdir {args.outdir}: {e}", file=sys.stderr)
             sys.exit(1)
+        json_output = JsonOutput(args.outdir, args.json_layout, args.json_part_bytes)
 
     # wrangler namespace resolution (available for both modes)
     wrangler_ns = args.wrangler_namespace or os.environ.get('CF_NAMESPACE_ID')
@@ -272,7 +207,7 @@ def main():
                 namespace_id = env_ns
                 api_token = env_token
                 headers = {'Authorization': f'Bearer {api_token}'}
-                put_url_base = f'https://api.cloudflare.com/client/v4/accounts/{account_id}/storage/kv/namespaces/{namespace_id}/values/'
+                put_url_base = f'{api_base}/accounts/{account_id}/storage/kv/namespaces/{namespace_id}/values/'
             else:
                 print("ERROR: wrangler CLI not found in PATH. Install via: npm install -g wrangler, or set CF_ACCOUNT_ID/CF_NAMESPACE_ID/CF_API_TOKEN to use HTTP API", file=sys.stderr)
                 sys.exit(1)
@@ -290,192 +225,483 @@ def main():
             print("ERROR: CF_ACCOUNT_ID, CF_NAMESPACE_ID, CF_API_TOKEN must be set (or use --use-wrangler)", file=sys.stderr)
             sys.exit(1)
         headers = {'Authorization': f'Bearer {api_token}'}
-        put_url_base = f'https://api.cloudflare.com/client/v4/accounts/{account_id}/storage/kv/namespaces/{namespace_id}/values/'
+        put_url_base = f'{api_base}/accounts/{account_id}/storage/kv/namespaces/{namespace_id}/values/'
+
+    if args.async_requests > 0 and args.use_wrangler:
+        print("ERROR: --async-requests uses the HTTP API and cannot be combined with --use-wrangler", file=sys.stderr)
+        sys.exit(1)
+    if args.bulk and args.async_requests > 0:
+        print("ERROR: choose one of --bulk and --async-requests", file=sys.stderr)
+        sys.exit(1)
+    if (args.bulk or args.use_wrangler) and args.skip_existing and args.exists_check == 'get':
+        print("ERROR: --exists-check get sends a GET per key and cannot be combined with --bulk or --use-wrangler", file=sys.stderr)
+        sys.exit(1)
+    if args.delete_missing and not args.hash_index:
+        print("ERROR: --delete-missing needs --hash-index (the record of which keys came from which input)", file=sys.stderr)
+        sys.exit(1)
+    if args.value_encoding != 'json' and args.only_json:
+        print("ERROR: --only-json writes JSON objects and cannot be combined with --value-encoding", file=sys.stderr)
+        sys.exit(1)
+    if args.retry_failed:
+        # a replay reads single rows of a few files, so nothing that needs whole files applies
+        for flag, given in (('--only-json', args.only_json), ('--layout shard', args.layout == 'shard'),
+                            ('--manifest', args.manifest), ('--delete-missing', args.delete_missing)):
+            if given:
+                print(f"ERROR: --retry-failed replays single rows and cannot be combined with {flag}", file=sys.stderr)
+                sys.exit(1)
+        if not os.path.isfile(args.failure_journal):
+            print(f"ERROR: --retry-failed: no failure journal at {args.failure_journal}", file=sys.stderr)
+            sys.exit(1)
+    if args.layout == 'shard':
+        # a shard holds meshes from several input files, so it is rebuilt from every input on each run
+        for flag, given in (('--manifest', args.manifest), ('--skip-existing', args.skip_existing),
+                            ('--delete-missing', args.delete_missing), ('--only-json', args.only_json)):
+            if given:
+                print(f"ERROR: {flag} works per mesh and cannot be combined with --layout shard", file=sys.stderr)
+                sys.exit(1)
+        if not 1 <= args.shard_prefix_len < 9:
+            print("ERROR: --shard-prefix-len must be between 1 and 8", file=sys.stderr)
+            sys.exit(1)
+    if args.encode_workers > 0 and not (args.parallel > 0 or args.async_requests > 0 or args.bulk or args.use_wrangler
+                                        or args.layout == 'shard'):
+        print("ERROR: --encode-workers feeds --parallel, --async-requests, --bulk, --use-wrangler or --layout shard", file=sys.stderr)
+        sys.exit(1)
+    if args.adaptive and not (args.parallel > 0 or args.async_requests > 0):
+        print("ERROR: --adaptive needs --parallel N or --async-requests N (the starting concurrency)", file=sys.stderr)
+        sys.exit(1)
+    limiter = None
+    metrics = Metrics()
+    if args.use_wrangler and args.parallel > 0:
+        log("WARNING: --parallel is ignored with --use-wrangler: rows are written one wrangler kv bulk put per batch")
+    if args.adaptive and not (args.only_json or args.dry_run or args.bulk or args.use_wrangler):
+        limiter = AdaptiveLimiter(args.async_requests or args.parallel, args.min_concurrency, args.max_concurrency, on_change=log)
+    async_client = None
+    bulk_writer = None
+    if args.async_requests > 0 and not (args.only_json or args.dry_run):
+        async_client = AsyncKVClient(args.async_requests, args.connections, limiter=limiter)
+    bulk_url = f'{api_base}/accounts/{account_id}/storage/kv/namespaces/{namespace_id}/bulk'
+    if args.use_wrangler and not (args.only_json or args.dry_run):
+        # one `wrangler kv bulk put` per batch instead of a wrangler process per key; the wrangler path
+        # stores bare key codes
+        bulk_writer = WranglerBulkWriter(wrangler_ns, lambda kv_key: kv_key.replace(KV_KEY_PREFIX, ''), retries=args.retries,
+                                         metrics=metrics)
+    elif args.bulk and not (args.only_json or args.dry_run):
+        bulk_writer = BulkWriter(bulk_url, headers, retries=args.retries, metrics=metrics)
+    # --skip-existing: list the namespace once and check rows locally (--exists-check get: a GET per row)
+    existing_keys = None
+    if args.skip_existing and args.exists_check == 'list' and not (args.only_json or args.dry_run):
+        started = time.monotonic()
+        list_stats = {}
+        try:
+            if args.use_wrangler:
+                # the wrangler path stores bare key codes
+                names = (KV_KEY_PREFIX + name for name in wrangler_list_keys(wrangler_ns))
+            else:
+                keys_url = f'{api_base}/accounts/{account_id}/storage/kv/namespaces/{namespace_id}/keys'
+                names = list_keys(keys_url, headers, KV_KEY_PREFIX, retries=args.retries, stats=list_stats,
+                                  metrics=metrics)
+            existing_keys = KeySet(KV_KEY_PREFIX, names)
+        except (RuntimeError, ValueError, OSError, subprocess.SubprocessError) as e:
+            print(f"ERROR: cannot list existing keys: {e}", file=sys.stderr)
+            sys.exit(1)
+        log(f"Listed {len(existing_keys)} existing keys in {time.monotonic() - started:.1f}s "
+            f"({list_stats.get('requests', 1)} list requests, ~{existing_keys.memory_bytes() // 1024} KiB in memory)")
+    # --hash-index: only new or changed values are sent; --delete-missing removes keys whose rows are gone
+    hash_index = None
+    vanished = []  # (key, input file name) candidates for --delete-missing
+    if args.hash_index and not (args.only_json or args.dry_run):
+        hash_index = HashIndex(args.hash_index, {'namespace': wrangler_ns if args.use_wrangler else namespace_id,
+                                                 'to_array_htksaki': args.to_array_htksaki})
+    # --parallel: one pool for the whole run, fed through a bounded window of submitted rows
+    executor = None
+    queue_size = 0
+    if args.parallel and args.parallel > 0 and not (async_client or bulk_writer or args.only_json or args.dry_run):
+        # with --adaptive the window is the limiter's current limit, so threads cover its upper bound
+        executor = ThreadPoolExecutor(max_workers=limiter.maximum if limiter else args.parallel)
+        queue_size = max(args.queue_size or 2 * args.parallel, args.parallel)
+    # --encode-workers: row encoding moves to a process pool; read / encode / upload are counted either way
+    encode_pool = None
+    if args.encode_workers > 0 and (async_client or bulk_writer or executor or args.layout == 'shard'):
+        encode_pool = EncodePool(args.encode_workers, args.encode_chunk_rows)
+    stages = StageCounters(encode_pool.workers if encode_pool else 0)
+    encode_stage = encode_pool.encode if encode_pool else encode_rows
+
+    # --value-encoding array / binary: the column order the values refer to is written once, before any value
+    encoding_stats = EncodingStats(args.value_encoding)
+    if args.value_encoding != 'json' and not args.dry_run:
+        descriptor_key = schema_key()
+        descriptor_item = {
+            'kv_key': descriptor_key,
+            'payload': json.dumps(schema_descriptor(), ensure_ascii=False).encode('utf-8'),
+            'headers': headers,
+            'put_url': put_url_base + requests.utils.requote_uri(descriptor_key) if put_url_base else None,
+            'skip_existing': False,
+            'retries': args.retries,
+            'metrics': metrics,
+        }
+        if args.use_wrangler:
+            [(_, result)] = bulk_writer.put(next(pack_batches([descriptor_item])))
+        else:
+            result = process_single(descriptor_item)
+        if result[1] is not True:
+            print(f"ERROR: cannot write schema descriptor {descriptor_key}: {result[2]}", file=sys.stderr)
+            sys.exit(1)
+        log(f"Wrote schema descriptor {descriptor_key}")
+    # --layout shard: keyed rows are spooled to disk and uploaded as shards once every file has been read
+    shard_builder = ShardBuilder(args.shard_prefix_len) if args.layout == 'shard' else None
 
     csv_paths = sorted(glob.glob(os.path.join(args.indir, '*')))
-    # load checkpoint
-    chk = load_checkpoint(args.checkpoint_file)
-    resume_file = None
-    resume_index = 0
-    if chk:
-        resume_file = chk.get('file')
-        resume_index = chk.get('index', 0)
+    # --retry-failed: the journaled rows per file instead of the input directory
+    replay = None
+    unreplayable = []
+    if args.retry_failed:
+        try:
+            replay, unreplayable = read_journal(args.failure_journal)
+        except OSError as e:
+            print(f"ERROR: cannot read failure journal {args.failure_journal}: {e}", file=sys.stderr)
+            sys.exit(1)
+        csv_paths = sorted(replay)
+        log(f"Retrying {sum(len(entries) for entries in replay.values())} failed rows from {len(csv_paths)} files "
+            f"in {args.failure_journal}")
+    manifest = None
+    if args.manifest:
+        if args.only_json:
+            target = {'only_json': os.path.abspath(args.outdir), 'json_layout': args.json_layout}
+            if args.json_layout != 'files':
+                target['json_part_bytes'] = args.json_part_bytes
+        else:
+            target = {'namespace': wrangler_ns if args.use_wrangler else namespace_id}
+        if args.value_encoding != 'json':
+            target['value_encoding'] = args.value_encoding
+        manifest = Manifest(args.manifest, {**target, 'to_array_htksaki': args.to_array_htksaki})
+    # checkpoint: the done rows of every input file; a shard run always reads every file, and --only-json
+    # rewrites the outputs of every input it reads
+    checkpoint = Checkpoint(args.checkpoint_file, csv_paths) if shard_builder is None and json_output is None else None
 
     total = 0
     success = 0
     skipped = 0
     failed = 0
-    failures = []
+    # failures are streamed to the journal; a replay rewrites it with what still fails, any other run
+    # drops the entries of rows that are done now on close
+    failures = FailureJournal(None if args.dry_run else args.failure_journal, replace=args.retry_failed)
+    for entry in unreplayable:
+        failures.carry(entry)
+    if unreplayable:
+        log(f"Kept {len(unreplayable)} journal entries without an input row (files that failed as a whole, shards, "
+            f"deletes): rerun without --retry-failed for those")
+
+    unchanged_inputs = 0
+    # rows without a key (e.g. the description row under the header) fail on every run,
+    # so they do not keep a file out of the manifest
+    missing_keys = 0
 
     processed_since_checkpoint = 0
     processed_total = 0
 
-    def log(msg):
-        print(msg)
-        if args.log_file:
-            with open(args.log_file, 'a', encoding='utf-8') as lf:
-                lf.write(msg + '\n')
+    # --stats-interval: throughput and ETA from the share of the input bytes read so far; inputs that
+    # are skipped (done, unchanged) drop out of the total instead of counting as read
+    input_sizes = {}
+    for path in csv_paths:
+        try:
+            input_sizes[path] = os.path.getsize(path)
+        except OSError:
+            input_sizes[path] = 0
+    input_total = sum(input_sizes.values())
+    input_done = 0
+    current_reader = None
+
+    def input_snapshot():
+        reader_now = current_reader
+        position = input_done + (reader_now.text.offset if reader_now is not None else 0)
+        return success + skipped + failed, min(position, input_total), input_total
+
+    run_started = time.monotonic()
+    reporter = ThroughputReporter(metrics, input_snapshot, log, args.stats_interval)
+    reporter.start()
 
     for path in csv_paths:
-        # handle resume skipping files
-        if resume_file and os.path.abspath(path) < os.path.abspath(resume_file):
+        # resume: files whose rows are all done are not opened again
+        progress = checkpoint.progress(path) if checkpoint is not None else FileProgress()
+        if checkpoint is not None and os.path.abspath(path) in checkpoint.dropped:
+            log(f"Checkpoint for {os.path.basename(path)} ignored: the file changed since it was written")
+        replay_entries = None
+        if replay is not None:
+            replay_entries, stale = split_stale(path, replay[path])
+            for entry in stale:
+                failures.carry(entry)
+            if stale:
+                log(f"Kept {len(stale)} journal entries for {os.path.basename(path)}: the file changed or is gone since they were written")
+            # rows a later run already wrote are done
+            replay_entries = [entry for entry in replay_entries if entry['row'] not in progress.done]
+            if not replay_entries:
+                input_total -= input_sizes[path]
+                continue
+        if progress.complete:
+            failures.settle(path)
+            input_total -= input_sizes[path]
+            continue
+        # unchanged since its last clean upload: a stat (and at most a hash) instead of re-reading it
+        if manifest is not None and os.path.isfile(path) and \
+                manifest.unchanged(path, check_outputs=json_output is not None and args.json_layout != 'files'):
+            unchanged_inputs += 1
+            failures.settle(path)  # uploaded without failures since
+            input_total -= input_sizes[path]
             continue
+        failed_before = failed - missing_keys
+        total_before = total
         try:
-            fieldnames, rows, used_enc = read_csv_stream(path)
+            reader = open_csv_stream(path, encodings=ENCODINGS)
         except Exception as e:
             log(f"Failed to read {path}: {e}")
             continue
+        fieldnames = reader.header
+        if not fieldnames:
+            reader.close()
+            log(f"Failed to read {path}: no header")
+            continue
+        # header work (column matching, JSON key normalisation) happens once per file
+        schema = CompiledSchema(fieldnames, to_array_htksaki=args.to_array_htksaki)
         key_field = find_key_field(fieldnames)
-
-        start_idx = 0
-        if resume_file and os.path.abspath(path) == os.path.abspath(resume_file):
-            start_idx = resume_index
-
-        # sequential processing
-        if args.parallel and args.parallel > 0:
-            # process rows and execute upload batches as we read to avoid large memory use
-            batch = []
-            last_processed_idx = None
-            for idx, row in enumerate(rows):
-                if idx < start_idx:
-                    continue
+        key_index = len(fieldnames) - 1 - fieldnames[::-1].index(key_field)
+        try:
+            encoder = ValueEncoder(args.value_encoding, schema.json_keys)
+        except ValueError as e:
+            reader.close()
+            log(f"Failed to read {path}: {e}")
+            failed += 1
+            failures.add(None, str(e), path=path)
+            continue
+        read_errors = []
+        # resume: seek to the first row that is not done instead of parsing the rows before it
+        first_row = 0
+        position = progress.seek_position() if replay_entries is None else None
+        if position is not None:
+            first_row, offset, line_no = position
+            reader.seek(offset, line_no)
+            input_total -= offset  # the rows before it are not read again
+        current_reader = reader
+
+        def guarded_rows(reader=reader, read_errors=read_errors, progress=progress, first_row=first_row):
+            # (row index, row) for the rows not done yet; stop the file cleanly on a mid-file encoding
+            # break (reported after the loop)
+            idx = first_row
+            try:
+                for row in reader:
+                    if not row:
+                        continue
+                    if idx not in progress.done:
+                        progress.seen(idx, reader.row_offset, reader.row_line_no, reader.text.offset, reader.text.line_no)
+                        yield idx, row
+                    idx += 1
+                progress.finish(idx)
+            except EncodingError as e:
+                read_errors.append(e)
+            finally:
+                reader.close()
+
+        replay_kept = []
+
+        def replayed_rows(reader=reader, read_errors=read_errors, progress=progress, entries=replay_entries,
+                          key_index=key_index, replay_kept=replay_kept):
+            # --retry-failed: each journaled row read at its offset; one that no longer holds its key stays in
+            # the journal as it is
+            try:
+                for entry in entries:
+                    reader.seek(entry['offset'], entry.get('line') or 0)
+                    row = next(reader, None)
+                    key_clean = clean_raw_value(row[key_index]) if row and key_index < len(row) else None
+                    if key_clean is None or KV_KEY_PREFIX + key_clean != entry['key']:
+                        failures.carry(entry)
+                        replay_kept.append(entry)
+                        continue
+                    progress.seen(entry['row'], reader.row_offset, reader.row_line_no, reader.text.offset, reader.text.line_no)
+                    yield entry['row'], row
+            except EncodingError as e:
+                read_errors.append(e)
+            finally:
+                reader.close()
+
+        def row_failed(kv_key, reason, row):
+            failures.add(kv_key, reason, path=path, row=row, position=progress.position(row))
+
+        rows = guarded_rows() if replay_entries is None else replayed_rows()
+        if json_output is not None:
+            json_output.begin(path)
+
+        # --hash-index: keys last written from this file, and the keys met in it during this run
+        source_name = os.path.basename(path)
+        known_hashes = hash_index.load_source(source_name) if hash_index is not None else None
+        seen_keys = set()
+
+        def value_unchanged(kv_key, payload):
+            """(unchanged, digest) against the hash index; a key last written from another file is compared too."""
+            digest = value_hash(payload)
+            stored = known_hashes.get(kv_key)
+            if stored is None:
+                stored = hash_index.lookup(kv_key)
+                if stored == digest:
+                    hash_index.stage(kv_key, digest, source_name)  # now comes from this file
+            return stored == digest, digest
+
+        # rows for the asyncio / bulk / --parallel paths: per-row accounting happens here, the upload result
+        # arrives later through record_result
+        def prepared_items(rows=rows):
+            nonlocal total, failed, missing_keys
+            # rows already in KV are skipped before they are encoded
+            wanted = (lambda key: KV_KEY_PREFIX + key not in existing_keys) if existing_keys is not None else None
+            for idx, key_clean, payload, others in encode_stage(rows, schema, encoder, key_index, stages, wanted):
                 total += 1
-                json_obj = process_row_to_json(fieldnames, row, to_array_htksaki=args.to_array_htksaki)
-                key_raw = row.get(key_field)
-                key_clean = clean_raw_value(key_raw)
                 if key_clean is None:
                     failed += 1
-                    failures.append((None, "missing key_code"))
-                    continue
-                # safe filename base from key_clean
-                safe_name = re.sub(r'[^0-9A-Za-z._-]', '_', str(key_clean))
-                if args.only_json:
-                    out_path = os.path.join(args.outdir, f"{safe_name}.json")
-                    try:
-                        with open(out_path, 'w', encoding='utf-8') as of:
-                            json.dump(json_obj, of, ensure_ascii=False)
-                        success += 1
-                    except Exception as e:
-                        failed += 1
-                        failures.append((key_clean, f"write failed: {e}"))
+                    missing_keys += 1
+                    failures.add(None, "missing key_code", journal=False)
+                    progress.mark(idx)  # fails the same way on every run
                     continue
                 kv_key = KV_KEY_PREFIX + str(key_clean)
-                payload = json.dumps(json_obj, ensure_ascii=False).encode('utf-8')
+                if hash_index is not None:
+                    seen_keys.add(kv_key)
+                if payload is None:
+                    record_result(kv_key, 'skipped', 'exists', row_index=idx)
+                    continue
+                encoding_stats.add(len(payload), others)
                 if len(payload) > SIZE_WARNING_BYTES:
                     log(f"WARNING: value for {kv_key} is {len(payload)} bytes (> {SIZE_WARNING_BYTES})")
-                if args.dry_run:
-                    log(f"[DRY RUN] PUT {kv_key}")
-                    log(f"[DRY RUN] SAMPLE JSON: {json.dumps(json_obj, ensure_ascii=False)[:1000]}")
-                    success += 1
-                    continue
-                put_url = put_url_base + requests.utils.requote_uri(kv_key)
-                batch.append({
+                digest = None
+                if hash_index is not None:
+                    unchanged, digest = value_unchanged(kv_key, payload)
+                    if unchanged:
+                        record_result(kv_key, 'skipped', 'unchanged', row_index=idx)
+                        continue
+                yield {
                     'kv_key': kv_key,
                     'payload': payload,
                     'headers': headers,
-                    'put_url': put_url,
-                    'skip_existing': args.skip_existing,
+                    'put_url': put_url_base + requests.utils.requote_uri(kv_key) if put_url_base else None,
+                    'content_type': encoder.content_type,
+                    'skip_existing': args.skip_existing and existing_keys is None,
                     'retries': args.retries,
-                    'use_wrangler': args.use_wrangler,
-                    'wrangler_ns': wrangler_ns,
+                    'limiter': limiter,
+                    'metrics': metrics,
                     'row_index': idx,
-                })
-
-                # if batch is full, execute it
-                if args.upload_batch_size and len(batch) >= args.upload_batch_size:
-                    last_processed_idx = None
-                    with ThreadPoolExecutor(max_workers=args.parallel) as ex:
-                        futures = {ex.submit(process_single, t): t for t in batch}
-                        for fut in as_completed(futures):
-                            t = futures[fut]
-                            kv_key, ok_flag, msg = fut.result()
-                            if ok_flag is True:
-                                success += 1
-                            elif ok_flag == 'skipped':
-                                skipped += 1
-                            else:
-                                failed += 1
-                                failures.append((kv_key, msg))
-                            processed_since_checkpoint += 1
-                            processed_total += 1
-                            try:
-                                last_processed_idx = max(last_processed_idx, t.get('row_index')) if last_processed_idx is not None else t.get('row_index')
-                            except Exception:
-                                pass
-                            if args.progress_every and processed_total % args.progress_every == 0:
-                                log(f"Progress: processed={processed_total} total={total} success={success} skipped={skipped} failed={failed}")
-                            if processed_since_checkpoint >= args.checkpoint_every:
-                                save_checkpoint(args.checkpoint_file, {'file': os.path.abspath(path), 'index': (last_processed_idx + 1) if last_processed_idx is not None else 0})
-                                processed_since_checkpoint = 0
-                    if last_processed_idx is not None:
-                        save_checkpoint(args.checkpoint_file, {'file': os.path.abspath(path), 'index': last_processed_idx + 1})
-                    log(f"Completed upload batch for file {os.path.basename(path)}: items {idx - len(batch) + 1}-{idx+1}")
-                    if args.sleep and args.sleep > 0:
+                    'hash': digest,
+                }
+
+        def record_result(kv_key, ok_flag, msg, item=None, row_index=None):
+            nonlocal success, skipped, failed, processed_since_checkpoint, processed_total
+            if ok_flag is True:
+                success += 1
+                if item is not None and item.get('hash') is not None:
+                    hash_index.stage(kv_key, item['hash'], source_name)
+            elif ok_flag == 'skipped':
+                skipped += 1
+            else:
+                failed += 1
+                row_failed(kv_key, msg, item['row_index'] if item is not None else row_index)
+            if ok_flag is True or ok_flag == 'skipped':
+                # failed rows stay outside the done ranges, so a resume sends exactly those again
+                progress.mark(item['row_index'] if item is not None else row_index)
+            if item is not None:
+                stages.rows['upload'] += 1
+            processed_since_checkpoint += 1
+            processed_total += 1
+            if args.progress_every and processed_total % args.progress_every == 0:
+                log(f"Progress: processed={processed_total} total={total} success={success} skipped={skipped} failed={failed}")
+            if processed_since_checkpoint >= args.checkpoint_every:
+                checkpoint.save()
+                processed_since_checkpoint = 0
+
+        # upload stage time = wall time of the network path minus the time it spent waiting on read / encode
+        dispatch_started = time.perf_counter()
+        producing_before = stages.producing
+        if shard_builder is not None:
+            for idx, key_clean, payload, others in encode_stage(rows, schema, encoder, key_index, stages):
+                total += 1
+                if key_clean is None:
+                    failed += 1
+                    missing_keys += 1
+                    failures.add(None, "missing key_code", journal=False)
+                    continue
+                encoding_stats.add(len(payload), others)
+                shard_builder.add(key_clean, payload)
+            log(f"Read file {os.path.basename(path)} into shards: {total - total_before} rows")
+        elif bulk_writer is not None:
+            # one bulk request per packed batch, in order, and the checkpoint is saved after each one
+            for batch in pack_batches(prepared_items(), args.bulk_max_keys, args.bulk_max_bytes):
+                for item, result in bulk_writer.put(batch):
+                    record_result(*result, item=item)
+                checkpoint.save()
+                processed_since_checkpoint = 0
+                log(f"Completed bulk request for file {os.path.basename(path)}: {len(batch)} keys, rows up to {batch[-1][0]['row_index'] + 1}")
+            stages.seconds['upload'] += time.perf_counter() - dispatch_started - (stages.producing - producing_before)
+        elif async_client is not None:
+            # asyncio engine: rows are read as request slots free up; completions arrive out of order
+            # and are recorded row by row in the checkpoint
+            async_client.upload(prepared_items(), lambda item, result: record_result(*result, item=item))
+            stages.seconds['upload'] += time.perf_counter() - dispatch_started - (stages.producing - producing_before)
+            log(f"Completed file {os.path.basename(path)}: {async_client.pool.requests} requests over {async_client.pool.opened} connections so far")
+        elif executor is not None:
+            # sliding window over the long-lived thread pool: at most queue_size rows are submitted and
+            # unfinished; reading resumes as soon as any one completes instead of waiting for a whole batch.
+            # Completions arrive out of order and are recorded row by row in the checkpoint.
+            pending = {}
+
+            def finish(done):
+                for fut in done:
+                    item = pending.pop(fut)
+                    try:
+                        result = fut.result()
+                    except Exception as e:
+                        result = (item['kv_key'], False, f'{type(e).__name__}: {e}')
+                    record_result(*result, item=item)
+
+            submitted = 0
+            for item in prepared_items():
+                while len(pending) >= (limiter.limit if limiter else queue_size):
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    finish(done)
+                pending[executor.submit(process_single, item)] = item
+                submitted += 1
+                if args.upload_batch_size and submitted % args.upload_batch_size == 0:
+                    log(f"Submitted upload batch for file {os.path.basename(path)}: items up to {item['row_index'] + 1}")
+                    if args.sleep and args.sleep > 0 and limiter is None:
+                        # pacing only: the workers keep draining the queue meanwhile
                         time.sleep(args.sleep)
-                    batch = []
-
-            # flush remaining batch
-            if batch:
-                last_processed_idx = None
-                with ThreadPoolExecutor(max_workers=args.parallel) as ex:
-                    futures = {ex.submit(process_single, t): t for t in batch}
-                    for fut in as_completed(futures):
-                        t = futures[fut]
-                        kv_key, ok_flag, msg = fut.result()
-                        if ok_flag is True:
-                            success += 1
-                        elif ok_flag == 'skipped':
-                            skipped += 1
-                        else:
-                            failed += 1
-                            failures.append((kv_key, msg))
-                        processed_since_checkpoint += 1
-                        processed_total += 1
-                        try:
-                            last_processed_idx = max(last_processed_idx, t.get('row_index')) if last_processed_idx is not None else t.get('row_index')
-                        except Exception:
-                            pass
-                        if args.progress_every and processed_total % args.progress_every == 0:
-                            log(f"Progress: processed={processed_total} total={total} success={success} skipped={skipped} failed={failed}")
-                        if processed_since_checkpoint >= args.checkpoint_every:
-                            save_checkpoint(args.checkpoint_file, {'file': os.path.abspath(path), 'index': (last_processed_idx + 1) if last_processed_idx is not None else 0})
-                            processed_since_checkpoint = 0
-                if last_processed_idx is not None:
-                    save_checkpoint(args.checkpoint_file, {'file': os.path.abspath(path), 'index': last_processed_idx + 1})
-                log(f"Completed final upload batch for file {os.path.basename(path)}: items end")
-            # after file done, update checkpoint to next file start
-            # we don't know total rows without pre-reading; set checkpoint to last processed index if available
-            try:
-                last_idx = last_processed_idx
-            except NameError:
-                last_idx = None
-            save_checkpoint(args.checkpoint_file, {'file': os.path.abspath(path), 'index': (last_idx + 1) if last_idx is not None else 0})
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                finish(done)
+            stages.seconds['upload'] += time.perf_counter() - dispatch_started - (stages.producing - producing_before)
+            log(f"Completed file {os.path.basename(path)}")
         else:
             # sequential per row
-            for idx, row in enumerate(rows):
-                if idx < start_idx:
-                    continue
+            for idx, row in timed_rows(rows, stages):
                 total += 1
-                json_obj = process_row_to_json(fieldnames, row, to_array_htksaki=args.to_array_htksaki)
-                key_raw = row.get(key_field)
+                encode_started = time.perf_counter()
+                json_obj = schema.json_object(row)
+                encode_seconds = time.perf_counter() - encode_started
+                key_raw = row[key_index] if key_index < len(row) else None
                 key_clean = clean_raw_value(key_raw)
                 if key_clean is None:
                     failed += 1
-                    failures.append((None, "missing key_code"))
+                    missing_keys += 1
+                    failures.add(None, "missing key_code", journal=False)
+                    progress.mark(idx)
                     continue
-                safe_name = re.sub(r'[^0-9A-Za-z._-]', '_', str(key_clean))
-                if args.only_json:
-                    out_path = os.path.join(args.outdir, f"{safe_name}.json")
+                if json_output is not None:
+                    stages.encoded(encode_seconds)
+                    stages.rows['upload'] += 1
                     try:
-                        with open(out_path, 'w', encoding='utf-8') as of:
-                            json.dump(json_obj, of, ensure_ascii=False)
+                        json_output.write(key_clean, json_obj)
                         success += 1
-                    except Exception as e:
+                    except OSError as e:
                         failed += 1
-                        failures.append((key_clean, f"write failed: {e}"))
+                        failures.add(key_clean, f"write failed: {e}")
                     continue
                 kv_key = KV_KEY_PREFIX + str(key_clean)
-                payload = json.dumps(json_obj, ensure_ascii=False).encode('utf-8')
+                encode_started = time.perf_counter()
+                payload = encoder.encode(json_obj)
+                stages.encoded(encode_seconds + time.perf_counter() - encode_started)
+                encoding_stats.record(json_obj, payload)
                 if len(payload) > SIZE_WARNING_BYTES:
                     log(f"WARNING: value for {kv_key} is {len(payload)} bytes (> {SIZE_WARNING_BYTES})")
                 if args.dry_run:
@@ -483,68 +709,231 @@ def main():
                     log(f"[DRY RUN] SAMPLE JSON: {json.dumps(json_obj, ensure_ascii=False)[:1000]}")
                     success += 1
                     continue
-
-                # wrangler path (sequential)
-                if args.use_wrangler:
-                    # check existing
-                    if args.skip_existing:
-                        rc = wrangler_get(wrangler_ns, str(key_clean), max_retries=args.retries)
-                        if rc is None:
-                            failed += 1
-                            failures.append((kv_key, 'wrangler GET failed or wrangler not found'))
-                            continue
-                        if rc == 0:
-                            skipped += 1
-                            continue
-                    ok = wrangler_put(wrangler_ns, str(key_clean), payload, max_retries=args.retries)
-                    if ok:
-                        success += 1
-                    else:
-                        failed += 1
-                        failures.append((kv_key, 'wrangler PUT failed'))
-                    processed_since_checkpoint += 1
-                    if processed_since_checkpoint >= args.checkpoint_every:
-                        save_checkpoint(args.checkpoint_file, {'file': os.path.abspath(path), 'index': idx+1})
-                        processed_since_checkpoint = 0
+                if hash_index is not None:
+                    seen_keys.add(kv_key)
+                if existing_keys is not None and kv_key in existing_keys:
+                    skipped += 1
+                    progress.mark(idx)
                     continue
+                digest = None
+                if hash_index is not None:
+                    unchanged, digest = value_unchanged(kv_key, payload)
+                    if unchanged:
+                        skipped += 1
+                        progress.mark(idx)
+                        continue
 
-                # existing HTTP path
-                if args.skip_existing:
+                if args.skip_existing and existing_keys is None:
                     get_url = put_url_base + requests.utils.requote_uri(kv_key)
-                    resp = request_with_retry('GET', get_url, headers=headers, max_retries=args.retries)
+                    resp = request_with_retry('GET', get_url, headers=headers, max_retries=args.retries, metrics=metrics)
                     if resp is None:
                         failed += 1
-                        failures.append((kv_key, 'GET failed (no response)'))
+                        row_failed(kv_key, 'GET failed (no response)', idx)
                         continue
                     if resp.status_code == 200:
                         skipped += 1
+                        progress.mark(idx)
                         continue
                     if resp.status_code != 404:
                         failed += 1
-                        failures.append((kv_key, f'GET status {resp.status_code} body={resp.text[:200]}'))
+                        row_failed(kv_key, f'GET status {resp.status_code} body={resp.text[:200]}', idx)
                         continue
                 put_url = put_url_base + requests.utils.requote_uri(kv_key)
-                resp = request_with_retry('PUT', put_url, headers={**headers, 'Content-Type': 'application/json'}, data=payload, max_retries=args.retries)
+                resp = request_with_retry('PUT', put_url, headers={**headers, 'Content-Type': encoder.content_type}, data=payload, max_retries=args.retries, metrics=metrics)
+                stages.rows['upload'] += 1
                 if resp is None:
                     failed += 1
-                    failures.append((kv_key, 'PUT failed (no response)'))
+                    row_failed(kv_key, 'PUT failed (no response)', idx)
                 elif 200 <= resp.status_code < 300:
                     success += 1
+                    progress.mark(idx)
+                    if digest is not None:
+                        hash_index.stage(kv_key, digest, source_name)
                 else:
                     failed += 1
-                    failures.append((kv_key, f'PUT status {resp.status_code} body={resp.text[:200]}'))
+                    row_failed(kv_key, f'PUT status {resp.status_code} body={resp.text[:200]}', idx)
                 processed_since_checkpoint += 1
                 processed_total += 1
                 if args.progress_every and processed_total % args.progress_every == 0:
                     log(f"Progress: processed={processed_total} total={total} success={success} skipped={skipped} failed={failed}")
                 if processed_since_checkpoint >= args.checkpoint_every:
-                    save_checkpoint(args.checkpoint_file, {'file': os.path.abspath(path), 'index': idx+1})
+                    checkpoint.save()
                     processed_since_checkpoint = 0
                 # if we've reached an upload batch boundary, log and sleep
                 if args.upload_batch_size and processed_total % args.upload_batch_size == 0:
                     log(f"Completed upload batch: processed_total={processed_total}")
                     if args.sleep and args.sleep > 0:
                         time.sleep(args.sleep)
+            stages.seconds['upload'] += time.perf_counter() - dispatch_started - (stages.producing - producing_before)
+
+        for e in read_errors:
+            log(f"Failed to read {path}: {e}")
+            failed += 1
+            failures.add(None, str(e), path=path)
+        if replay_kept:
+            log(f"Kept {len(replay_kept)} journal entries for {os.path.basename(path)}: the row no longer holds the journaled key")
+        failures.settle(path, progress.done)
+        outputs = json_output.end() if json_output is not None else []
+        current_reader = None
+        input_done += input_sizes[path] - (position[1] if position is not None else 0)
+        if checkpoint is not None and not args.dry_run:
+            checkpoint.save()
+            processed_since_checkpoint = 0
+        if hash_index is not None:
+            hash_index.flush()
+            # a key recorded for this file but not met in it disappeared, if the whole file was read
+            if args.delete_missing and not progress.resumed and not read_errors:
+                vanished.extend((key, source_name) for key in known_hashes if key not in seen_keys)
+        if manifest is not None and not args.dry_run and failed - missing_keys == failed_before:
+            manifest.record(path, outputs, rows=total - total_before)
+            manifest.save()
+
+    if json_output is not None:
+        removed = json_output.prune(csv_paths)
+        if removed:
+            log(f"Removed {removed} JSON output parts of inputs that are gone")
+        log(json_output.summary())
+
+    if shard_builder is not None:
+        # success / skipped / failed count meshes, so the summary reads the same as the per-mesh layout
+        shards = 0
+        meshes = 0
+
+        def shard_items():
+            nonlocal shards, meshes, success, skipped
+            for prefix, entries in shard_builder.shards():
+                shards += 1
+                meshes += len(entries)
+                kv_key = SHARD_KEY_PREFIX + prefix
+                payload = encode_shard(prefix, entries)
+                if len(payload) > SIZE_WARNING_BYTES:
+                    log(f"WARNING: value for {kv_key} is {len(payload)} bytes (> {SIZE_WARNING_BYTES})")
+                digest = None
+                if hash_index is not None:
+                    digest = value_hash(payload)
+                    if hash_index.lookup(kv_key) == digest:
+                        skipped += len(entries)
+                        continue
+                if args.dry_run:
+                    log(f"[DRY RUN] PUT {kv_key} ({len(entries)} meshes, {len(payload)} bytes)")
+                    success += len(entries)
+                    continue
+                yield {
+                    'kv_key': kv_key,
+                    'payload': payload,
+                    'headers': headers,
+                    'put_url': put_url_base + requests.utils.requote_uri(kv_key) if put_url_base else None,
+                    'content_type': 'application/json' if args.value_encoding == 'json' else 'application/octet-stream',
+                    'skip_existing': False,
+                    'retries': args.retries,
+                    'limiter': limiter,
+                    'metrics': metrics,
+                    'meshes': len(entries),
+                    'hash': digest,
+                }
+
+        def record_shard(item, result):
+            nonlocal success, failed
+            kv_key, ok_flag, msg = result
+            if ok_flag is True:
+                success += item['meshes']
+                if item['hash'] is not None:
+                    hash_index.stage(kv_key, item['hash'], 'shards')
+            else:
+                failed += item['meshes']
+                failures.add(kv_key, msg)
+            if args.progress_every and shards % args.progress_every == 0:
+                log(f"Progress: shards={shards} meshes={meshes} success={success} skipped={skipped} failed={failed}")
+
+        if args.dry_run:
+            for _ in shard_items():
+                pass
+        elif bulk_writer is not None:
+            for batch in pack_batches(shard_items(), args.bulk_max_keys, args.bulk_max_bytes):
+                for item, result in bulk_writer.put(batch):
+                    record_shard(item, result)
+        elif async_client is not None:
+            async_client.upload(shard_items(), record_shard)
+        elif executor is not None:
+            pending = {}
+
+            def finish_shards(done):
+                for fut in done:
+                    item = pending.pop(fut)
+                    try:
+                        result = fut.result()
+                    except Exception as e:
+                        result = (item['kv_key'], False, f'{type(e).__name__}: {e}')
+                    record_shard(item, result)
+
+            for item in shard_items():
+                while len(pending) >= (limiter.limit if limiter else queue_size):
+                    finish_shards(wait(pending, return_when=FIRST_COMPLETED).done)
+                pending[executor.submit(process_single, item)] = item
+            finish_shards(wait(pending).done)
+        else:
+            for item in shard_items():
+                record_shard(item, process_single(item))
+        shard_builder.close()
+        log(f"Shards: {meshes} meshes in {shards} shards (key_code prefix length {args.shard_prefix_len})")
+
+    if hash_index is not None and args.delete_missing:
+        # inputs that are gone take all their keys with them; a key met again in a later file this run stays
+        input_names = {os.path.basename(p) for p in csv_paths}
+        for source in hash_index.sources():
+            if source not in input_names:
+                vanished.extend((key, source) for key in hash_index.load_source(source))
+        doomed = [key for key, source in vanished if hash_index.source_of(key) == source]
+        if doomed:
+            deleter = bulk_writer or BulkWriter(bulk_url, headers, retries=args.retries, metrics=metrics)
+            not_deleted = deleter.delete(doomed)
+            failed += len(not_deleted)
+            for key, msg in not_deleted:
+                failures.add(key, msg)
+            rejected = {key for key, _ in not_deleted}
+            hash_index.forget(key for key in doomed if key not in rejected)
+            log(f"Deleted keys missing from their input: {len(doomed) - len(not_deleted)} (failed {len(not_deleted)})")
+        else:
+            log("Deleted keys missing from their input: 0")
+    if hash_index is not None:
+        hash_index.close()
+    if executor is not None:
+        executor.shutdown()
+    if encode_pool is not None:
+        encode_pool.close()
+    if stages.rows['read']:
+        log(stages.summary())
+    if limiter is not None:
+        log(limiter.summary())
+    if async_client is not None:
+        async_client.close()
+    if bulk_writer is not None:
+        bulk_writer.close()
+        if args.use_wrangler:
+            log(f"wrangler kv bulk calls: {bulk_writer.requests}")
+        else:
+            log(f"Bulk requests sent: {bulk_writer.requests}")
+    reporter.stop()
+    if metrics.kinds:
+        log(metrics.summary())
+    if args.metrics_file:
+        elapsed = time.monotonic() - run_started
+        try:
+            write_report(args.metrics_file, {
+                'elapsed_s': round(elapsed, 3),
+                'rows': {'total': total, 'success': success, 'skipped': skipped, 'failed': failed,
+                         'rows_per_s': round((success + skipped + failed) / elapsed, 1) if elapsed > 0 else None},
+                'input_bytes': input_total,
+                'stages': stages.to_json(),
+                **metrics.to_json(),
+                'options': {name: getattr(args, name) for name in (
+                    'parallel', 'async_requests', 'connections', 'adaptive', 'bulk', 'bulk_max_keys', 'bulk_max_bytes',
+                    'use_wrangler', 'encode_workers', 'encode_chunk_rows', 'layout', 'value_encoding',
+                    'upload_batch_size', 'sleep', 'retries')},
+            })
+            log(f"Wrote metrics to {args.metrics_file}")
+        except OSError as e:
+            log(f"Failed to write metrics file {args.metrics_file}: {e}")
 
     # summary
     log("Done.")
@@ -552,10 +941,23 @@ def main():
     log(f"Success: {success}")
     log(f"Skipped: {skipped}")
     log(f"Failed: {failed}")
-    if failures:
-        log("Failures (sample up to 20):")
-        for k, msg in failures[:20]:
+    if encoding_stats.rows:
+        log(encoding_stats.summary())
+    if manifest is not None:
+        log(f"Unchanged inputs skipped: {unchanged_inputs}")
+    failures.close()
+    if failures.sample:
+        log(f"Failures (sample up to {SAMPLE_SIZE}):")
+        for k, msg in failures.sample:
             log(f"- {k}: {msg}")
+    if failures.dropped:
+        log(f"Failure journal: dropped {failures.dropped} entries (rows done now, files changed or read again, repeats)")
+    if failures.journaled:
+        log(f"Failure journal: {failures.journaled} entries in {args.failure_journal} (send them again with --retry-failed)")
+    elif (args.retry_failed or failures.dropped) and not args.dry_run:
+        log(f"Failure journal: every journaled row is done; {args.failure_journal} is empty")
+    if log_file is not None:
+        log_file.close()
 
 if __name__ == '__main__':
     main()
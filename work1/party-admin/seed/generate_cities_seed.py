@@ -1,13 +1,21 @@
+import argparse
+import os
 import requests
 import time
 import unicodedata
 import xml.etree.ElementTree as ET
 
+import sqlite_seed
+from seed_io import EncodingError, open_text_stream
+from sql_parts import D1_MAX_STATEMENT_BYTES, SqlPartWriter
+
 # --- 設定 ---
 INPUT_FILE = 'work1\\party-admin\\seed\\cities.txt'
 OUTPUT_FILE = 'work1\\party-admin\\seed\\02_seed_cities.sql'
 BATCH_SIZE = 1000  # 1000行ごとにINSERT文を区切る
 PREF_MAP = { '01': '北海道' } # 必要に応じて追加
+TABLE_NAME = 'm_cities'
+COLUMNS = ('city_code', 'pref_code', 'city_name', 'city_kana', 'latitude', 'longitude')
 
 def to_full_width_katakana(text):
     """半角カタカナを全角カタカナに変換（濁点結合含む）"""
@@ -33,16 +41,44 @@ def get_coords(pref_code, city_name):
         print(f"  [Error] {city_name}: {e}")
     return "0.0", "0.0"
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='市区町村マスター (m_cities) のシードを生成')
+    parser.add_argument('--sqlite', help='SQLファイルの代わりにローカル SQLite ファイルへ直接投入する (例: out.db)')
+    parser.add_argument('--dump', help='--sqlite 指定時: 投入した m_cities を D1 インポート用の SQL として書き出す')
+    return parser.parse_args()
+
+def load_sqlite(records, args):
+    """--sqlite: executemany でまとめて投入し、必要なら --dump で SQL を書き出す"""
+    conn = sqlite_seed.connect(args.sqlite, [TABLE_NAME])
+    try:
+        count = sqlite_seed.load_rows(conn, TABLE_NAME, COLUMNS, records, delete_first=True)
+        print(f"SQLite 投入完了: {args.sqlite} ({count}件)")
+        if args.dump:
+            os.makedirs(os.path.dirname(os.path.abspath(args.dump)), exist_ok=True)
+            # INSERT 文は BATCH_SIZE 件ごと、かつ D1 の1文あたりの上限を超えないように区切る
+            with SqlPartWriter(lambda part: args.dump, max_statement_rows=BATCH_SIZE,
+                               max_statement_bytes=D1_MAX_STATEMENT_BYTES) as writer:
+                writer.write_raw(f"DELETE FROM {TABLE_NAME};\n\n")
+                dumped = sqlite_seed.export_sql_parts(conn, TABLE_NAME, writer, columns=COLUMNS, on_conflict=None)
+            print(f"SQL ダンプ出力完了: {args.dump} ({dumped}件)")
+    finally:
+        conn.close()
+
 def main():
-    results = []
+    args = parse_args()
+    records = []
     
     print(f"ファイルを読み込み中: {INPUT_FILE}")
     try:
-        with open(INPUT_FILE, 'r', encoding='utf-8') as f:
+        # 文字コードは先頭サンプルから自動判定し、1行ずつデコードする
+        with open_text_stream(INPUT_FILE) as f:
             lines = [line.strip() for line in f if line.strip()]
     except FileNotFoundError:
         print(f"エラー: {INPUT_FILE} が見つかりません。")
         return
+    except EncodingError as e:
+        print(f"エラー: 文字コードエラー: {e}")
+        return
 
     print(f"合計 {len(lines)} 件の処理を開始します（{BATCH_SIZE}件ごとに分割出力）")
 
@@ -63,13 +99,21 @@ def main():
         lat, lng = get_coords(pref_code, city_name)
         print(f"[{i+1}/{len(lines)}] {city_name} -> {lat}, {lng}")
         
-        # 行データの作成
-        val = f"('{city_code}','{pref_code}','{city_name}','{city_kana_full}',{lat},{lng})"
-        results.append(val)
+        records.append((city_code, pref_code, city_name, city_kana_full, lat, lng))
         
         # API負荷軽減 (0.5秒待機)
         time.sleep(0.5)
 
+    if args.sqlite:
+        load_sqlite(records, args)
+        return
+
+    # 行データの作成
+    results = [
+        f"('{city_code}','{pref_code}','{city_name}','{city_kana_full}',{lat},{lng})"
+        for city_code, pref_code, city_name, city_kana_full, lat, lng in records
+    ]
+
     # SQLファイル作成
     with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
         f.write("BEGIN TRANSACTION;\n")
@@ -1,12 +1,17 @@
+import argparse
 import csv
 import hashlib
 import os
 
+import sqlite_seed
+from sql_parts import D1_MAX_STATEMENT_BYTES, SqlPartWriter
+
 # --- 設定 ---
 # Windowsのパスは r'' (raw文字列) を使うとバックスラッシュが扱いやすくなります
 input_file = r'work1\party-admin\seed\electoral_districts.txt'
 output_file = r'work1\party-admin\seed\04_seed_electoral_districts.sql'
 table_name = 'm_electoral_districts'
+columns = ('id', 'chamber_type_code', 'pref_code', 'district_number', 'name')
 
 def generate_hash(c_type, p_code, d_num):
     # カラムを結合した文字列を作成
@@ -14,6 +19,46 @@ def generate_hash(c_type, p_code, d_num):
     # SHA-256でハッシュ化
     return hashlib.sha256(target_str.encode('utf-8')).hexdigest()
 
+def read_rows():
+    """入力ファイルを読み込み、テーブルの行 (columns の順) を返す"""
+    rows = []
+    # encoding='utf-8-sig' にすることで、BOM付きUTF-8でも正常に読み込めます
+    with open(input_file, mode='r', encoding='utf-8-sig') as f_in:
+        # delimiter='\t' を指定してタブ区切りとして読み込む
+        reader = csv.DictReader(f_in, delimiter='\t')
+        for row in reader:
+            c_type = row['chamber_type_code']
+            p_code = row['pref_code']
+            d_num = row['district_number']
+            rows.append((generate_hash(c_type, p_code, d_num), c_type, p_code, d_num, row['name']))
+    return rows
+
+def load_sqlite(db_path, dump_path=None):
+    """--sqlite: ローカル SQLite に直接投入し、必要なら --dump で SQL を書き出す"""
+    try:
+        rows = read_rows()
+    except FileNotFoundError:
+        print(f"エラー: {input_file} が見つかりません。")
+        return
+    except KeyError as e:
+        print(f"エラー: タブ区切りの中にカラム {e} が見つかりません。")
+        return
+    conn = sqlite_seed.connect(db_path, [table_name])
+    try:
+        count = sqlite_seed.load_rows(conn, table_name, columns, rows, delete_first=True)
+        print(f"成功: {db_path} に {count} 件投入しました。")
+        if dump_path:
+            os.makedirs(os.path.dirname(os.path.abspath(dump_path)), exist_ok=True)
+            # INSERT 文は D1 の1文あたりの上限を超えないように区切る
+            with SqlPartWriter(lambda part: dump_path,
+                               max_statement_rows=sqlite_seed.DUMP_ROWS_PER_STATEMENT,
+                               max_statement_bytes=D1_MAX_STATEMENT_BYTES) as writer:
+                if not sqlite_seed.export_sql_parts(conn, table_name, writer, columns=columns):
+                    writer.write_raw('')  # 0件でもファイルは作る
+            print(f"成功: {dump_path} が作成されました。")
+    finally:
+        conn.close()
+
 def create_sql_insert():
     # 出力先ディレクトリが存在しない場合に作成
     output_dir = os.path.dirname(output_file)
@@ -21,26 +66,12 @@ def create_sql_insert():
         os.makedirs(output_dir)
 
     try:
-        # encoding='utf-8-sig' にすることで、BOM付きUTF-8でも正常に読み込めます
-        with open(input_file, mode='r', encoding='utf-8-sig') as f_in, \
-             open(output_file, mode='w', encoding='utf-8') as f_out:
-            
-            # delimiter='\t' を指定してタブ区切りとして読み込む
-            reader = csv.DictReader(f_in, delimiter='\t')
-            
+        rows = read_rows()
+        with open(output_file, mode='w', encoding='utf-8') as f_out:
             # トランザクション開始
             f_out.write("BEGIN TRANSACTION;\n")
             
-            for row in reader:
-                # 各値の取得
-                c_type = row['chamber_type_code']
-                p_code = row['pref_code']
-                d_num = row['district_number']
-                name = row['name']
-                
-                # ハッシュ値の計算
-                h_id = generate_hash(c_type, p_code, d_num)
-                
+            for h_id, c_type, p_code, d_num, name in rows:
                 # SQL文の作成 (シングルクォートのエスケープ処理)
                 safe_name = name.replace("'", "''")
                 sql = (f"INSERT INTO {table_name} "
@@ -61,4 +92,11 @@ def create_sql_insert():
         print("ファイルの1行目がタブで区切られているか、スペルが正しいか確認してください。")
 
 if __name__ == "__main__":
-    create_sql_insert()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='選挙区マスター (m_electoral_districts) のシードを生成')
+    parser.add_argument('--sqlite', help='SQLファイルの代わりにローカル SQLite ファイルへ直接投入する (例: out.db)')
+    parser.add_argument('--dump', help='--sqlite 指定時: 投入したテーブルを D1 インポート用の SQL として書き出す')
+    args = parser.parse_args()
+    if args.sqlite:
+        load_sqlite(args.sqlite, args.dump)
+    else:
+        create_sql_insert()
\ No newline at end of file
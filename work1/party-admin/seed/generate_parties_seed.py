@@ -1,10 +1,71 @@
+import argparse
 import csv
 import os
 
+import sqlite_seed
+from sql_parts import D1_MAX_STATEMENT_BYTES, SqlPartWriter
+
 # --- 設定 ---
 input_file = r'work1\party-admin\seed\parties.txt'  # 入力ファイル名
 output_file = r'work1\party-admin\seed\05_seed_parties.sql'  # 出力SQL
 table_name = 'm_parties' # テーブル名は適宜合わせてください
+# create.sql の m_parties に合わせたカラム
+columns = ('party_id', 'name', 'short_name', 'color_code', 'note', 'logo_url', 'is_active')
+
+def read_rows():
+    """入力ファイルを読み込み、テーブルの行 (columns の順) を返す"""
+    rows = []
+    # utf-8-sig でBOM対策
+    with open(input_file, mode='r', encoding='utf-8-sig') as f_in:
+        # タブ区切りとして読み込み
+        # ※もしデータがスペース区切りの場合は delimiter='\t' を消すか ' ' に変更してください
+        reader = csv.DictReader(f_in, delimiter='\t')
+        for row in reader:
+            # 空欄は NULL 扱い
+            rows.append((
+                row['party_id'],
+                row['name'],
+                row['short_name'] or None,
+                row['color_code'] or None,
+                row['notes'] or None,
+                row['logo_url'] or None,
+                int(row['is_active'] or 1),
+            ))
+    return rows
+
+def sql_literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, int):
+        return str(value)
+    # エスケープ処理
+    return "'" + value.replace("'", "''") + "'"
+
+def load_sqlite(db_path, dump_path=None):
+    """--sqlite: ローカル SQLite に直接投入し、必要なら --dump で SQL を書き出す"""
+    try:
+        rows = read_rows()
+    except FileNotFoundError:
+        print(f"エラー: {input_file} が見つかりません。")
+        return
+    except KeyError as e:
+        print(f"エラー: カラム {e} が見つかりません。ヘッダー（1行目）のタブ区切りを確認してください。")
+        return
+    conn = sqlite_seed.connect(db_path, [table_name])
+    try:
+        count = sqlite_seed.load_rows(conn, table_name, columns, rows, delete_first=True)
+        print(f"成功: {db_path} に {count} 件投入しました。")
+        if dump_path:
+            os.makedirs(os.path.dirname(os.path.abspath(dump_path)), exist_ok=True)
+            # INSERT 文は D1 の1文あたりの上限を超えないように区切る
+            with SqlPartWriter(lambda part: dump_path,
+                               max_statement_rows=sqlite_seed.DUMP_ROWS_PER_STATEMENT,
+                               max_statement_bytes=D1_MAX_STATEMENT_BYTES) as writer:
+                if not sqlite_seed.export_sql_parts(conn, table_name, writer, columns=columns):
+                    writer.write_raw('')  # 0件でもファイルは作る
+            print(f"成功: {dump_path} が作成されました。")
+    finally:
+        conn.close()
 
 def create_sql_insert():
     # 出力先ディレクトリの作成
@@ -13,39 +74,21 @@ def create_sql_insert():
         os.makedirs(output_dir)
 
     try:
-        # utf-8-sig でBOM対策
-        with open(input_file, mode='r', encoding='utf-8-sig') as f_in, \
-             open(output_file, mode='w', encoding='utf-8') as f_out:
-            
-            # タブ区切りとして読み込み
-            # ※もしデータがスペース区切りの場合は delimiter='\t' を消すか ' ' に変更してください
-            reader = csv.DictReader(f_in, delimiter='\t')
-            
+        rows = read_rows()
+        with open(output_file, mode='w', encoding='utf-8') as f_out:
             f_out.write("BEGIN TRANSACTION;\n")
-            
-            for row in reader:
-                # 各カラムの抽出
-                p_id = row['party_id']
-                name = row['name']
-                color = row['party_color']
-                notes = row['notes']
-                c_at = row['created_at']
-                u_at = row['updated_at']
-                alive = row['alive']
-                
-                # エスケープ処理
-                safe_name = name.replace("'", "''")
-                safe_notes = notes.replace("'", "''")
-                
+
+            for row in rows:
                 # SQLの組み立て
+                values = ', '.join(sql_literal(v) for v in row)
                 sql = (f"INSERT INTO {table_name} "
-                       f"(id, name, color_code, notes, created_at, updated_at, alive) "
-                       f"VALUES ('{p_id}', '{safe_name}', '{color}', '{safe_notes}', '{c_at}', '{u_at}', {alive});\n")
-                
+                       f"({', '.join(columns)}) "
+                       f"VALUES ({values});\n")
+
                 f_out.write(sql)
-            
+
             f_out.write("COMMIT;\n")
-            
+
         print(f"成功: {output_file} が作成されました。")
 
     except FileNotFoundError:
@@ -54,4 +97,11 @@ def create_sql_insert():
         print(f"エラー: カラム {e} が見つかりません。ヘッダー（1行目）のタブ区切りを確認してください。")
 
 if __name__ == "__main__":
-    create_sql_insert()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='政党マスター (m_parties) のシードを生成')
+    parser.add_argument('--sqlite', help='SQLファイルの代わりにローカル SQLite ファイルへ直接投入する (例: out.db)')
+    parser.add_argument('--dump', help='--sqlite 指定時: 投入したテーブルを D1 インポート用の SQL として書き出す')
+    args = parser.parse_args()
+    if args.sqlite:
+        load_sqlite(args.sqlite, args.dump)
+    else:
+        create_sql_insert()
@@ -1,25 +1,75 @@
+import argparse
 import os
 
+import sqlite_seed
+from seed_io import EncodingError, open_text_stream
+from sql_parts import D1_MAX_STATEMENT_BYTES, SqlPartWriter, size_report
+
 # --- 設定 ---
 INPUT_FILE = 'work1/party-admin/seed/towns.txt'
 OUTPUT_DIR = 'work1/party-admin/seed/03_seed_towns'
 OUTPUT_BASE_NAME = '03_seed_towns'
 FILE_SPLIT_SIZE = 10000  # 10,000件ごとにファイルを分割
 INSERT_BATCH_SIZE = 1000 # INSERT文の中のVALUESは1,000件ごと
+TABLE_NAME = 'm_towns'
+COLUMNS = ('key_code', 'pref_code', 'city_code', 'level', 'town_name',
+           'latitude', 'longitude', 'population', 'male', 'female', 'households')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='町丁・字マスター (m_towns) のシードを生成')
+    parser.add_argument('--sqlite', help='SQLファイルの代わりにローカル SQLite ファイルへ直接投入する (例: out.db)')
+    parser.add_argument('--dump', help='--sqlite 指定時: 投入した m_towns を D1 インポート用の SQL として書き出す')
+    parser.add_argument('--max-part-bytes', type=int,
+                        help='1ファイルのバイト数上限。指定時は FILE_SPLIT_SIZE の件数ではなくサイズで詰めて分割する')
+    parser.add_argument('--max-statement-bytes', type=int,
+                        help=f'INSERT文1つのバイト数上限 (既定: D1 の上限 {D1_MAX_STATEMENT_BYTES})。'
+                             '指定時は INSERT_BATCH_SIZE の件数ではなくサイズで詰める。'
+                             '未指定でも、INSERT_BATCH_SIZE 件が既定の上限を超える文はそこで分割する'
+                             '(SQL ファイル出力と --dump の両方)')
+    return parser.parse_args()
+
+def statement_limits(args):
+    """INSERT文は1,000件ごと（--max-statement-bytes 指定時はサイズで詰める）。
+    どちらの場合も D1 の1文あたりの上限 (D1_MAX_STATEMENT_BYTES) を超える文は分割する"""
+    return {
+        'max_statement_rows': None if args.max_statement_bytes else INSERT_BATCH_SIZE,
+        'max_statement_bytes': args.max_statement_bytes or D1_MAX_STATEMENT_BYTES,
+    }
+
+def load_sqlite(records, args):
+    """--sqlite: executemany でまとめて投入し、必要なら --dump で SQL を書き出す"""
+    conn = sqlite_seed.connect(args.sqlite, [TABLE_NAME])
+    try:
+        # 数値列は文字列のまま渡し、カラムの型アフィニティで INTEGER/REAL に変換させる
+        count = sqlite_seed.load_rows(conn, TABLE_NAME, COLUMNS, records, delete_first=True)
+        print(f"SQLite 投入完了: {args.sqlite} ({count}件)")
+        if args.dump:
+            os.makedirs(os.path.dirname(os.path.abspath(args.dump)), exist_ok=True)
+            # 1ファイルにまとめ、INSERT 文は SQL ファイル出力と同じ件数・バイト数で区切る
+            with SqlPartWriter(lambda part: args.dump, header_for=lambda part: "-- D1 Seed Data (m_towns)\n",
+                               **statement_limits(args)) as writer:
+                writer.write_raw(f"DELETE FROM {TABLE_NAME};\n\n")
+                dumped = sqlite_seed.export_sql_parts(conn, TABLE_NAME, writer, columns=COLUMNS, on_conflict=None)
+            print(f"SQL ダンプ出力完了: {args.dump} ({dumped}件)")
+    finally:
+        conn.close()
 
 def main():
+    args = parse_args()
+    records = []
     results = []
-    
-    # 出力先ディレクトリの作成
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
 
     print(f"ファイルを読み込み中: {INPUT_FILE}")
     try:
-        with open(INPUT_FILE, 'r', encoding='utf-8') as f:
+        # 文字コードは先頭サンプルから自動判定し、1行ずつデコードする
+        with open_text_stream(INPUT_FILE) as f:
             lines = [line.strip() for line in f if line.strip()]
     except FileNotFoundError:
         print(f"エラー: {INPUT_FILE} が見つかりません。")
         return
+    except EncodingError as e:
+        print(f"エラー: 文字コードエラー: {e}")
+        return
 
     total = len(lines)
     print(f"合計 {total} 件のデータを処理中...")
@@ -34,7 +84,7 @@ def main():
         pref_code  = parts[1]
         city_code  = parts[2]
         level      = parts[3]
-        town_name  = parts[4].replace("'", "''") # SQLエスケープ
+        town_name  = parts[4]
         pop        = parts[5]
         male       = parts[6]
         female     = parts[7]
@@ -42,43 +92,57 @@ def main():
 
         lat, lng = "0.0", "0.0"
 
+        records.append((key_code, pref_code, city_code, level, town_name,
+                        lat, lng, pop, male, female, households))
+
+    if args.sqlite:
+        load_sqlite(records, args)
+        return
+
+    # 出力先ディレクトリの作成
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    for key_code, pref_code, city_code, level, town_name, lat, lng, pop, male, female, households in records:
+        town_name = town_name.replace("'", "''") # SQLエスケープ
         val = (
             f"('{key_code}','{pref_code}','{city_code}','{level}','{town_name}',"
             f"{lat},{lng},{pop},{male},{female},{households})"
         )
         results.append(val)
 
-    # 2. 10,000件ごとに分割してファイル書き出し
-    file_count = 0
-    for start_idx in range(0, len(results), FILE_SPLIT_SIZE):
-        file_count += 1
-        chunk = results[start_idx : start_idx + FILE_SPLIT_SIZE]
-        output_file = os.path.join(OUTPUT_DIR, f"{OUTPUT_BASE_NAME}_{file_count}.sql")
-        
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(f"-- D1 Seed Data Part {file_count}\n")
-            f.write("BEGIN TRANSACTION;\n")
-            
-            # 最初のファイルの最初だけDELETE文を入れる（既存データをリセットする場合）
-            if file_count == 1:
-                f.write("DELETE FROM m_towns;\n\n")
-
-            # INSERT文を1,000件ごとに分割
-            for j in range(0, len(chunk), INSERT_BATCH_SIZE):
-                batch = chunk[j : j + INSERT_BATCH_SIZE]
-                f.write(
-                    'INSERT INTO "m_towns" ('
-                    'key_code, pref_code, city_code, level, town_name, '
-                    'latitude, longitude, population, male, female, households'
-                    ') VALUES\n'
-                )
-                f.write(",\n".join(batch))
-                f.write(";\n\n")
-
-            f.write("COMMIT;\n")
-            f.write(f"SELECT count(*) AS total_after_part_{file_count} FROM m_towns;\n")
-        
-        print(f"ファイル出力完了: {output_file} ({len(chunk)}件)")
+    # 2. 10,000件ごと（--max-part-bytes 指定時はサイズ上限まで詰めて）分割してファイル書き出し
+    def header_for(part):
+        header = f"-- D1 Seed Data Part {part}\nBEGIN TRANSACTION;\n"
+        # 最初のファイルの最初だけDELETE文を入れる（既存データをリセットする場合）
+        if part == 1:
+            header += "DELETE FROM m_towns;\n\n"
+        return header
+
+    def footer_for(part):
+        return f"COMMIT;\nSELECT count(*) AS total_after_part_{part} FROM m_towns;\n"
+
+    writer = SqlPartWriter(
+        lambda part: os.path.join(OUTPUT_DIR, f"{OUTPUT_BASE_NAME}_{part}.sql"),
+        header_for=header_for, footer_for=footer_for,
+        max_part_rows=None if args.max_part_bytes else FILE_SPLIT_SIZE,
+        max_part_bytes=args.max_part_bytes,
+        **statement_limits(args),
+    )
+    writer.set_statement(
+        'INSERT INTO "m_towns" ('
+        'key_code, pref_code, city_code, level, town_name, '
+        'latitude, longitude, population, male, female, households'
+        ') VALUES\n',
+        ";\n\n",
+    )
+    with writer:
+        for val in results:
+            writer.add_row(val)
+
+    for part in writer.parts:
+        print(f"ファイル出力完了: {part.path} ({part.rows}件)")
+    file_count = len(writer.parts)
+    print(size_report(writer.parts, args.max_part_bytes))
 
     print(f"\nすべて完了！ {file_count} 個のSQLファイルを生成しました。")
 
@@ -0,0 +1,202 @@
+"""
+Streaming text/CSV input shared by the seed generators and upload_kv.py.
+
+The encoding is detected from a bounded sample at the start of the file and
+the file is then decoded line by line, so memory use does not depend on the
+file size. If the sample is pure ASCII (e.g. only a header) detection is
+deferred to the first line that contains non-ASCII bytes.
+
+A line that cannot be decoded with the detected encoding raises
+EncodingError with the line number and byte offset instead of silently
+switching encodings part way through a file.
+"""
+
+import codecs
+import csv
+from typing import Iterator, List, Optional, Sequence
+
+ENCODINGS = ('utf-8-sig', 'utf-8', 'cp932', 'shift_jis', 'euc_jp')
+SAMPLE_BYTES = 64 * 1024
+UTF8_BOM = b'\xef\xbb\xbf'
+
+
+class EncodingError(ValueError):
+    """Raised when a file stops decoding with its detected encoding."""
+
+    def __init__(self, path: str, encoding: Optional[str], line_no: int, byte_offset: int, reason: str):
+        self.path = path
+        self.encoding = encoding
+        self.line_no = line_no
+        self.byte_offset = byte_offset
+        self.reason = reason
+        if encoding:
+            msg = f'{path}: line {line_no} (byte offset {byte_offset}) is not valid {encoding}: {reason}'
+        else:
+            msg = f'{path}: line {line_no} (byte offset {byte_offset}) does not decode with any of the tried encodings: {reason}'
+        super().__init__(msg)
+
+
+def _decodes(sample: bytes, encoding: str) -> bool:
+    """True if sample decodes, allowing a multi-byte sequence cut off at the end."""
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def detect_encoding(sample: bytes, encodings: Sequence[str] = ENCODINGS) -> Optional[str]:
+    """Return the first encoding in `encodings` that decodes `sample`.
+
+    Returns 'ascii' when the sample carries no evidence (pure ASCII) and None
+    when no candidate decodes it.
+    """
+    if sample.startswith(UTF8_BOM) and 'utf-8-sig' in encodings:
+        return 'utf-8-sig'
+    if sample.isascii():
+        return 'ascii'
+    for enc in encodings:
+        if enc == 'utf-8-sig':
+            # without a BOM this is plain utf-8, which is tried on its own
+            continue
+        if _decodes(sample, enc):
+            return enc
+    return None
+
+
+class TextStream:
+    """Iterate the decoded lines of a file in constant memory.
+
+    Lines keep their line endings so they can be fed to csv.reader directly.
+    `offset` is the byte offset of the next unread line and `line_no` the
+    number of lines read so far.
+    """
+
+    def __init__(self, path: str, encodings: Sequence[str] = ENCODINGS, sample_bytes: int = SAMPLE_BYTES):
+        self.path = path
+        self.encodings = tuple(encodings)
+        self._fh = open(path, 'rb')
+        sample = self._fh.read(sample_bytes)
+        self._fh.seek(0)
+        self._encoding = detect_encoding(sample, self.encodings)
+        if self._encoding is None:
+            self._fh.close()
+            raise EncodingError(path, None, 1, 0, f'tried {", ".join(self.encodings)} on the first {len(sample)} bytes')
+        self.offset = 0
+        self.line_no = 0
+        if self._encoding == 'utf-8-sig':
+            self._fh.seek(len(UTF8_BOM))
+            self.offset = len(UTF8_BOM)
+
+    @property
+    def encoding(self) -> str:
+        """Detected encoding ('ascii' while no non-ASCII byte has been seen)."""
+        return self._encoding
+
+    def _line_codec(self) -> str:
+        # the BOM is skipped on open, so the remaining lines are plain utf-8
+        return 'utf-8' if self._encoding == 'utf-8-sig' else self._encoding
+
+    def _decode(self, raw: bytes) -> str:
+        if self._encoding == 'ascii':
+            if raw.isascii():
+                return raw.decode('ascii')
+            # first line with real evidence: settle the encoding on it
+            enc = detect_encoding(raw, tuple(e for e in self.encodings if e != 'utf-8-sig'))
+            if enc is None or enc == 'ascii':
+                raise EncodingError(self.path, None, self.line_no, self.offset, f'tried {", ".join(self.encodings)}')
+            self._encoding = enc
+        try:
+            return raw.decode(self._line_codec())
+        except UnicodeDecodeError as e:
+            raise EncodingError(self.path, self._encoding, self.line_no, self.offset, str(e)) from None
+
+    def __iter__(self) -> Iterator[str]:
+        return self
+
+    def __next__(self) -> str:
+        raw = self._fh.readline()
+        if not raw:
+            raise StopIteration
+        self.line_no += 1
+        line = self._decode(raw)
+        self.offset += len(raw)
+        return line
+
+    def seek(self, offset: int, line_no: int = 0):
+        """Continue at byte `offset`, which must be the start of a line (an `offset` seen earlier)."""
+        self._fh.seek(offset)
+        self.offset = offset
+        self.line_no = line_no
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvStream:
+    """csv.reader over a TextStream.
+
+    `header` holds the first row (None for an empty file). `row_offset` is
+    the byte offset at which the most recently returned row starts (and
+    `row_line_no` the number of lines before it); seek() returns to one,
+    e.g. to resume a file part way through.
+    """
+
+    def __init__(self, path: str, encodings: Sequence[str] = ENCODINGS, delimiter: str = ',', has_header: bool = True):
+        self.text = TextStream(path, encodings=encodings)
+        self._reader = csv.reader(self.text, delimiter=delimiter)
+        self.row_offset = self.text.offset
+        self.row_line_no = self.text.line_no
+        self.header: Optional[List[str]] = None
+        if has_header:
+            try:
+                self.header = next(self._reader)
+            except StopIteration:
+                self.header = None
+
+    @property
+    def encoding(self) -> str:
+        return self.text.encoding
+
+    @property
+    def path(self) -> str:
+        return self.text.path
+
+    def __iter__(self) -> Iterator[List[str]]:
+        return self
+
+    def __next__(self) -> List[str]:
+        # csv.reader pulls exactly the lines of one record, so the stream
+        # offset before the call is where the record starts
+        self.row_offset = self.text.offset
+        self.row_line_no = self.text.line_no
+        return next(self._reader)
+
+    def seek(self, offset: int, line_no: int = 0):
+        """Continue with the row starting at byte `offset` (a row_offset seen earlier)."""
+        self.text.seek(offset, line_no)
+        self.row_offset = offset
+        self.row_line_no = line_no
+
+    def close(self):
+        self.text.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_text_stream(path: str, encodings: Sequence[str] = ENCODINGS) -> TextStream:
+    return TextStream(path, encodings=encodings)
+
+
+def open_csv_stream(path: str, encodings: Sequence[str] = ENCODINGS, delimiter: str = ',', has_header: bool = True) -> CsvStream:
+    return CsvStream(path, encodings=encodings, delimiter=delimiter, has_header=has_header)
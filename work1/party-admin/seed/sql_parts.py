@@ -0,0 +1,228 @@
+"""
+Split generated SQL into part files under row and byte budgets.
+
+SqlPartWriter packs multi-row INSERT statements (or complete single
+statements) into numbered files. Every limit is optional and they combine:
+
+  max_part_rows / max_statement_rows    row counts, as the generators used to split
+  max_part_bytes / max_statement_bytes  UTF-8 sizes of a whole file (header and
+                                        footer included) / of one statement
+
+A row is added to the current statement and file only if both still fit
+afterwards; otherwise the statement is closed and, if needed, a new file is
+started, so each file is filled as close to its byte budget as possible
+without going over. A single row that cannot fit even on its own raises
+ValueError.
+
+D1 rejects statements over D1_MAX_STATEMENT_BYTES, so callers apply that as
+the statement budget unless told otherwise.
+"""
+
+import os
+from typing import Callable, List, NamedTuple, Optional
+
+D1_MAX_STATEMENT_BYTES = 100_000
+
+
+def utf8_len(s: str) -> int:
+    return len(s) if s.isascii() else len(s.encode('utf-8'))
+
+
+class PartStats(NamedTuple):
+    path: str
+    bytes: int
+    statements: int
+    rows: int
+    last: bool = False  # final part of its writer, holding whatever was left over
+
+
+class SqlPartWriter:
+    """Write rows / statements into part files, rotating on the configured budgets.
+
+    path_for(n), header_for(n) and footer_for(n) give the path and the fixed
+    text at the start / end of part n (1-based). Parts are opened lazily, so
+    no empty trailing part is written.
+    """
+
+    def __init__(self, path_for: Callable[[int], str],
+                 header_for: Optional[Callable[[int], str]] = None,
+                 footer_for: Optional[Callable[[int], str]] = None,
+                 max_part_rows: Optional[int] = None, max_part_bytes: Optional[int] = None,
+                 max_statement_rows: Optional[int] = None, max_statement_bytes: Optional[int] = None):
+        self.path_for = path_for
+        self.header_for = header_for or (lambda n: '')
+        self.footer_for = footer_for or (lambda n: '')
+        self.max_part_rows = max_part_rows or None
+        self.max_part_bytes = max_part_bytes or None
+        self.max_statement_rows = max_statement_rows or None
+        self.max_statement_bytes = max_statement_bytes or None
+        self.parts: List[PartStats] = []
+
+        self._fh = None
+        self._index = 0
+        self._part_bytes = 0
+        self._part_rows = 0
+        self._part_statements = 0
+        self._footer_bytes = 0
+        # statement being collected
+        self._prefix = ''
+        self._separator = ',\n'
+        self._suffix = ''
+        self._rows: List[str] = []
+        self._stmt_bytes = 0
+
+    # -- parts --
+
+    def _open_part(self):
+        self._index += 1
+        path = self.path_for(self._index)
+        self._fh = open(path, 'w', encoding='utf-8')
+        header = self.header_for(self._index)
+        self._fh.write(header)
+        self._part_bytes = utf8_len(header)
+        self._part_rows = 0
+        self._part_statements = 0
+        self._footer_bytes = utf8_len(self.footer_for(self._index))
+        self._path = path
+
+    def close_part(self):
+        """Finish the current part (if any); the next write starts a new one."""
+        self.flush_statement()
+        if self._fh is None:
+            return
+        footer = self.footer_for(self._index)
+        self._fh.write(footer)
+        self._fh.close()
+        self._fh = None
+        self.parts.append(PartStats(self._path, self._part_bytes + utf8_len(footer), self._part_statements, self._part_rows))
+
+    def _part_has_room(self, extra_bytes: int) -> bool:
+        if self.max_part_bytes is None:
+            return True
+        return self._part_bytes + extra_bytes + self._footer_bytes <= self.max_part_bytes
+
+    def _part_is_empty(self) -> bool:
+        return self._part_statements == 0 and not self._rows
+
+    def _ensure_part(self):
+        if self._fh is None:
+            self._open_part()
+
+    def write_raw(self, text: str):
+        """Text between statements (comments, BEGIN/DELETE ...), counted in the part size."""
+        self.flush_statement()
+        self._ensure_part()
+        size = utf8_len(text)
+        if not self._part_has_room(size) and not self._part_is_empty():
+            self.close_part()
+            self._ensure_part()
+        self._fh.write(text)
+        self._part_bytes += size
+
+    # -- statements --
+
+    def set_statement(self, prefix: str, suffix: str, separator: str = ',\n'):
+        """Template for multi-row statements: prefix + rows joined by separator + suffix."""
+        self.flush_statement()
+        self._prefix = prefix
+        self._suffix = suffix
+        self._separator = separator
+
+    def add_row(self, row_sql: str):
+        """Add one row (e.g. "(1,'a')") to the current multi-row statement."""
+        row_bytes = utf8_len(row_sql)
+        alone = utf8_len(self._prefix) + row_bytes + utf8_len(self._suffix)
+        if self.max_statement_bytes is not None and alone > self.max_statement_bytes:
+            raise ValueError(f'a single row makes a {alone} byte statement (limit {self.max_statement_bytes})')
+
+        if self._rows:
+            grown = self._stmt_bytes + utf8_len(self._separator) + row_bytes
+            if (self.max_statement_rows is not None and len(self._rows) >= self.max_statement_rows) or \
+                    (self.max_statement_bytes is not None and grown > self.max_statement_bytes):
+                self.flush_statement()
+            elif not self._part_has_room(grown):
+                self.close_part()
+
+        self._ensure_part()
+        if not self._rows:
+            if not self._part_has_room(alone):
+                if self._part_is_empty():
+                    raise ValueError(f'a single row does not fit in a part of {self.max_part_bytes} bytes')
+                self.close_part()
+                self._ensure_part()
+            self._stmt_bytes = alone
+        else:
+            self._stmt_bytes += utf8_len(self._separator) + row_bytes
+        self._rows.append(row_sql)
+        self._part_rows += 1
+        if self.max_part_rows is not None and self._part_rows >= self.max_part_rows:
+            self.close_part()
+
+    def flush_statement(self):
+        """Write the statement collected so far."""
+        if not self._rows:
+            return
+        self._fh.write(self._prefix + self._separator.join(self._rows) + self._suffix)
+        self._part_bytes += self._stmt_bytes
+        self._part_statements += 1
+        self._rows = []
+        self._stmt_bytes = 0
+
+    def add_statement(self, sql: str, rows: int = 1):
+        """Add one complete statement (counted as `rows` rows)."""
+        self.flush_statement()
+        size = utf8_len(sql)
+        if self.max_statement_bytes is not None and size > self.max_statement_bytes:
+            raise ValueError(f'statement of {size} bytes exceeds the {self.max_statement_bytes} byte limit')
+        self._ensure_part()
+        if not self._part_has_room(size):
+            if self._part_is_empty():
+                raise ValueError(f'a {size} byte statement does not fit in a part of {self.max_part_bytes} bytes')
+            self.close_part()
+            self._ensure_part()
+        self._fh.write(sql)
+        self._part_bytes += size
+        self._part_statements += 1
+        self._part_rows += rows
+        if self.max_part_rows is not None and self._part_rows >= self.max_part_rows:
+            self.close_part()
+
+    def close(self) -> List[PartStats]:
+        self.close_part()
+        if self.parts and not self.parts[-1].last:
+            self.parts[-1] = self.parts[-1]._replace(last=True)
+        return self.parts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def size_report(parts: List[PartStats], max_part_bytes: Optional[int] = None) -> str:
+    """Human readable size distribution of the written parts."""
+    if not parts:
+        return 'no parts written'
+    sizes = sorted(p.bytes for p in parts)
+    total = sum(sizes)
+    lines = [
+        f'{len(parts)} parts, {total:,} bytes, {sum(p.rows for p in parts):,} rows, '
+        f'{sum(p.statements for p in parts):,} statements',
+        f'part bytes: min {sizes[0]:,}  p50 {_percentile(sizes, 0.5):,}  p90 {_percentile(sizes, 0.9):,}  '
+        f'max {sizes[-1]:,}  mean {total // len(sizes):,}',
+    ]
+    if max_part_bytes:
+        # a writer's last part only holds what is left over, so it is left out of the fill ratio
+        full = sorted(p.bytes for p in parts if not p.last) or sizes
+        lines.append(f'fill vs {max_part_bytes:,} byte budget: min {100 * full[0] / max_part_bytes:.2f}%  '
+                     f'mean {100 * sum(full) / len(full) / max_part_bytes:.2f}% (final parts excluded)')
+    largest = max(parts, key=lambda p: p.bytes)
+    lines.append(f'largest: {os.path.basename(largest.path)}')
+    return '\n'.join(lines)
@@ -0,0 +1,150 @@
+"""
+Load seed rows straight into a local SQLite database.
+
+The table definitions are taken from the project's real schema files
+(migrations/*.sql, then work1/party-admin/create.sql for the m_* master
+tables), so the local database matches what D1 has. Rows are written with
+executemany() in large transactions.
+
+export_sql_parts() turns a loaded table back into compact multi-row INSERT
+statements for `wrangler d1 execute --file`, formatted by SQLite's quote(),
+so rows are only ever formatted once. They are written through a
+SqlPartWriter, so the caller's row and byte budgets (at least D1's
+statement limit) apply.
+"""
+
+import glob
+import os
+import re
+import sqlite3
+from itertools import islice
+from typing import Iterable, List, Optional, Sequence
+
+SEED_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.abspath(os.path.join(SEED_DIR, '..', '..', '..'))
+MIGRATIONS_DIR = os.path.join(REPO_ROOT, 'migrations')
+MASTER_SCHEMA_FILE = os.path.join(SEED_DIR, '..', 'create.sql')
+
+BATCH_ROWS = 50000
+DUMP_ROWS_PER_STATEMENT = 500
+
+_CREATE_TABLE_RE = re.compile(r'^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?["`\[]?(\w+)', re.IGNORECASE)
+
+
+def schema_files() -> List[str]:
+    files = sorted(glob.glob(os.path.join(MIGRATIONS_DIR, '*.sql')))
+    if os.path.exists(MASTER_SCHEMA_FILE):
+        files.append(os.path.abspath(MASTER_SCHEMA_FILE))
+    return files
+
+
+def _iter_statements(path: str):
+    buf = []
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        for line in f:
+            if not buf and (not line.strip() or line.lstrip().startswith('--')):
+                continue
+            buf.append(line)
+            stmt = ''.join(buf)
+            if sqlite3.complete_statement(stmt):
+                yield stmt.strip()
+                buf = []
+
+
+def table_ddl(table: str, files: Optional[Sequence[str]] = None) -> str:
+    """Return the last CREATE TABLE statement for `table` in the schema files."""
+    found = None
+    for path in files if files is not None else schema_files():
+        for stmt in _iter_statements(path):
+            m = _CREATE_TABLE_RE.match(stmt)
+            if m and m.group(1) == table:
+                found = stmt
+    if found is None:
+        raise LookupError(f'CREATE TABLE {table} not found in {MIGRATIONS_DIR} or {MASTER_SCHEMA_FILE}')
+    return found
+
+
+def connect(db_path: str, tables: Sequence[str]) -> sqlite3.Connection:
+    """Open (or create) db_path and make sure `tables` exist."""
+    db_dir = os.path.dirname(os.path.abspath(db_path))
+    os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    # a seed database is rebuilt from source on failure, so trade durability for speed
+    conn.execute('PRAGMA journal_mode = MEMORY')
+    conn.execute('PRAGMA synchronous = OFF')
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table in tables:
+        if table not in existing:
+            conn.executescript(table_ddl(table))
+    return conn
+
+
+def primary_key(conn: sqlite3.Connection, table: str) -> List[str]:
+    cols = [(row[5], row[1]) for row in conn.execute(f'PRAGMA table_info("{table}")') if row[5]]
+    return [name for _, name in sorted(cols)]
+
+
+def load_rows(conn: sqlite3.Connection, table: str, columns: Sequence[str], rows: Iterable[Sequence],
+              conflict: Optional[str] = None, delete_first: bool = False, batch_rows: int = BATCH_ROWS) -> int:
+    """executemany() rows into table, one transaction per batch_rows rows.
+
+    conflict: None (plain INSERT), 'ignore' (first row wins, like the
+    generators' NOT EXISTS / DO NOTHING output) or 'replace' (last row wins).
+    Returns the number of rows handed to SQLite.
+    """
+    verb = {None: 'INSERT', 'ignore': 'INSERT OR IGNORE', 'replace': 'INSERT OR REPLACE'}[conflict]
+    cols_sql = ', '.join(columns)
+    placeholders = ', '.join('?' for _ in columns)
+    sql = f'{verb} INTO "{table}" ({cols_sql}) VALUES ({placeholders})'
+    total = 0
+    if delete_first:
+        with conn:
+            conn.execute(f'DELETE FROM "{table}"')
+    it = iter(rows)
+    while True:
+        batch = list(islice(it, batch_rows))
+        if not batch:
+            break
+        with conn:
+            conn.executemany(sql, batch)
+        total += len(batch)
+    return total
+
+
+def _dump_clauses(conn: sqlite3.Connection, table: str, columns: Optional[Sequence[str]], on_conflict: Optional[str]):
+    """(columns, SELECT expression giving each row as a VALUES literal, ON CONFLICT clause)."""
+    if columns is None:
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+    literal_sql = " || ',' || ".join(f'quote("{c}")' for c in columns)
+    pk = primary_key(conn, table)
+    conflict_sql = ''
+    if on_conflict and pk:
+        if on_conflict == 'update':
+            assignments = ','.join(f'{c}=excluded.{c}' for c in columns if c not in pk)
+            conflict_sql = f'\nON CONFLICT({",".join(pk)}) DO UPDATE SET {assignments}'
+        else:
+            conflict_sql = f'\nON CONFLICT({",".join(pk)}) DO NOTHING'
+    return columns, literal_sql, conflict_sql
+
+
+def export_sql_parts(conn: sqlite3.Connection, table: str, writer, columns: Optional[Sequence[str]] = None,
+                     on_conflict: Optional[str] = 'nothing') -> int:
+    """Write table as multi-row INSERT statements through a sql_parts.SqlPartWriter.
+
+    on_conflict: 'nothing' / 'update' add ON CONFLICT(<primary key>) so the
+    dump can be re-run; None writes plain INSERTs. The caller opens and
+    closes the writer. Returns the row count.
+    """
+    columns, literal_sql, conflict_sql = _dump_clauses(conn, table, columns, on_conflict)
+    writer.set_statement(f'INSERT INTO "{table}" ({",".join(columns)}) VALUES\n', f'{conflict_sql};\n\n')
+    total = 0
+    cursor = conn.execute(f'SELECT {literal_sql} FROM "{table}" ORDER BY rowid')
+    while True:
+        batch = cursor.fetchmany(BATCH_ROWS)
+        if not batch:
+            break
+        for row in batch:
+            writer.add_row(f'({row[0]})')
+        total += len(batch)
+    writer.flush_statement()
+    return total
@@ -0,0 +1,112 @@
+"""Tests for seed_io: encoding detection, BOM handling and mid-file encoding errors.
+
+  python -m pytest test_seed_io.py
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from seed_io import SAMPLE_BYTES, EncodingError, open_csv_stream, open_text_stream  # noqa: E402
+
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmp.name, 'input.txt')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def write(self, *chunks):
+        with open(self.path, 'wb') as f:
+            f.write(b''.join(chunks))
+
+    def ascii_rows(self, count):
+        return [f'{533900000 + n},{n}\r\n'.encode('ascii') for n in range(count)]
+
+    def test_ascii_prefix_then_cp932(self):
+        # more ASCII than the detection sample, so the encoding is settled on the first CP932 line
+        rows = self.ascii_rows(SAMPLE_BYTES // 10)
+        prefix = b'KEY_CODE,NAME\r\n' + b''.join(rows)
+        self.assertGreater(len(prefix), SAMPLE_BYTES)
+        self.write(prefix, '533999999,札幌市中央区\r\n'.encode('cp932'), b'533999998,x\r\n')
+
+        with open_csv_stream(self.path) as reader:
+            self.assertEqual(reader.encoding, 'ascii')
+            self.assertEqual(reader.header, ['KEY_CODE', 'NAME'])
+            read = list(reader)
+            self.assertEqual(reader.encoding, 'cp932')
+        self.assertEqual(len(read), len(rows) + 2)
+        self.assertEqual(read[-2], ['533999999', '札幌市中央区'])
+        self.assertEqual(read[-1], ['533999998', 'x'])
+
+    def test_ascii_prefix_then_utf8(self):
+        prefix = b''.join(self.ascii_rows(SAMPLE_BYTES // 10))
+        self.write(prefix, '533999999,札幌\n'.encode('utf-8'))
+        with open_text_stream(self.path) as stream:
+            lines = list(stream)
+            self.assertEqual(stream.encoding, 'utf-8')
+        self.assertEqual(lines[-1], '533999999,札幌\n')
+
+    def test_utf8_bom(self):
+        header = 'KEY_CODE,NAME\n'.encode('utf-8')
+        first = '533900000,札幌\n'.encode('utf-8')
+        self.write(b'\xef\xbb\xbf', header, first, b'533900001,x\n')
+
+        with open_csv_stream(self.path) as reader:
+            self.assertEqual(reader.encoding, 'utf-8-sig')
+            # the BOM is not part of the first column name
+            self.assertEqual(reader.header, ['KEY_CODE', 'NAME'])
+            self.assertEqual(next(reader), ['533900000', '札幌'])
+            self.assertEqual(reader.row_offset, 3 + len(header))
+            second = 3 + len(header) + len(first)
+            self.assertEqual(next(reader), ['533900001', 'x'])
+            self.assertEqual(reader.row_offset, second)
+
+            # seeking back to a recorded row offset reads the same row again
+            reader.seek(3 + len(header), 1)
+            self.assertEqual(next(reader), ['533900000', '札幌'])
+            self.assertEqual(reader.row_line_no, 1)
+
+    def test_invalid_byte_mid_file(self):
+        head = 'KEY_CODE,NAME\r\n533900000,札幌\r\n'.encode('cp932')
+        filler = b''.join(self.ascii_rows(SAMPLE_BYTES // 10))
+        bad_offset = len(head) + len(filler)
+        bad_line = 2 + SAMPLE_BYTES // 10 + 1
+        self.write(head, filler, b'533999999,\x81\r\n', b'533999998,x\r\n')
+
+        with open_csv_stream(self.path) as reader:
+            self.assertEqual(reader.encoding, 'cp932')
+            read = 0
+            with self.assertRaises(EncodingError) as ctx:
+                for _ in reader:
+                    read += 1
+        err = ctx.exception
+        self.assertEqual(read, 1 + SAMPLE_BYTES // 10)
+        self.assertEqual(err.encoding, 'cp932')
+        self.assertEqual(err.line_no, bad_line)
+        self.assertEqual(err.byte_offset, bad_offset)
+        self.assertIn(f'line {bad_line} (byte offset {bad_offset})', str(err))
+
+    def test_invalid_line_after_ascii_prefix(self):
+        prefix = b''.join(self.ascii_rows(SAMPLE_BYTES // 10))
+        self.write(prefix, b'533999999,\xff\xfe\r\n')
+        with open_text_stream(self.path, encodings=('utf-8-sig', 'utf-8')) as stream:
+            with self.assertRaises(EncodingError) as ctx:
+                list(stream)
+        self.assertIsNone(ctx.exception.encoding)
+        self.assertEqual(ctx.exception.line_no, SAMPLE_BYTES // 10 + 1)
+        self.assertEqual(ctx.exception.byte_offset, len(prefix))
+
+    def test_undecodable_sample(self):
+        self.write(b'\xff\xfe\xfd\r\n')
+        with self.assertRaises(EncodingError) as ctx:
+            open_text_stream(self.path, encodings=('utf-8',))
+        self.assertEqual((ctx.exception.line_no, ctx.exception.byte_offset), (1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()